@@ -2,8 +2,19 @@
 应用配置管理
 使用 Pydantic Settings 管理环境变量
 """
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Literal, Optional
+
+
+class GeminiRouteConfig(BaseModel):
+    """Gemini 调用路线配置（API Key + 模型）"""
+    api_key: str
+    model: str = "gemini-2.0-flash-exp"
+    weight: float = 1.0
+    tier: Literal["primary", "cheap"] = "primary"
+    rpm: Optional[int] = None  # 为空时使用 gemini_rpm_limit
+    tpm: Optional[int] = None  # 为空时使用 gemini_tpm_limit
 
 
 class Settings(BaseSettings):
@@ -20,21 +31,144 @@ class Settings(BaseSettings):
     
     # Gemini API 配置
     gemini_api_key: str
+    gemini_model: str = "gemini-2.0-flash-exp"
+    # 多 Key / 多模型路由（JSON 数组），为空时只使用 gemini_api_key + gemini_model
+    gemini_routes: List[GeminiRouteConfig] = []
+    # 优先分配给 tier=cheap 路线的流量比例（0-1）
+    gemini_cheap_traffic_ratio: float = 0.0
+    # 启动时预热客户端并验证 Key 和模型；strict 模式下没有可用路线时拒绝启动
+    gemini_warmup_enabled: bool = True
+    gemini_warmup_timeout_seconds: float = 10
+    gemini_warmup_strict: bool = False
+
+    # Gemini 文件缓存配置（重试和重复分析时复用已上传的文件）
+    gemini_file_cache_enabled: bool = True
+    gemini_file_cache_ttl_seconds: int = 6 * 3600  # Gemini 文件最长保留 48 小时
+    gemini_file_cache_max_entries: int = 200
+
+    # Gemini 调用超时、重试与熔断配置
+    gemini_upload_timeout_seconds: float = 60
+    gemini_processing_timeout_seconds: float = 60
+    gemini_poll_timeout_seconds: float = 10
+    gemini_generate_timeout_seconds: float = 90
+    gemini_max_retries: int = 2
+    gemini_retry_base_delay: float = 1.0
+    gemini_retry_max_delay: float = 8.0
+    gemini_breaker_failure_threshold: int = 5
+    gemini_breaker_recovery_seconds: float = 30
+
+    # Gemini 配额调度配置（0 表示不限制，默认不限制；按所用 Key 的配额设置，如免费层 10 RPM）
+    gemini_rpm_limit: int = 0
+    gemini_tpm_limit: int = 0
+    gemini_queue_max_size: int = 50
+    gemini_queue_max_wait_seconds: float = 30
+    # 配额按 worker 数平分（run.py 多 worker 启动时自动设置，无需手动配置）
+    gemini_quota_workers: int = 1
+    premium_points_threshold: int = 50  # 累计获得积分超过该值视为付费用户（注册赠送 50）
 
     # 微信配置
     wechat_app_id: str
     wechat_app_secret: str
+    wechat_cloud_env: str = "cloud1-1grfk67f82062cc1"  # 云开发环境ID（换取云存储文件下载链接）
     
     # 服务器配置
     host: str = "0.0.0.0"
     port: int = 80  # 微信云托管默认监听 80 端口
     
+    # 生产模式多进程配置（run.py）
+    # 默认单 worker：配额调度、熔断、进度推送、幂等、请求合并和内存缓存都保存在进程内，多 worker 时各自独立
+    server_workers: int = 1  # 0 表示按容器可用 CPU 核数自动设置
+    server_max_requests: int = 2000  # 多 worker 时 worker 处理该数量的请求后重启，回收 ffmpeg 相关的内存增长（0 表示不重启；单 worker 时不生效）
+    server_graceful_timeout_seconds: int = 30
+    server_keepalive_seconds: int = 5
+    server_backlog: int = 2048
+    
     # 文件存储配置
     upload_dir: str = "./uploads"
+    upload_tmp_dir: str = "./upload_tmp"  # 断点续传的未完成上传，不能放在 upload_dir 下（/uploads 对外提供静态访问）
     max_video_size_mb: int = 50
     max_video_duration_seconds: int = 10
     allowed_extensions: str = "mp4,mov,avi,mkv,webm"
     
+    # 断点续传上传配置（分片上传，网络中断后从已接收的位置继续）
+    upload_chunk_size_mb: int = 5  # 建议（也是允许的最大）分片大小
+    upload_session_ttl_seconds: int = 24 * 3600  # 会话无新分片后保留的时间，过期自动清理
+    
+    # 云存储视频同步：能顺序读取的视频边下载边转码（或计算运动强度）
+    cloud_sync_streaming_enabled: bool = True
+    cloud_sync_batch_max_files: int = 50  # 单次批量同步的文件数（batchdownloadfile 一次最多 50 个）
+    cloud_sync_download_concurrency: int = 4  # 批量同步时同时下载的文件数
+    cloud_sync_transcode_concurrency: int = 2  # 每个 worker 同时进行的 ffmpeg 转码数（云存储同步、上传处理和分析视频生成共用）
+    
+    # /uploads 静态文件缓存配置（UUID 命名的文件按不可变缓存）
+    static_cache_max_age_seconds: int = 365 * 24 * 3600
+    static_chunk_size_kb: int = 1024  # 不支持零拷贝发送时每次读取的块大小
+    
+    # 缩略图配置（一次 ffmpeg 调用生成多个尺寸、WebP 版本和动态预览）
+    thumbnail_sizes: str = "160,320,640"  # JPEG 宽度，320 为主缩略图
+    thumbnail_webp_enabled: bool = True
+    thumbnail_preview_enabled: bool = True  # 动态 WebP 预览
+    thumbnail_preview_seconds: float = 2.0
+    thumbnail_preview_fps: int = 10
+    thumbnail_preview_width: int = 240
+    
+    # AI 分析视频配置（上传给模型的轻量版本）
+    analysis_profile_enabled: bool = True
+    analysis_max_resolution: int = 720  # 短边最大像素
+    analysis_fps: int = 24
+    analysis_crf: int = 30
+    
+    # AI 分析模式：video 上传完整视频，frames 只发送击球前后的关键帧
+    analysis_mode: str = "video"
+    analysis_keyframe_count: int = 8
+    analysis_keyframe_span_seconds: float = 1.6
+    
+    # 分析 Prompt 版本（v1 自由格式 JSON，v2 由 response_schema 约束输出结构）
+    analysis_prompt_version: str = "v2"
+    # 客户端订阅进度时使用流式生成，已生成的字段（速度、等级、评分等）立即推送
+    analysis_streaming_enabled: bool = True
+    
+    # 批量分析配置
+    analysis_batch_max_videos: int = 50
+    analysis_batch_concurrency: int = 5  # 单个批次同时进行的分析数
+    
+    # 自动裁剪配置（未手动指定裁剪范围时，按运动强度截取杀球片段）
+    # 默认关闭：会改变未指定裁剪范围时的处理结果，请求可通过 auto_trim=true 单独开启
+    auto_trim_enabled: bool = False
+    auto_trim_window_seconds: float = 3.0
+    
+    # 任务进度推送（SSE）配置
+    progress_history_size: int = 20  # 每个任务保留的事件数（订阅时回放）
+    progress_ttl_seconds: int = 600  # 任务无更新后保留的时间
+    progress_heartbeat_seconds: float = 15
+    progress_stream_timeout_seconds: float = 300
+    progress_subscribe_wait_seconds: float = 10  # 先订阅后发起任务时，等待任务开始的时间
+    
+    # 数据库批量写入配置（积分流水合并为多行插入，失败时转存本地文件后重放；分析记录同步插入，保存后即可查询）
+    db_write_batching_enabled: bool = True
+    db_batch_interval_ms: int = 5
+    db_batch_max_rows: int = 100
+    db_spool_path: str = "./spool/db_writes.jsonl"
+    db_spool_replay_seconds: float = 60
+    
+    # 服务层缓存配置（memory 为进程内缓存；多 worker 部署使用 redis 共享缓存和失效）
+    # memory 后端下每个 worker 各自缓存，写入后只清除当前 worker 的缓存：
+    # 其他 worker 最多在 history_cache_ttl_seconds / statistics_cache_ttl_seconds 内返回旧的历史记录和统计
+    cache_backend: str = "memory"
+    redis_url: str = "redis://localhost:6379/0"
+    cache_key_prefix: str = "badminton"
+    cache_max_entries: int = 10000  # 仅 memory 后端，redis 由 maxmemory 控制
+    cache_lock_timeout_seconds: float = 10  # 其他 worker 正在加载同一个键时的最长等待时间
+    history_cache_ttl_seconds: int = 300  # 保存新的分析结果时按用户失效；也是 memory 后端多 worker 时旧数据的最长保留时间
+    statistics_cache_ttl_seconds: int = 60
+    
+    # 幂等请求配置（Idempotency-Key）
+    # cache_backend=redis 时通过 Redis 在 worker 之间共享；memory 时只在同一 worker 内生效，
+    # 多 worker 部署下重试落到其他 worker 会重新执行（重复处理、重复扣积分）
+    idempotency_ttl_seconds: int = 24 * 3600
+    idempotency_max_entries: int = 10000  # 进程内记录的最大条数
+    idempotency_in_flight_ttl_seconds: float = 600  # 进行中标记的有效期（worker 退出后过期），也是其他 worker 上重试的最长等待时间
+    
     # CORS 配置
     allowed_origins: str = "http://localhost:4200"
     
@@ -47,6 +181,11 @@ class Settings(BaseSettings):
         """获取允许的文件扩展名列表"""
         return [ext.strip().lower() for ext in self.allowed_extensions.split(",")]
     
+    @property
+    def thumbnail_sizes_list(self) -> List[int]:
+        """获取缩略图 JPEG 宽度列表"""
+        return [int(size) for size in self.thumbnail_sizes.split(",") if size.strip()]
+    
     @property
     def allowed_origins_list(self) -> List[str]:
         """获取允许的跨域来源列表"""
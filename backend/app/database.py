@@ -1,9 +1,15 @@
 """
 Supabase 数据库连接管理
 """
-from supabase import create_client, Client
+from typing import TYPE_CHECKING, Any
 from app.config import settings
 
+if TYPE_CHECKING:
+    from supabase import Client
+else:
+    # supabase 导入耗时较长，运行时只在创建客户端时导入；类型注解仅供编辑器和类型检查使用
+    Client = Any
+
 
 class Database:
     """数据库连接管理类"""
@@ -14,6 +20,8 @@ class Database:
     def get_client(cls) -> Client:
         """获取 Supabase 客户端实例（单例模式）"""
         if cls._client is None:
+            from supabase import create_client
+
             cls._client = create_client(
                 supabase_url=settings.supabase_url,
                 supabase_key=settings.supabase_key
@@ -2,10 +2,10 @@
 依赖注入函数
 """
 from typing import Optional
-from fastapi import Depends, HTTPException, status, Request
+from fastapi import Depends, Header, HTTPException, Query, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from supabase import Client
-from app.database import get_db
+from app.database import Client, get_db
+from app.services.cache import Cache, cache
 from app.utils.security import decode_access_token
 from app.models.user import User
 
@@ -96,6 +96,47 @@ async def get_current_user(
         )
 
 
+async def get_current_user_for_stream(
+    request: Request,
+    access_token: Optional[str] = Query(None, description="EventSource 无法设置请求头时通过查询参数传递 Token"),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
+    db: Client = Depends(get_db)
+) -> dict:
+    """
+    获取当前登录用户（用于 SSE 等流式接口）
+    
+    浏览器 EventSource 不支持自定义请求头，允许通过 access_token 查询参数传递 JWT
+    """
+    if credentials is None and access_token:
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=access_token)
+    return await get_current_user(request, credentials, db)
+
+
+def get_cache() -> Cache:
+    """
+    获取服务层缓存
+    
+    后端由 CACHE_BACKEND 配置：memory（进程内）或 redis（多个 worker 共享缓存和失效）
+    """
+    return cache
+
+
+async def get_idempotency_key(
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> Optional[str]:
+    """
+    获取请求头中的幂等 Key
+    
+    客户端为每次操作生成唯一 Key（如 UUID），网络重试时复用同一个 Key
+    """
+    if idempotency_key is not None and not 1 <= len(idempotency_key) <= 255:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Idempotency-Key 长度必须在 1-255 之间"
+        )
+    return idempotency_key
+
+
 async def get_current_user_optional(
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
     db: Client = Depends(get_db)
@@ -4,12 +4,14 @@ FastAPI 主应用
 """
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
+import asyncio
+import json
 import os
 
 from app.config import settings
-from app.routers import auth, video, analysis, history, admin
+from app.routers import auth, video, analysis, history, admin, progress
+from app.utils.static_files import UploadStaticFiles
 
 
 # 创建 FastAPI 应用
@@ -40,11 +42,12 @@ app.include_router(video.router, prefix="/api")
 app.include_router(analysis.router, prefix="/api")
 app.include_router(history.router, prefix="/api")
 app.include_router(admin.router, prefix="/api")
+app.include_router(progress.router, prefix="/api")
 
 
-# 挂载静态文件（上传的视频和缩略图）
+# 挂载静态文件（上传的视频和缩略图，支持 ETag/304、不可变缓存和 Range）
 if os.path.exists(settings.upload_dir):
-    app.mount("/uploads", StaticFiles(directory=settings.upload_dir), name="uploads")
+    app.mount("/uploads", UploadStaticFiles(directory=settings.upload_dir), name="uploads")
 
 
 # 根路径
@@ -63,9 +66,30 @@ async def root():
 @app.get("/health", tags=["健康检查"])
 async def health_check():
     """健康检查端点"""
+    from app.services.gemini_router import gemini_router
+    from app.services.gemini_file_cache import gemini_file_cache
+    from app.services.idempotency_store import idempotency_store
+    from app.services.analysis_service import analysis_singleflight
+    from app.services.prompt_registry import PROMPTS
+    from app.services.write_batcher import write_batcher
+    from app.services.cache import cache
+    from app.services.upload_sessions import upload_sessions
+    from app.utils.ffmpeg_helper import FFmpegHelper
+    
     return {
-        "status": "healthy",
-        "service": "badminton-smash-analysis-api"
+        "status": "healthy" if gemini_router.plan() and not gemini_router.misconfigured else "degraded",
+        "service": "badminton-smash-analysis-api",
+        "gemini": {
+            "router": gemini_router.snapshot(),
+            "file_cache": gemini_file_cache.stats()
+        },
+        "idempotency": idempotency_store.stats(),
+        "analysis_singleflight": analysis_singleflight.snapshot(),
+        "prompts": [p.snapshot() for p in PROMPTS.values()],
+        "write_batcher": write_batcher.stats(),
+        "cache": cache.stats(),
+        "upload_sessions": upload_sessions.stats(),
+        "ffmpeg": FFmpegHelper.capabilities() or {"probed": False}
     }
 
 
@@ -93,6 +117,66 @@ async def global_exception_handler(request, exc):
     )
 
 
+# 启动时在后台执行的任务（保留引用，避免任务被垃圾回收）
+_background_tasks = set()
+
+
+def _run_in_background(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _warm_up_gemini() -> None:
+    """预热 Gemini 路线；严格模式下没有可用路线时抛出异常"""
+    from app.services.gemini_router import READY_STATE_ENV, gemini_router
+    if os.environ.get(READY_STATE_ENV):
+        # 多 worker 模式：启动脚本已在主进程中检查过，worker 直接使用检查结果
+        state = json.loads(os.environ[READY_STATE_ENV])
+        ready = await asyncio.to_thread(gemini_router.restore_ready_state, state)
+    else:
+        ready = await gemini_router.warm_up(timeout=settings.gemini_warmup_timeout_seconds)
+    if not ready:
+        message = "没有可用的 Gemini 路线，请检查 GEMINI_API_KEY / GEMINI_ROUTES 配置"
+        if settings.gemini_warmup_strict:
+            raise RuntimeError(message)
+        print(f"⚠️  {message}")
+
+
+async def _probe_ffmpeg() -> None:
+    """探测 FFmpeg 路径、版本和可用编码器，之后的视频处理直接使用探测结果"""
+    from app.utils.ffmpeg_helper import FFmpegHelper
+    capabilities = await asyncio.to_thread(FFmpegHelper.probe_capabilities)
+    if not capabilities["installed"]:
+        print("⚠️  未找到 FFmpeg，视频处理将不可用")
+        return
+    missing = [name for name, available in capabilities["encoders"].items() if not available]
+    print(f"🎬 FFmpeg {capabilities['version']}，H.264 编码器: {capabilities['h264_encoder']}"
+          + (f"，不可用的编码器: {', '.join(missing)}" if missing else ""))
+
+
+async def _cleanup_upload_sessions() -> None:
+    """定期清理过期的断点续传上传会话（多个 worker 同时清理也不会冲突）"""
+    from app.services.upload_sessions import upload_sessions
+    interval = min(3600, upload_sessions.ttl_seconds)
+    while True:
+        try:
+            removed = await asyncio.to_thread(upload_sessions.cleanup_expired)
+            if removed:
+                print(f"🧹 已清理 {removed} 个过期的上传会话")
+        except Exception as e:
+            print(f"⚠️  清理上传会话失败: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+async def _replay_write_spool() -> None:
+    from app.services.write_batcher import write_batcher
+    try:
+        await asyncio.to_thread(write_batcher.replay_spool)
+    except Exception as e:
+        print(f"⚠️  重放本地转存的数据库写入失败: {str(e)}")
+
+
 # 启动事件
 @app.on_event("startup")
 async def startup_event():
@@ -101,6 +185,25 @@ async def startup_event():
     os.makedirs(os.path.join(settings.upload_dir, "original"), exist_ok=True)
     os.makedirs(os.path.join(settings.upload_dir, "processed"), exist_ok=True)
     os.makedirs(os.path.join(settings.upload_dir, "thumbnails"), exist_ok=True)
+    os.makedirs(os.path.join(settings.upload_tmp_dir, "chunks"), exist_ok=True)
+    
+    # 预热 Gemini 客户端并验证 Key，配置错误在启动时暴露而不是等到第一个分析请求
+    # 严格模式下等待预热完成；否则在后台预热（导入 SDK、验证 Key），不推迟开始接收请求
+    if settings.gemini_warmup_enabled:
+        if settings.gemini_warmup_strict:
+            await _warm_up_gemini()
+        else:
+            _run_in_background(_warm_up_gemini())
+    
+    # 探测 FFmpeg 能力（子进程调用，在后台执行）
+    _run_in_background(_probe_ffmpeg())
+    
+    # 定期清理中断后未继续的上传会话
+    _run_in_background(_cleanup_upload_sessions())
+    
+    # 重放上次运行中写入失败、转存到本地的数据库记录
+    if settings.db_write_batching_enabled:
+        _run_in_background(_replay_write_spool())
     
     print("=" * 60)
     print("🏸 羽毛球杀球分析 API 启动成功！")
@@ -113,6 +216,16 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时的清理操作"""
+    for task in list(_background_tasks):
+        task.cancel()
+    
+    # 写入队列中尚未提交的记录
+    from app.services.write_batcher import write_batcher
+    await write_batcher.drain()
+    
+    from app.services.cache import cache
+    await cache.close()
+    
     from app.database import Database
     Database.close()
     print("\n👋 应用已关闭")
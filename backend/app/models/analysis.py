@@ -1,24 +1,25 @@
 """
 Pydantic 数据模型 - 分析结果
 """
+import re
 from datetime import datetime
-from typing import List, Optional
-from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field, field_validator
 
 
 class TechniqueScore(BaseModel):
     """技术评分"""
-    power: int = Field(..., ge=0, le=100)
-    angle: int = Field(..., ge=0, le=100)
-    coordination: int = Field(..., ge=0, le=100)
+    power: int = Field(..., ge=0, le=100, description="发力评分 0-100")
+    angle: int = Field(..., ge=0, le=100, description="击球角度评分 0-100")
+    coordination: int = Field(..., ge=0, le=100, description="协调性评分 0-100")
 
 
 class Suggestion(BaseModel):
     """改进建议"""
-    title: str
-    desc: str
-    icon: str
-    highlight: str
+    title: str = Field(..., description="建议标题，10字以内")
+    desc: str = Field(..., description="具体建议，60字以内")
+    icon: str = Field(..., description="Material 图标名")
+    highlight: str = Field(..., description="关键数据，如 +15km/h")
 
 
 class AnalysisBase(BaseModel):
@@ -32,11 +33,87 @@ class AnalysisBase(BaseModel):
     suggestions: List[Suggestion]
 
 
+def _clamp(value, low: float, high: Optional[float] = None, as_int: bool = True):
+    """
+    把模型输出的数值收敛到取值范围内（如评分 105 -> 100、85.6 -> 86）
+
+    模型偶尔会超出范围或输出小数，整个结果因此校验失败不值得；无法转换为数字的值原样返回，由字段类型校验报错
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    if number != number:  # NaN
+        return value
+    number = max(low, number)
+    if high is not None:
+        number = min(high, number)
+    return int(round(number)) if as_int else number
+
+
+# 文档字符串会作为 response_schema 中 technique 字段的描述
+class TechniqueModelOutput(BaseModel):
+    """技术评分"""
+    power: int = Field(..., description="发力评分 0-100")
+    angle: int = Field(..., description="击球角度评分 0-100")
+    coordination: int = Field(..., description="协调性评分 0-100")
+    
+    @field_validator("power", "angle", "coordination", mode="before")
+    @classmethod
+    def clamp_score(cls, value):
+        """超出 0-100 的值收敛到范围内"""
+        return _clamp(value, 0, 100)
+
+
+class AnalysisModelOutput(BaseModel):
+    """
+    模型输出结构
+    
+    同时用于生成 Gemini response_schema 和校验模型返回的 JSON；
+    数值字段不做严格的范围校验，而是收敛到 AnalysisBase 的取值范围内
+    """
+    speed: int = Field(..., description="杀球初速度 km/h")
+    rank: Optional[int] = Field(None, description="百分位排名 0-100")
+    rank_position: Optional[int] = Field(None, description="前 X%，只填数字 X")
+    level: str = Field(..., description="技术等级，如 业余中级")
+    technique: TechniqueModelOutput
+    score: float = Field(..., description="综合评分 0-10")
+    suggestions: List[Suggestion] = Field(..., json_schema_extra={"maxItems": 3})
+    
+    @field_validator("speed", mode="before")
+    @classmethod
+    def clamp_speed(cls, value):
+        """速度必须为正数"""
+        return _clamp(value, 1)
+    
+    @field_validator("score", mode="before")
+    @classmethod
+    def clamp_score(cls, value):
+        return _clamp(value, 0, 10, as_int=False)
+    
+    @field_validator("rank", mode="before")
+    @classmethod
+    def clamp_rank(cls, value):
+        return _clamp(value, 0, 100)
+    
+    @field_validator("rank_position", mode="before")
+    @classmethod
+    def parse_rank_position(cls, value):
+        """兼容旧版 Prompt 返回的字符串（如 "前25%" -> 25）"""
+        if isinstance(value, str):
+            match = re.search(r'\d+(\.\d+)?', value)
+            value = match.group() if match else None
+        return _clamp(value, 0, 100)
+
+
 class AnalysisCreate(AnalysisBase):
     """分析结果创建模型"""
     user_id: str
     video_id: str
     analysis_duration: Optional[float] = None
+    prompt_version: Optional[str] = None
 
 
 class AnalysisInDB(AnalysisCreate):
@@ -50,6 +127,7 @@ class AnalysisResult(AnalysisBase):
     id: str
     video_id: str
     analyzed_at: datetime
+    prompt_version: Optional[str] = None
     
     class Config:
         from_attributes = True
@@ -58,6 +136,14 @@ class AnalysisResult(AnalysisBase):
 class AnalysisStartRequest(BaseModel):
     """开始分析请求"""
     video_id: str
+    mode: Optional[Literal["video", "frames"]] = None  # 分析模式，默认取服务端配置
+    job_id: Optional[str] = None  # 客户端生成的任务ID，用于通过 /progress/{job_id} 订阅进度
+
+
+class AnalysisBatchRequest(BaseModel):
+    """批量分析请求"""
+    video_ids: List[str] = Field(..., min_length=1)
+    mode: Optional[Literal["video", "frames"]] = None
 
 
 class AnalysisWithVideo(BaseModel):
@@ -11,7 +11,7 @@ class PointsTransaction(BaseModel):
     """积分交易记录模型"""
     id: str
     user_id: str
-    transaction_type: str  # 'earn', 'spend', 'gift', 'purchase'
+    transaction_type: str  # 'earn', 'spend', 'gift', 'purchase', 'refund'
     points: int
     balance_before: int
     balance_after: int
@@ -2,7 +2,7 @@
 Pydantic 数据模型 - 视频
 """
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
 
 
@@ -36,6 +36,7 @@ class Video(BaseModel):
     duration: float
     file_size: int
     thumbnail_url: Optional[str] = None
+    thumbnails: Optional[Dict[str, str]] = None  # 各尺寸缩略图、WebP 和动态预览的 URL
     uploaded_at: datetime
     
     class Config:
@@ -50,11 +51,46 @@ class VideoUploadResponse(BaseModel):
     duration: float
     file_size: int
     thumbnail_path: Optional[str] = None
+    thumbnails: Optional[Dict[str, str]] = None  # 各尺寸缩略图、WebP 和动态预览的 URL
     uploaded_at: datetime
 
 
-class CloudVideoUploadRequest(BaseModel):
-    """微信云存储视频同步请求"""
+class CloudVideoSyncItem(BaseModel):
+    """同步一个微信云存储视频的参数"""
     file_id: str
     trim_start: Optional[float] = None
     trim_end: Optional[float] = None
+    auto_trim: Optional[bool] = None  # 未指定裁剪范围时自动截取杀球片段，默认取服务端配置
+
+
+class CloudVideoUploadRequest(CloudVideoSyncItem):
+    """微信云存储视频同步请求"""
+    job_id: Optional[str] = None  # 客户端生成的任务ID，用于通过 /progress/{job_id} 订阅进度
+
+
+class CloudVideoBatchRequest(BaseModel):
+    """微信云存储视频批量同步请求"""
+    files: List[CloudVideoSyncItem] = Field(..., min_length=1)
+
+
+class UploadSessionCreate(BaseModel):
+    """断点续传上传会话创建请求"""
+    filename: str
+    size: int = Field(..., gt=0)  # 文件总字节数
+    sha256: Optional[str] = Field(None, pattern=r"^[0-9a-fA-F]{64}$")  # 可选，接收完成后校验整个文件
+    trim_start: Optional[float] = None
+    trim_end: Optional[float] = None
+    auto_trim: Optional[bool] = None  # 未指定裁剪范围时自动截取杀球片段，默认取服务端配置
+    job_id: Optional[str] = None  # 客户端生成的任务ID，最后一个分片到达后通过 /progress/{job_id} 推送处理进度
+
+
+class UploadSessionStatus(BaseModel):
+    """断点续传上传会话状态"""
+    upload_id: str
+    offset: int  # 已接收的字节数，下一个分片从这里开始
+    size: int
+    chunk_size: int  # 建议（也是允许的最大）分片大小
+    state: str  # uploading / processing / completed
+    expires_at: float  # 会话过期时间（Unix 时间戳），每接收一个分片顺延
+    job_id: Optional[str] = None
+    video: Optional[VideoUploadResponse] = None  # 处理完成后的视频信息
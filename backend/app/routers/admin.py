@@ -3,10 +3,13 @@
 """
 from typing import Optional, List
 from fastapi import APIRouter, Depends, Query, HTTPException, status
-from supabase import Client
-from app.database import get_db
+from app.config import settings
+from app.database import Client, get_db
+from app.dependencies import get_cache
 from app.models.points import PointsAdjustRequest, PurchaseRecord
+from app.services.cache import Cache
 from app.services.points_service import PointsService
+from app.utils.ffmpeg_helper import FFmpegHelper
 
 
 router = APIRouter(prefix="/admin", tags=["管理员"])
@@ -370,7 +373,8 @@ async def get_analyses(
                 "video_id": record["video_id"],
                 "video_info": {
                     "original_filename": video_info.get("original_filename") if video_info else None,
-                    "thumbnail_url": thumbnail_url
+                    "thumbnail_url": thumbnail_url,
+                    "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(thumbnail_path)
                 },
                 "speed": record["speed"],
                 "level": record["level"],
@@ -466,6 +470,7 @@ async def get_analysis_detail(
                 "duration": video.get("duration"),
                 "file_size": video.get("file_size"),
                 "thumbnail_url": thumbnail_url,
+                "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(thumbnail_path),
                 "uploaded_at": video.get("uploaded_at")
             } if video else None,
             "user": {
@@ -549,7 +554,8 @@ async def get_user_analyses(
                 "video_id": record["video_id"],
                 "video_info": {
                     "original_filename": video_info.get("original_filename") if video_info else None,
-                    "thumbnail_url": thumbnail_url
+                    "thumbnail_url": thumbnail_url,
+                    "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(thumbnail_path)
                 },
                 "speed": record["speed"],
                 "level": record["level"],
@@ -584,11 +590,20 @@ async def get_user_analyses(
 
 @router.get("/statistics", summary="获取统计数据")
 async def get_statistics(
+    cache: Cache = Depends(get_cache),
     db: Client = Depends(get_db)
 ):
     """
     获取系统统计数据（管理员）
+    
+    统计需要扫描用户和购买记录，结果缓存 STATISTICS_CACHE_TTL_SECONDS 秒
     """
+    statistics_cache = cache.namespace("statistics", ttl_seconds=settings.statistics_cache_ttl_seconds)
+    return await statistics_cache.get_or_load("summary", lambda: _load_statistics(db))
+
+
+async def _load_statistics(db: Client) -> dict:
+    """查询数据库，汇总系统统计数据"""
     try:
         # 用户统计
         users_count = db.table("users").select("id", count="exact").execute()
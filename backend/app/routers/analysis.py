@@ -1,12 +1,16 @@
 """
 分析相关 API 路由
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from supabase import Client
-from app.database import get_db
-from app.models.analysis import AnalysisStartRequest, AnalysisResult
-from app.services.analysis_service import AnalysisService
-from app.dependencies import get_current_user
+import json
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from app.database import Client, get_db
+from app.models.analysis import AnalysisBatchRequest, AnalysisStartRequest, AnalysisResult
+from app.services.analysis_service import AnalysisService, get_analysis_priority
+from app.services.idempotency_store import idempotency_store
+from app.services.progress_broker import progress_broker
+from app.dependencies import get_current_user, get_idempotency_key
 
 
 router = APIRouter(prefix="/analysis", tags=["AI分析"])
@@ -15,13 +19,18 @@ router = APIRouter(prefix="/analysis", tags=["AI分析"])
 @router.post("/start", response_model=AnalysisResult, summary="开始分析视频")
 async def start_analysis(
     request: AnalysisStartRequest,
+    response: Response,
     current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Depends(get_idempotency_key),
     db: Client = Depends(get_db)
 ):
     """
     开始分析视频
     
     - **video_id**: 要分析的视频ID
+    - **mode**: 可选，分析模式。video 上传完整视频；frames 只发送击球前后的关键帧，速度更快
+    - **job_id**: 可选，客户端生成的任务ID，可通过 /progress/{job_id} 订阅分析进度
+    - **Idempotency-Key** 请求头: 可选，重试时使用同一个 Key，不会重复分析和扣除积分
     
     调用 Gemini API 分析视频，返回杀球速度、技术评分和改进建议
     
@@ -30,7 +39,21 @@ async def start_analysis(
     try:
         print(f"收到分析请求: video_id={request.video_id}, user_id={current_user['id']}")
         analysis_service = AnalysisService(db)
-        result = await analysis_service.analyze_video(request.video_id, current_user["id"])
+        with progress_broker.track(current_user["id"], request.job_id):
+            result, replayed = await idempotency_store.run(
+                "analysis.start",
+                current_user["id"],
+                idempotency_key,
+                {"video_id": request.video_id, "mode": request.mode},
+                lambda: analysis_service.analyze_video(
+                    request.video_id,
+                    current_user["id"],
+                    mode=request.mode,
+                    priority=get_analysis_priority(current_user)
+                )
+            )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
         print(f"分析成功完成: {result.get('id', 'N/A')}")
         return result
     except HTTPException:
@@ -46,6 +69,47 @@ async def start_analysis(
         )
 
 
+@router.post("/batch", summary="批量分析视频")
+async def start_batch_analysis(
+    request: AnalysisBatchRequest,
+    current_user: dict = Depends(get_current_user),
+    db: Client = Depends(get_db)
+):
+    """
+    批量分析视频（适合教练一次提交多个片段）
+    
+    - **video_ids**: 要分析的视频ID列表（重复的ID只分析一次）
+    - **mode**: 可选，分析模式，同 /analysis/start
+    
+    多个视频并发分析，以 NDJSON（每行一个 JSON）按完成顺序流式返回：
+    
+    - `{"type": "result", "index": 0, "video_id": "...", "status": "success", "analysis": {...}}`
+    - `{"type": "result", "index": 1, "video_id": "...", "status": "failed", "status_code": 404, "error": "..."}`
+    - 最后一行 `{"type": "summary", "total": 2, "succeeded": 1, "failed": 1, "points_cost": 10, "duration": 12.3}`
+    
+    开始前按整批费用预扣积分（余额不足时返回 400），结束后退回失败视频的积分
+    """
+    analysis_service = AnalysisService(db)
+    video_ids, reserved_points = await analysis_service.prepare_batch(request.video_ids, current_user["id"])
+    print(f"收到批量分析请求: {len(video_ids)} 个视频, user_id={current_user['id']}")
+    
+    async def _stream():
+        async for item in analysis_service.analyze_batch(
+            video_ids,
+            current_user["id"],
+            mode=request.mode,
+            priority=get_analysis_priority(current_user),
+            reserved_points=reserved_points
+        ):
+            yield json.dumps(item, ensure_ascii=False, default=str) + "\n"
+    
+    return StreamingResponse(
+        _stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/{analysis_id}", response_model=AnalysisResult, summary="获取分析结果")
 async def get_analysis(
     analysis_id: str,
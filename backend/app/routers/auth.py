@@ -2,8 +2,7 @@
 认证相关 API 路由
 """
 from fastapi import APIRouter, Depends, HTTPException, status
-from supabase import Client
-from app.database import get_db
+from app.database import Client, get_db
 from app.models.user import UserCreate, UserLogin
 from app.schemas.auth import RegisterResponse, LoginResponse, UserProfileResponse, WeChatLoginRequest
 from app.services.auth_service import AuthService
@@ -1,12 +1,14 @@
 """
 历史记录相关 API 路由
 """
-from typing import Optional, List
-from fastapi import APIRouter, Depends, Query
-from supabase import Client
+from typing import Dict, Optional, List
+from fastapi import APIRouter, Depends, Header, Query, Response
 from pydantic import BaseModel
-from app.database import get_db
-from app.dependencies import get_current_user
+from app.database import Client, get_db
+from app.dependencies import get_cache, get_current_user
+from app.services.cache import Cache
+from app.services.history_cache import etag_matches, get_history_response
+from app.utils.ffmpeg_helper import FFmpegHelper
 
 
 router = APIRouter(prefix="/history", tags=["历史记录"])
@@ -20,6 +22,7 @@ class HistoryItem(BaseModel):
     score: float
     level: str
     thumbnail_url: Optional[str]
+    thumbnails: Optional[Dict[str, str]] = None  # 各尺寸缩略图、WebP 和动态预览的 URL
     analyzed_at: str
 
 
@@ -31,13 +34,29 @@ class HistoryResponse(BaseModel):
     items: List[HistoryItem]
 
 
+def _cached_response(response: Response, payload: dict, etag: str, if_none_match: Optional[str]):
+    """设置缓存相关响应头；客户端缓存仍然有效时返回 304"""
+    headers = {
+        "ETag": etag,
+        # 客户端每次使用前重新验证，新的分析结果能立即显示
+        "Cache-Control": "private, no-cache"
+    }
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return payload
+
+
 @router.get("", response_model=HistoryResponse, summary="获取历史记录列表")
 async def get_history(
+    response: Response,
     page: int = Query(1, ge=1, description="页码"),
     page_size: int = Query(10, ge=1, le=50, description="每页数量"),
     sort_by: str = Query("analyzed_at", description="排序字段"),
     order: str = Query("desc", regex="^(asc|desc)$", description="排序方向"),
+    if_none_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user),
+    cache: Cache = Depends(get_cache),
     db: Client = Depends(get_db)
 ):
     """
@@ -48,10 +67,28 @@ async def get_history(
     - **sort_by**: 排序字段（analyzed_at, speed, score）
     - **order**: 排序方向（asc 升序, desc 降序）
     
-    返回分页的历史记录列表
+    返回分页的历史记录列表；响应带 ETag，If-None-Match 匹配时返回 304
     """
     user_id = current_user["id"]
     
+    payload, etag = await get_history_response(
+        cache,
+        user_id,
+        f"list:{page}:{page_size}:{sort_by}:{order}",
+        lambda: _load_history(db, user_id, page, page_size, sort_by, order)
+    )
+    return _cached_response(response, payload, etag, if_none_match)
+
+
+async def _load_history(
+    db: Client,
+    user_id: str,
+    page: int,
+    page_size: int,
+    sort_by: str,
+    order: str
+) -> dict:
+    """查询数据库，返回历史记录列表页"""
     # 计算偏移量
     offset = (page - 1) * page_size
     
@@ -71,13 +108,14 @@ async def get_history(
     # 分页
     query = query.range(offset, offset + page_size - 1)
     
-    response = query.execute()
+    data_response = query.execute()
     
     # 格式化结果
     items = []
-    for record in response.data:
+    for record in data_response.data:
         video_info = record.get("videos", {}) if isinstance(record.get("videos"), dict) else {}
         thumbnail_path = video_info.get("thumbnail_path") if video_info else None
+        thumbnails = FFmpegHelper.get_thumbnail_variant_urls(thumbnail_path)
         
         # 转换缩略图路径为 URL
         thumbnail_url = None
@@ -108,6 +146,7 @@ async def get_history(
             "score": record["score"],
             "level": record["level"],
             "thumbnail_url": thumbnail_url,
+            "thumbnails": thumbnails,
             "analyzed_at": record["analyzed_at"]
         })
     
@@ -122,7 +161,10 @@ async def get_history(
 @router.get("/{analysis_id}/detail", summary="获取历史记录详情")
 async def get_history_detail(
     analysis_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user),
+    cache: Cache = Depends(get_cache),
     db: Client = Depends(get_db)
 ):
     """
@@ -130,10 +172,21 @@ async def get_history_detail(
     
     - **analysis_id**: 分析记录ID
     
-    返回完整的分析结果和视频信息
+    返回完整的分析结果和视频信息；响应带 ETag，If-None-Match 匹配时返回 304
     """
     user_id = current_user["id"]
     
+    payload, etag = await get_history_response(
+        cache,
+        user_id,
+        f"detail:{analysis_id}",
+        lambda: _load_history_detail(db, user_id, analysis_id)
+    )
+    return _cached_response(response, payload, etag, if_none_match)
+
+
+async def _load_history_detail(db: Client, user_id: str, analysis_id: str) -> dict:
+    """查询数据库，返回单条历史记录详情"""
     # 查询分析记录和视频信息
     analysis_response = db.table("analyses").select(
         "*, videos(*)"
@@ -172,6 +225,7 @@ async def get_history_detail(
             "duration": video.get("duration"),
             "file_size": video.get("file_size"),
             "thumbnail_url": video.get("thumbnail_path"),
+            "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(video.get("thumbnail_path")),
             "uploaded_at": video.get("uploaded_at")
         } if video else None
     }
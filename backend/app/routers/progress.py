@@ -0,0 +1,64 @@
+"""
+任务进度推送 API 路由
+"""
+import json
+import time
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from app.config import settings
+from app.services.progress_broker import progress_broker
+from app.dependencies import get_current_user_for_stream
+
+
+router = APIRouter(prefix="/progress", tags=["任务进度"])
+
+
+@router.get("/{job_id}", summary="订阅任务进度（SSE）")
+async def stream_progress(
+    job_id: str,
+    current_user: dict = Depends(get_current_user_for_stream)
+):
+    """
+    以 Server-Sent Events 推送任务进度
+    
+    - **job_id**: 客户端生成的任务ID，需同时传给 /video/upload、/video/cloud-upload 或 /analysis/start
+    - **access_token**: 可选，EventSource 无法设置请求头时通过查询参数传递 Token
+    
+    只能订阅当前用户发起的任务。可在发起任务之前或之后订阅，订阅时会先回放已发生的事件；
+    订阅后 progress_subscribe_wait_seconds 秒内任务仍未开始（或任务已过期）时返回 404。事件名为阶段名：
+    
+    - `received`: 服务端已收到请求
+    - `transcoding`: 视频裁剪压缩或抽取关键帧
+    - `uploaded`: 视频已上传到模型
+    - `model_active`: 模型侧文件处理完成
+    - `generating`: 模型生成中
+    - `partial`: 流式生成的部分结果，data 中 field 为字段名、value 为字段值；
+      suggestions 逐条推送，额外带 index
+    - `saved`: 结果已保存（data 中包含 video_id 或 analysis_id），流随即结束
+    - `failed`: 任务失败（data 中包含 error），流随即结束
+    """
+    # 任务键包含用户ID：其他用户的任务对当前用户不存在
+    key = progress_broker.job_key(current_user["id"], job_id)
+    if not await progress_broker.wait_for_job(key, settings.progress_subscribe_wait_seconds):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="任务不存在或已过期"
+        )
+    
+    async def _stream():
+        deadline = time.time() + settings.progress_stream_timeout_seconds
+        async for event in progress_broker.subscribe(key, settings.progress_heartbeat_seconds):
+            if event is None:
+                # 心跳，防止代理断开空闲连接
+                yield ": ping\n\n"
+            else:
+                data = json.dumps(event, ensure_ascii=False, default=str)
+                yield f"event: {event['stage']}\ndata: {data}\n\n"
+            if time.time() > deadline:
+                break
+    
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,64 +1,269 @@
 """
 视频相关 API 路由
 """
+import asyncio
+import json
+import os
 from typing import Optional
-from fastapi import APIRouter, Depends, File, UploadFile, Form, HTTPException, status
-from supabase import Client
-from app.database import get_db
-from app.models.video import VideoUploadResponse, Video, CloudVideoUploadRequest
+from fastapi import APIRouter, Depends, File, UploadFile, Form, Header, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from app.database import Client, get_db
+from app.models.video import (
+    VideoUploadResponse,
+    Video,
+    CloudVideoUploadRequest,
+    CloudVideoBatchRequest,
+    UploadSessionCreate,
+    UploadSessionStatus
+)
 from app.services.video_service import VideoService
-from app.dependencies import get_current_user
+from app.services.idempotency_store import idempotency_store
+from app.services.progress_broker import progress_broker
+from app.services.upload_sessions import upload_sessions
+from app.dependencies import get_current_user, get_idempotency_key
+from app.utils.ffmpeg_helper import FFmpegHelper
+from app.utils.validators import validate_video_filename, validate_video_size
 
 
 router = APIRouter(prefix="/video", tags=["视频"])
 
 
 @router.post("/upload", response_model=VideoUploadResponse, summary="上传视频")
-# ... (原有逻辑) ...
+async def upload_video(
+    response: Response,
+    file: UploadFile = File(..., description="视频文件"),
+    trim_start: Optional[float] = Form(None, description="裁剪起始时间(秒)"),
+    trim_end: Optional[float] = Form(None, description="裁剪结束时间(秒)"),
+    auto_trim: Optional[bool] = Form(None, description="未指定裁剪范围时自动截取杀球片段"),
+    job_id: Optional[str] = Form(None, description="任务ID，用于订阅处理进度"),
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Depends(get_idempotency_key),
+    db: Client = Depends(get_db)
+):
+    """
+    上传视频文件
+    
+    - **file**: 视频文件 (MP4/MOV/AVI/MKV/WEBM，最大50MB)
+    - **trim_start**: 可选，裁剪起始时间(秒)
+    - **trim_end**: 可选，裁剪结束时间(秒)
+    - **auto_trim**: 可选，未指定裁剪范围时按运动强度自动截取杀球片段
+    - **job_id**: 可选，客户端生成的任务ID，可通过 /progress/{job_id} 订阅处理进度
+    - **Idempotency-Key** 请求头: 可选，重试时使用同一个 Key，不会重复处理视频
+    
+    返回视频信息，包括处理后的文件路径和缩略图
+    """
+    video_service = VideoService(db)
+    # UploadFile 只在请求内有效：先在请求中保存，幂等请求的独立任务只处理已保存的文件
+    original_path, unique_id = await video_service.save_upload(file)
+    processing = False
+    
+    async def _process() -> dict:
+        nonlocal processing
+        processing = True
+        return await video_service.process_stored_video(
+            original_path=original_path,
+            original_filename=file.filename,
+            unique_id=unique_id,
+            user_id=current_user["id"],
+            trim_start=trim_start,
+            trim_end=trim_end,
+            auto_trim=auto_trim
+        )
+    
+    try:
+        with progress_broker.track(current_user["id"], job_id):
+            result, replayed = await idempotency_store.run(
+                "video.upload",
+                current_user["id"],
+                idempotency_key,
+                {
+                    "filename": file.filename,
+                    "size": file.size,
+                    "trim_start": trim_start,
+                    "trim_end": trim_end,
+                    "auto_trim": auto_trim
+                },
+                _process
+            )
+    finally:
+        # 重放（或 Key 参数不匹配）时本次保存的文件没有用到
+        if not processing and os.path.exists(original_path):
+            os.remove(original_path)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+@router.post("/uploads", response_model=UploadSessionStatus, summary="创建断点续传上传会话")
+async def create_upload_session(
+    request: UploadSessionCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    创建断点续传上传会话，之后按顺序上传分片（PUT /video/uploads/{upload_id}）
+    
+    - **filename**: 原始文件名 (MP4/MOV/AVI/MKV/WEBM)
+    - **size**: 文件总字节数 (最大50MB)
+    - **sha256**: 可选，整个文件的 SHA-256，接收完成后校验
+    - **trim_start / trim_end / auto_trim**: 与 /video/upload 相同，最后一个分片到达后使用
+    - **job_id**: 可选，最后一个分片到达后可通过 /progress/{job_id} 订阅处理进度
+    
+    返回 upload_id 和建议的分片大小 chunk_size
+    """
+    validate_video_filename(request.filename)
+    validate_video_size(request.size)
+    return await asyncio.to_thread(
+        upload_sessions.create,
+        current_user["id"],
+        request.filename,
+        request.size,
+        request.sha256,
+        request.model_dump(include={"trim_start", "trim_end", "auto_trim", "job_id"})
+    )
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionStatus, summary="查询上传会话状态")
+async def get_upload_session(
+    upload_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    查询上传会话状态，网络中断后从返回的 offset 继续上传
+    """
+    return await asyncio.to_thread(upload_sessions.get_status, upload_id, current_user["id"])
+
+
+async def _read_chunk(request: Request, limit: int) -> bytes:
+    """读取分片请求体，超过 limit 字节时返回 413"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"分片过大。最大允许 {limit} 字节"
+        )
+    
+    data = bytearray()
+    async for part in request.stream():
+        data.extend(part)
+        if len(data) > limit:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"分片过大。最大允许 {limit} 字节"
+            )
+    return bytes(data)
+
+
+@router.put("/uploads/{upload_id}", response_model=UploadSessionStatus, summary="上传分片")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    response: Response,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0, description="分片在文件中的起始位置"),
+    upload_checksum: Optional[str] = Header(None, alias="Upload-Checksum", description="分片摘要，如 sha256 <Base64>"),
+    current_user: dict = Depends(get_current_user),
+    db: Client = Depends(get_db)
+):
+    """
+    上传一个分片（请求体为分片的原始字节）
+    
+    - **Upload-Offset** 请求头: 分片起始位置，必须等于已接收的字节数，否则返回 409 和当前的 Upload-Offset
+    - **Upload-Checksum** 请求头: 可选，分片摘要（sha256/sha1/md5 + Base64），校验失败返回 400，重传该分片即可
+    
+    最后一个分片到达后立即处理视频，返回的 video 为视频信息；重试最后一个分片会直接返回已处理的结果，
+    处理被中断（state 恢复为 uploading、offset 等于文件大小）时重试最后一个分片会重新处理
+    """
+    data = await _read_chunk(request, upload_sessions.chunk_size)
+    await asyncio.to_thread(upload_sessions.verify_checksum, data, upload_checksum)
+    session, finished = await asyncio.to_thread(
+        upload_sessions.write_chunk, upload_id, current_user["id"], upload_offset, data
+    )
+    
+    if finished:
+        video_service = VideoService(db)
+        with progress_broker.track(current_user["id"], session["job_id"]):
+            session = await video_service.finish_chunked_upload(upload_id, current_user["id"])
+    
+    response.headers["Upload-Offset"] = str(session["offset"])
+    return session
+
+
+@router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT, summary="取消上传")
+async def cancel_upload_session(
+    upload_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    取消上传会话，删除已接收的分片
+    """
+    await asyncio.to_thread(upload_sessions.delete, upload_id, current_user["id"])
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 
 @router.post("/cloud-upload", response_model=VideoUploadResponse, summary="同步云存储视频")
 async def cloud_upload_video(
     request: CloudVideoUploadRequest,
+    response: Response,
     current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Depends(get_idempotency_key),
     db: Client = Depends(get_db)
 ):
     """
     同步小程序已上传到云存储的视频
     
     - **file_id**: 微信云存储 fileID
+    - **job_id**: 可选，客户端生成的任务ID，可通过 /progress/{job_id} 订阅处理进度
+    - **Idempotency-Key** 请求头: 可选，重试时使用同一个 Key，不会重复下载和处理视频
     """
     video_service = VideoService(db)
-    result = await video_service.sync_cloud_video(
-        file_id=request.file_id,
-        user_id=current_user["id"],
-        trim_start=request.trim_start,
-        trim_end=request.trim_end
-    )
+    with progress_broker.track(current_user["id"], request.job_id):
+        result, replayed = await idempotency_store.run(
+            "video.cloud_upload",
+            current_user["id"],
+            idempotency_key,
+            request.model_dump(exclude={"job_id"}),
+            lambda: video_service.sync_cloud_video(
+                file_id=request.file_id,
+                user_id=current_user["id"],
+                trim_start=request.trim_start,
+                trim_end=request.trim_end,
+                auto_trim=request.auto_trim
+            )
+        )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
     return result
-async def upload_video(
-    file: UploadFile = File(..., description="视频文件"),
-    trim_start: Optional[float] = Form(None, description="裁剪起始时间(秒)"),
-    trim_end: Optional[float] = Form(None, description="裁剪结束时间(秒)"),
+
+
+@router.post("/cloud-upload/batch", summary="批量同步云存储视频")
+async def cloud_upload_video_batch(
+    request: CloudVideoBatchRequest,
     current_user: dict = Depends(get_current_user),
     db: Client = Depends(get_db)
 ):
     """
-    上传视频文件
+    批量同步小程序已上传到云存储的视频（一次调用换取全部下载链接，多个文件并发下载和处理）
     
-    - **file**: 视频文件 (MP4/MOV/AVI/MKV/WEBM，最大50MB)
-    - **trim_start**: 可选，裁剪起始时间(秒)
-    - **trim_end**: 可选，裁剪结束时间(秒)
+    - **files**: 要同步的视频列表，每项包含 file_id 和可选的 trim_start / trim_end / auto_trim（重复的 file_id 只同步一次）
     
-    返回视频信息，包括处理后的文件路径和缩略图
+    以 NDJSON（每行一个 JSON）按完成顺序流式返回：
+    
+    - `{"type": "result", "index": 0, "file_id": "...", "status": "success", "video": {...}}`
+    - `{"type": "result", "index": 1, "file_id": "...", "status": "failed", "status_code": 502, "error": "..."}`
+    - 最后一行 `{"type": "summary", "total": 2, "succeeded": 1, "failed": 1, "duration": 12.3}`
     """
     video_service = VideoService(db)
-    result = await video_service.upload_video(
-        file=file,
-        user_id=current_user["id"],
-        trim_start=trim_start,
-        trim_end=trim_end
+    files = video_service.prepare_cloud_batch([item.model_dump() for item in request.files])
+    print(f"收到批量同步请求: {len(files)} 个视频, user_id={current_user['id']}")
+    
+    async def _stream():
+        async for item in video_service.sync_cloud_videos_batch(files, current_user["id"]):
+            yield json.dumps(item, ensure_ascii=False, default=str) + "\n"
+    
+    return StreamingResponse(
+        _stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    return result
 
 
 @router.get("/{video_id}", response_model=Video, summary="获取视频信息")
@@ -83,5 +288,6 @@ async def get_video(
         "duration": video["duration"],
         "file_size": video["file_size"],
         "thumbnail_url": video.get("thumbnail_path"),
+        "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(video.get("thumbnail_path")),
         "uploaded_at": video["uploaded_at"]
     }
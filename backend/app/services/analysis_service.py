@@ -2,15 +2,78 @@
 AI 分析服务
 调用 Gemini API 分析视频
 """
+import os
+import asyncio
 import base64
+import shutil
+import tempfile
 import time
-import json
-import re
-from typing import Optional
+from typing import AsyncIterator, List, Optional, Tuple
 from fastapi import HTTPException, status
-from supabase import Client
-import google.generativeai as genai
+from pydantic import ValidationError
+from app.database import Client
+from google.api_core import exceptions as google_exceptions
 from app.config import settings
+from app.services.gemini_file_cache import gemini_file_cache
+from app.services.gemini_router import GeminiRoute, gemini_router
+from app.services.cache import cache
+from app.services.history_cache import invalidate_history
+from app.services.prompt_registry import AnalysisPrompt, get_analysis_prompt
+from app.services.progress_broker import (
+    STAGE_GENERATING,
+    STAGE_MODEL_ACTIVE,
+    STAGE_PARTIAL,
+    STAGE_SAVED,
+    STAGE_TRANSCODING,
+    STAGE_UPLOADED,
+    is_tracking,
+    join_progress,
+    progress_jobs,
+    report_progress
+)
+from app.utils.ffmpeg_helper import FFmpegHelper, transcode_slots
+from app.utils.rate_limiter import (
+    PRIORITY_NORMAL,
+    PRIORITY_PREMIUM,
+    QuotaExceededError
+)
+from app.utils.partial_json import IncrementalJsonParser
+from app.utils.singleflight import SingleFlight
+from app.utils.resilience import (
+    CircuitOpenError,
+    StageTimeoutError,
+    call_with_retry,
+    is_retryable_error
+)
+
+
+# 单次分析的 Token 估算参数（Gemini 视频按每秒 1 帧、每帧约 258 Token 计费）
+PROMPT_TOKENS_ESTIMATE = 1000
+OUTPUT_TOKENS_ESTIMATE = 800
+TOKENS_PER_FRAME = 258
+
+# 每次分析消耗的积分
+ANALYSIS_POINTS_COST = 10
+
+# 积分字段检查通过后缓存结果，避免每次分析都查询一次
+_points_enabled_checked = False
+
+# 同一用户对同一视频的并发分析只执行一次（例如重复点击“分析”）
+analysis_singleflight = SingleFlight("analysis")
+
+# 批量分析的退款和断开后的结算任务（保留引用，避免任务被垃圾回收）
+_pending_refunds = set()
+
+
+def get_analysis_priority(user: dict) -> int:
+    """
+    获取用户的分析排队优先级
+    
+    累计获得积分超过注册赠送额度（即购买过积分或被赠送过积分）的用户视为付费用户，优先放行
+    """
+    if user.get("total_points_earned", 0) > settings.premium_points_threshold:
+        return PRIORITY_PREMIUM
+    return PRIORITY_NORMAL
 
 
 class AnalysisService:
@@ -18,22 +81,413 @@ class AnalysisService:
     
     def __init__(self, db: Client):
         self.db = db
-        # 配置 Gemini API
-        genai.configure(api_key=settings.gemini_api_key)
+
+    async def _get_analysis_file(self, video_path: str) -> str:
+        """
+        获取上传给模型的视频文件
+
+        优先使用降分辨率、去音轨的分析版本，不存在时现场生成（在线程中转码，占用转码名额），
+        生成失败则回退到处理后的原视频
+        """
+        if not settings.analysis_profile_enabled:
+            return video_path
+
+        rendition_path = FFmpegHelper.get_analysis_rendition_path(video_path)
+        if os.path.exists(rendition_path):
+            return rendition_path
+
+        try:
+            async with transcode_slots():
+                # 等待名额期间其他请求可能已生成
+                if os.path.exists(rendition_path):
+                    return rendition_path
+                return await asyncio.to_thread(
+                    FFmpegHelper.create_analysis_rendition, video_path, rendition_path
+                )
+        except Exception as e:
+            print(f"Warning: 生成分析视频失败，使用原视频: {str(e)}")
+            return video_path
+
+    async def _upload_to_gemini(self, route: GeminiRoute, upload_path: str):
+        """
+        使用指定路线上传视频文件到 Gemini 并等待处理完成
+        
+        Args:
+            route: Gemini 调用路线
+            upload_path: 待上传的视频路径
+        
+        Returns:
+            状态为 ACTIVE 的 Gemini 文件对象
+        """
+        print(f"开始上传视频文件到 Gemini（{route.name}）: {upload_path}")
+        video_file = await call_with_retry(
+            route.upload_file,
+            upload_path,
+            stage="Gemini 上传",
+            timeout=settings.gemini_upload_timeout_seconds,
+            # 超时后原上传仍在线程中继续，重试会重复上传同一个文件
+            retry_on_timeout=False,
+            **self._retry_options(route)
+        )
+        print(f"视频文件上传成功: {video_file.uri}, 状态: {video_file.state}")
+        report_progress(STAGE_UPLOADED)
+        
+        # 等待文件处理完成（状态变为 ACTIVE）
+        max_wait_time = settings.gemini_processing_timeout_seconds
+        wait_interval = 2   # 每2秒检查一次
+        waited_time = 0
+        
+        while video_file.state.name != "ACTIVE" and waited_time < max_wait_time:
+            print(f"等待文件处理完成，当前状态: {video_file.state.name}, 已等待: {waited_time}秒")
+            await asyncio.sleep(wait_interval)
+            waited_time += wait_interval
+            # 重新获取文件状态
+            video_file = await call_with_retry(
+                route.get_file,
+                video_file.name,
+                stage="Gemini 文件状态查询",
+                timeout=settings.gemini_poll_timeout_seconds,
+                **self._retry_options(route)
+            )
+        
+        if video_file.state.name != "ACTIVE":
+            raise StageTimeoutError("Gemini 文件处理", max_wait_time)
+        
+        print(f"文件已就绪，状态: {video_file.state.name}")
+        report_progress(STAGE_MODEL_ACTIVE)
+        return video_file
+
+    @staticmethod
+    def _retry_options(route: GeminiRoute) -> dict:
+        """Gemini 调用的重试和熔断参数"""
+        return {
+            "max_retries": settings.gemini_max_retries,
+            "base_delay": settings.gemini_retry_base_delay,
+            "max_delay": settings.gemini_retry_max_delay,
+            "breaker": route.breaker
+        }
+
+    @staticmethod
+    def _should_failover(exc: Exception) -> bool:
+        """配额不足、熔断或服务临时不可用时切换到下一条路线"""
+        return isinstance(exc, (
+            QuotaExceededError,
+            CircuitOpenError,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServiceUnavailable
+        ))
+
+    @staticmethod
+    def _gemini_error_message(exc: Exception) -> str:
+        """将 Gemini 调用异常转换为用户可读的错误信息"""
+        error_msg = str(exc)
+        if "API key" in error_msg or "authentication" in error_msg.lower():
+            error_msg = "Gemini API 密钥配置错误，请检查 .env 文件中的 GEMINI_API_KEY"
+        elif "quota" in error_msg.lower() or "limit" in error_msg.lower():
+            error_msg = "Gemini API 配额已用完，请检查 API 使用限制"
+        elif "model" in error_msg.lower() and "not found" in error_msg.lower():
+            error_msg = "Gemini 模型不可用，请检查模型名称是否正确"
+        elif "file" in error_msg.lower() and "not found" in error_msg.lower():
+            error_msg = "视频文件不存在或无法访问"
+        elif "not in an ACTIVE state" in error_msg:
+            error_msg = "视频文件处理未完成，请稍后重试"
+        return error_msg
+
+    @staticmethod
+    def _gemini_http_exception(exc: Exception, detail: str) -> HTTPException:
+        """
+        将 Gemini 调用异常转换为 HTTP 异常
+        
+        熔断 -> 503，超时 -> 504，排队已满/限流 -> 429，其他临时故障 -> 503，其余 -> 500
+        """
+        headers = None
+        if isinstance(exc, QuotaExceededError):
+            status_code = status.HTTP_429_TOO_MANY_REQUESTS
+            headers = {"Retry-After": str(int(exc.retry_after) + 1)}
+        elif isinstance(exc, CircuitOpenError):
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            headers = {"Retry-After": str(int(exc.retry_after) + 1)}
+        elif isinstance(exc, asyncio.TimeoutError):
+            status_code = status.HTTP_504_GATEWAY_TIMEOUT
+        elif isinstance(exc, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+            status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        elif is_retryable_error(exc):
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        else:
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+    async def _get_or_upload_file(
+        self,
+        route: GeminiRoute,
+        upload_path: str
+    ) -> Tuple[object, Optional[str]]:
+        """
+        获取视频在指定路线下对应的 Gemini 文件，内容相同的视频复用已上传的文件
+        
+        文件属于上传时使用的 API Key，缓存键包含 Key 的短哈希
+        
+        Returns:
+            (Gemini 文件对象, 缓存键)，未启用缓存时缓存键为 None
+        """
+        if not settings.gemini_file_cache_enabled:
+            return await self._upload_to_gemini(route, upload_path), None
+        
+        content_hash = await asyncio.to_thread(gemini_file_cache.compute_key, upload_path)
+        cache_key = f"{route.key_id}:{content_hash}"
+        video_file = gemini_file_cache.get(cache_key)
+        if video_file is not None:
+            print(f"复用已上传的 Gemini 文件: {video_file.name}")
+            report_progress(STAGE_MODEL_ACTIVE, cached=True)
+            return video_file, cache_key
+        
+        video_file = await self._upload_to_gemini(route, upload_path)
+        gemini_file_cache.put(cache_key, video_file, deleter=route.delete_file)
+        return video_file, cache_key
+    
+    async def _generate_on_route(
+        self,
+        route: GeminiRoute,
+        upload_path: str,
+        frame_parts: Optional[list],
+        prompt: AnalysisPrompt,
+        estimated_tokens: int,
+        priority: int
+    ):
+        """
+        在指定路线上完成上传（视频模式）和内容生成
+        
+        Returns:
+            Gemini 响应对象
+        """
+        video_file = None
+        cache_key = None
+        try:
+            # 先申请 RPM/TPM 配额（超出时按优先级排队等待），排队超时或队列已满时不必上传视频
+            await route.scheduler.acquire(estimated_tokens, priority=priority)
+            
+            if frame_parts is not None:
+                media_parts = frame_parts
+            else:
+                video_file, cache_key = await self._get_or_upload_file(route, upload_path)
+                media_parts = [video_file]
+            
+            print(f"开始调用 Gemini API，路线: {route.name}")
+            report_progress(STAGE_GENERATING)
+            
+            if settings.analysis_streaming_enabled and is_tracking():
+                generate = self._stream_generate(route.get_model(), asyncio.get_running_loop())
+            else:
+                generate = route.get_model().generate_content
+            
+            response = await call_with_retry(
+                generate,
+                media_parts + [prompt.text],
+                generation_config=prompt.generation_config,
+                request_options={"timeout": settings.gemini_generate_timeout_seconds},
+                stage="Gemini 生成",
+                timeout=settings.gemini_generate_timeout_seconds,
+                # 每次重试同样是一次请求，重新申请配额
+                before_retry=lambda: route.scheduler.acquire(estimated_tokens, priority=priority),
+                **self._retry_options(route)
+            )
+            
+            # 按实际 Token 消耗修正配额
+            usage = getattr(response, "usage_metadata", None)
+            route.scheduler.record_usage(estimated_tokens, getattr(usage, "total_token_count", None))
+            return response
+        
+        except Exception as e:
+            # 远端文件已失效时移除缓存，下次分析重新上传
+            error_msg = str(e).lower()
+            if cache_key and ("not found" in error_msg or "permission" in error_msg):
+                gemini_file_cache.invalidate(cache_key)
+            raise
+        finally:
+            # 未启用缓存时清理上传的文件；启用缓存时由缓存在过期后后台删除
+            if video_file is not None and cache_key is None:
+                try:
+                    route.delete_file(video_file.name)
+                except:
+                    pass
+    
+    @staticmethod
+    def _stream_generate(model, loop: asyncio.AbstractEventLoop):
+        """
+        构造流式生成函数：在工作线程中逐块接收模型输出，增量解析 JSON，
+        字段完整后立即推送 partial 进度事件
+        
+        Returns:
+            与 generate_content 参数相同的同步函数，返回完整的响应对象
+        """
+        def _on_field(key: str, value) -> None:
+            report_progress(STAGE_PARTIAL, field=key, value=value)
+        
+        def _on_item(key: str, index: int, item) -> None:
+            report_progress(STAGE_PARTIAL, field=key, index=index, value=item)
+        
+        def _generate(contents, **kwargs):
+            # 每次调用（包括重试）使用新的解析器
+            parser = IncrementalJsonParser(_on_field, _on_item, stream_arrays=("suggestions",))
+            response = model.generate_content(contents, stream=True, **kwargs)
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # 只包含用量等元数据的数据块
+                    continue
+                # 进度事件需要在事件循环线程中发布
+                loop.call_soon_threadsafe(parser.feed, text)
+            return response
+        
+        return _generate
+    
+    def _build_keyframe_parts(self, upload_path: str) -> list:
+        """
+        抽取击球前后的关键帧，构造内联图片输入（无需 File API 上传和轮询）
+        
+        Args:
+            upload_path: 视频路径
+        
+        Returns:
+            模型输入片段列表（说明文字 + JPEG 图片）
+        """
+        frames_dir = tempfile.mkdtemp(prefix="keyframes_")
+        try:
+            frames = FFmpegHelper.extract_keyframes(upload_path, frames_dir)
+            
+            interval = frames[1][0] - frames[0][0] if len(frames) > 1 else 0
+            parts = [
+                f"以下是从杀球视频中按时间顺序抽取的 {len(frames)} 张关键帧，"
+                f"覆盖击球时刻前后，相邻两帧间隔约 {interval:.3f} 秒。"
+                f"请将这些关键帧视为上传的视频进行分析，并利用帧间隔估算羽毛球飞行速度。"
+            ]
+            for time_point, frame_path in frames:
+                with open(frame_path, "rb") as f:
+                    parts.append(f"t={time_point:.3f}s")
+                    parts.append({"mime_type": "image/jpeg", "data": f.read()})
+            
+            print(f"关键帧抽取完成: {len(frames)} 帧")
+            return parts
+        
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"抽取关键帧失败: {str(e)}"
+            )
+        finally:
+            shutil.rmtree(frames_dir, ignore_errors=True)
+    
+    def _points_enabled(self) -> bool:
+        """检查数据库表是否有积分字段（积分系统是否启用），检查通过后不再重复查询"""
+        global _points_enabled_checked
+        if _points_enabled_checked:
+            return True
+        try:
+            self.db.table("users").select("points").limit(1).execute()
+            _points_enabled_checked = True
+            return True
+        except Exception:
+            return False
+    
+    async def _deduct_points(
+        self,
+        user_id: str,
+        points_cost: int,
+        description: str,
+        raise_insufficient: bool = False
+    ) -> bool:
+        """
+        扣除积分（交易记录通过批量写入器合并插入）
+        
+        Args:
+            raise_insufficient: 积分不足时是否抛出 400（扣除时会校验余额，无需事先查询）
+        
+        Returns:
+            是否扣除成功；积分系统未配置等异常只记录日志，不影响分析结果
+        """
+        try:
+            from app.services.points_service import PointsService
+            await PointsService(self.db).adjust_points(
+                user_id=user_id,
+                points=-points_cost,
+                transaction_type="spend",
+                description=description,
+                related_type="analysis",
+                write_behind=settings.db_write_batching_enabled
+            )
+            print(f"成功扣除积分: {points_cost}，用户ID: {user_id}")
+            return True
+        except HTTPException as e:
+            if raise_insufficient and e.status_code == status.HTTP_400_BAD_REQUEST:
+                raise
+            print(f"扣除积分失败: {e.detail}")
+            return False
+        except Exception as e:
+            print(f"扣除积分失败（可能积分系统未配置）: {str(e)}")
+            return False
     
-    async def analyze_video(self, video_id: str, user_id: str) -> dict:
+    async def analyze_video(
+        self,
+        video_id: str,
+        user_id: str,
+        mode: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        charge_points: bool = True
+    ) -> dict:
         """
         分析视频并返回结果
         
         Args:
             video_id: 视频ID
             user_id: 用户ID
+            mode: 分析模式（video/frames），None 时使用配置 analysis_mode
+            priority: 配额排队优先级，数值越小越优先
+            charge_points: 是否扣除本次分析的积分（批量分析由批次统一扣除）
         
         Returns:
             分析结果字典
         """
+        mode = mode or settings.analysis_mode
+        # 同一用户、同一视频、相同模式和计费方式的并发请求合并为一次分析，进度同时发布给合并的请求
+        return await analysis_singleflight.do(
+            (user_id, video_id, mode, charge_points),
+            lambda: self._analyze_video(video_id, user_id, mode, priority, charge_points),
+            share=progress_jobs(),
+            on_join=join_progress
+        )
+    
+    async def _analyze_video(
+        self,
+        video_id: str,
+        user_id: str,
+        mode: str,
+        priority: int,
+        charge_points: bool
+    ) -> dict:
+        """执行一次完整的视频分析（参数同 analyze_video）"""
         start_time = time.time()
         
+        # Gemini 所有路线都熔断或排队已满时直接失败，避免走完整个上传流程
+        if not gemini_router.plan():
+            if gemini_router.misconfigured:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="AI 分析服务配置错误，请检查 Gemini API 密钥和模型名称"
+                )
+            if gemini_router.all_circuits_open():
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="AI 分析服务暂时不可用，请稍后重试",
+                    headers={"Retry-After": str(int(gemini_router.min_retry_after()) + 1)}
+                )
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="当前分析请求过多，请稍后重试",
+                headers={"Retry-After": "10"}
+            )
+        
         # 1. 获取视频信息
         try:
             video_response = self.db.table("videos").select("*").eq("id", video_id).eq("user_id", user_id).execute()
@@ -56,104 +510,50 @@ class AnalysisService:
             )
         
         # 2. 检查视频文件是否存在
-        import os
         if not os.path.exists(video_path):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"视频文件不存在: {video_path}"
             )
         
-        # 3. 上传视频文件到 Gemini
-        try:
-            print(f"开始上传视频文件到 Gemini: {video_path}")
-            video_file = genai.upload_file(path=video_path)
-            print(f"视频文件上传成功: {video_file.uri}, 状态: {video_file.state}")
-            
-            # 等待文件处理完成（状态变为 ACTIVE）
-            max_wait_time = 60  # 最多等待60秒
-            wait_interval = 2   # 每2秒检查一次
-            waited_time = 0
-            
-            while video_file.state.name != "ACTIVE" and waited_time < max_wait_time:
-                print(f"等待文件处理完成，当前状态: {video_file.state.name}, 已等待: {waited_time}秒")
-                time.sleep(wait_interval)
-                waited_time += wait_interval
-                # 重新获取文件状态
-                video_file = genai.get_file(video_file.name)
-            
-            if video_file.state.name != "ACTIVE":
-                raise Exception(f"文件处理超时，状态: {video_file.state.name}")
-            
-            print(f"文件已就绪，状态: {video_file.state.name}")
-            
-        except Exception as e:
-            error_msg = str(e)
-            # 提供更详细的错误信息
-            if "API key" in error_msg or "authentication" in error_msg.lower():
-                error_msg = "Gemini API 密钥配置错误，请检查 .env 文件中的 GEMINI_API_KEY"
-            elif "file" in error_msg.lower() and "not found" in error_msg.lower():
-                error_msg = f"视频文件不存在或无法访问: {video_path}"
-            elif "not in an ACTIVE state" in error_msg:
-                error_msg = "视频文件处理未完成，请稍后重试"
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"上传视频到 Gemini 失败: {error_msg}"
-            )
+        # 3. 准备模型输入（关键帧模式在此抽帧，视频模式在选定路线后上传）
+        upload_path = await self._get_analysis_file(video_path)
+        frame_parts = None
         
-        # 4. 构建 Prompt
-        prompt = """
-你是一位世界顶级的羽毛球科研专家和运动生物力学分析师。请对上传的视频进行极高精度的量化分析，结果必须严谨且经得住推敲。
-
-请执行以下思维过程来确保准确性：
-1. **视觉测距与物理建模**：
-   - 仔细观察视频中的环境参照物（标准羽毛球场长13.40米，宽6.10米，网高1.55米）。
-   - 估算羽毛球从击球点到落地点的飞行距离。
-   - 计算飞行时间，从而推算平均速度和初速度。
-2. **动作生物力学诊断**：
-   - 逐帧分析"鞭打动作"：检查力量是否从蹬地 -> 转髋 -> 展胸 -> 大臂 -> 小臂 -> 手腕 -> 手指顺畅传递。
-   - 观察击球点高度：是否在人体中轴线的前上方最高点。
-3. **数据合理性校验**：
-   - 业余初级：< 150 km/h
-   - 业余中高级：150 - 250 km/h
-   - 职业级：> 250 km/h
-   - 请根据视频中选手的动作流畅度和爆发力，给出符合物理常识的速度估算。
-
-请以 JSON 格式返回分析结果，包含以下字段（所有文本使用简体中文）：
-{
-  "speed": 整数(km/h),
-  "rank": 百分位排名(0-100),
-  "rank_position": 前X%,
-  "level": "技术等级",
-  "technique": {
-    "power": 发力评分(0-100),
-    "angle": 角度评分(0-100),
-    "coordination": 协调性评分(0-100)
-  },
-  "score": 综合评分(0-10),
-  "suggestions": [
-    {
-      "title": "建议标题",
-      "desc": "详细建议",
-      "icon": "Material图标名",
-      "highlight": "关键数据"
-    }
-  ]
-}
-"""
+        if mode == "frames":
+            report_progress(STAGE_TRANSCODING)
+            frame_parts = await asyncio.to_thread(self._build_keyframe_parts, upload_path)
+            estimated_tokens = settings.analysis_keyframe_count * TOKENS_PER_FRAME
+        else:
+            estimated_tokens = int(float(video.get("duration") or 10) + 1) * TOKENS_PER_FRAME
+        estimated_tokens += PROMPT_TOKENS_ESTIMATE + OUTPUT_TOKENS_ESTIMATE
         
-        # 5. 调用 Gemini API
-        try:
-            print(f"开始调用 Gemini API，模型: gemini-2.0-flash-exp")
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            print(f"模型创建成功，开始生成内容...")
-            
-            response = model.generate_content(
-                [video_file, prompt],
-                generation_config=genai.GenerationConfig(
-                    response_mime_type="application/json"
+        # 4. 获取 Prompt（按配置的版本，带结构化输出 Schema）
+        prompt = get_analysis_prompt()
+        
+        # 5. 调用 Gemini API（按路由顺序尝试，配额不足或服务不可用时切换到下一条路线）
+        response = None
+        last_error = None
+        for route in gemini_router.plan():
+            try:
+                response = await self._generate_on_route(
+                    route, upload_path, frame_parts, prompt, estimated_tokens, priority
                 )
-            )
-            
+                break
+            except Exception as e:
+                last_error = e
+                if not self._should_failover(e):
+                    break
+                print(f"路线 {route.name} 不可用（{type(e).__name__}: {str(e)[:200]}），尝试下一条路线")
+        
+        if response is None:
+            import traceback
+            error = last_error or CircuitOpenError("gemini", settings.gemini_breaker_recovery_seconds)
+            print(f"Gemini API 调用异常: {str(error)}")
+            print(f"错误堆栈: {''.join(traceback.format_exception(type(error), error, error.__traceback__))}")
+            raise self._gemini_http_exception(error, f"AI 分析失败: {self._gemini_error_message(error)}")
+        
+        try:
             print(f"Gemini API 调用成功，响应类型: {type(response)}")
             
             # 解析结果
@@ -162,123 +562,57 @@ class AnalysisService:
                 raise Exception("AI 返回结果为空")
             
             print(f"AI 返回文本长度: {len(response.text)}")
-            print(f"AI 返回文本前200字符: {response.text[:200]}")
-            
-            result = json.loads(response.text)
-            print(f"JSON 解析成功，结果: {result}")
-            
-            # 验证结果格式
-            if "speed" not in result:
-                print(f"错误: 结果中缺少 speed 字段，完整结果: {result}")
-                raise Exception("AI 返回结果格式不正确，缺少 speed 字段")
-            
-        except json.JSONDecodeError as e:
-            error_detail = f"AI 返回结果解析失败: {str(e)}"
-            if hasattr(response, 'text'):
-                error_detail += f"。原始响应: {response.text[:500]}"
-            print(f"JSON 解析错误: {error_detail}")
+            result = prompt.parse(response.text)
+            prompt.record(response, parsed=True)
+            print(f"结果校验成功（Prompt {prompt.version}）: {result}")
+        
+        except ValidationError as e:
+            prompt.record(response, parsed=False)
+            error_detail = f"AI 返回结果解析失败: {e.error_count()} 个字段不符合要求"
+            error_detail += f"。原始响应: {response.text[:500]}"
+            print(f"结果校验错误: {error_detail}\n{str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=error_detail
             )
         except Exception as e:
-            import traceback
-            error_msg = str(e)
-            error_trace = traceback.format_exc()
-            print(f"Gemini API 调用异常: {error_msg}")
-            print(f"错误堆栈: {error_trace}")
-            
-            if "API key" in error_msg or "authentication" in error_msg.lower():
-                error_msg = "Gemini API 密钥配置错误，请检查 .env 文件中的 GEMINI_API_KEY"
-            elif "quota" in error_msg.lower() or "limit" in error_msg.lower():
-                error_msg = "Gemini API 配额已用完，请检查 API 使用限制"
-            elif "model" in error_msg.lower() and "not found" in error_msg.lower():
-                error_msg = "Gemini 模型不可用，请检查模型名称是否正确"
-            
+            prompt.record(response, parsed=False)
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"AI 分析失败: {error_msg}"
+                detail=f"AI 分析失败: {self._gemini_error_message(e)}"
             )
-        finally:
-            # 清理上传的文件
-            try:
-                genai.delete_file(video_file.name)
-            except:
-                pass
         
         # 6. 扣除积分（每次分析消耗 10 积分）
         # 注意：如果数据库表没有积分字段，跳过积分扣除
-        points_cost = 10
+        points_cost = ANALYSIS_POINTS_COST
         points_deducted = False
-        
-        try:
-            # 先检查数据库表是否有积分字段
-            test_query = self.db.table("users").select("points").limit(1).execute()
-            has_points_field = True
-        except Exception:
-            # 积分字段不存在，跳过积分扣除
-            print("数据库表没有积分字段，跳过积分扣除")
-            has_points_field = False
+        has_points_field = charge_points and self._points_enabled()
         
         if has_points_field:
-            try:
-                from app.services.points_service import PointsService
-                points_service = PointsService(self.db)
-                
-                # 检查积分是否足够
-                user_points = await points_service.get_user_points(user_id)
-                if user_points.get("points", 0) < points_cost:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail=f"积分不足，当前余额: {user_points.get('points', 0)}，需要: {points_cost}"
-                    )
-                
-                # 扣除积分
-                await points_service.adjust_points(
-                    user_id=user_id,
-                    points=-points_cost,
-                    transaction_type="spend",
-                    description="视频分析消耗",
-                    related_type="analysis"
-                )
-                points_deducted = True
-                print(f"成功扣除积分: {points_cost}，用户ID: {user_id}")
-            except HTTPException:
-                raise
-            except Exception as e:
-                print(f"扣除积分失败（可能积分系统未配置）: {str(e)}")
-                # 积分扣除失败不影响分析结果保存，但记录错误
-                points_deducted = False
-        else:
+            points_deducted = await self._deduct_points(
+                user_id, points_cost, "视频分析消耗", raise_insufficient=True
+            )
+        elif charge_points:
             print("积分系统未启用，跳过积分扣除")
         
         # 7. 保存分析结果到数据库
         analysis_duration = time.time() - start_time
+        print(f"分析耗时: {analysis_duration:.2f} 秒，模式: {mode}，路线: {route.name}")
         
-        # 处理 rank_position：如果是字符串（如"前25%"），提取数字部分
-        rank_position = result.get("rank_position")
-        if isinstance(rank_position, str):
-            # 尝试从字符串中提取数字，例如 "前25%" -> 25
-            match = re.search(r'\d+', rank_position)
-            if match:
-                rank_position = int(match.group())
-            else:
-                rank_position = None
-        
-        # 确保所有必需字段都存在
         analysis_data = {
             "user_id": user_id,
             "video_id": video_id,
-            "speed": int(result["speed"]),
-            "level": str(result["level"]),
-            "score": float(result["score"]),
-            "technique_power": int(result["technique"]["power"]),
-            "technique_angle": int(result["technique"]["angle"]),
-            "technique_coordination": int(result["technique"]["coordination"]),
-            "rank": int(result.get("rank")) if result.get("rank") is not None else None,
-            "rank_position": rank_position,  # 已经是处理后的整数或 None
-            "suggestions": result["suggestions"],
-            "analysis_duration": float(analysis_duration)
+            "speed": result.speed,
+            "level": result.level,
+            "score": result.score,
+            "technique_power": result.technique.power,
+            "technique_angle": result.technique.angle,
+            "technique_coordination": result.technique.coordination,
+            "rank": result.rank,
+            "rank_position": result.rank_position,
+            "suggestions": [s.model_dump() for s in result.suggestions],
+            "analysis_duration": float(analysis_duration),
+            "prompt_version": prompt.version
         }
         
         # 只有在积分字段存在且已扣除积分时才添加 points_cost
@@ -295,13 +629,11 @@ class AnalysisService:
         try:
             print(f"准备保存分析结果到数据库")
             print(f"数据: user_id={user_id}, video_id={video_id}, speed={analysis_data['speed']}, level={analysis_data['level']}")
-            db_response = self.db.table("analyses").insert(analysis_data).execute()
-            if not db_response.data:
-                print(f"数据库插入失败: 响应为空")
-                raise Exception("数据库插入失败")
-            
-            analysis_record = db_response.data[0]
+            # 同步插入：返回给客户端的分析ID必须已经可以查询（积分流水才通过批量写入器合并插入）
+            analysis_record = await asyncio.to_thread(self._insert_analysis, analysis_data)
             print(f"分析结果保存成功: ID={analysis_record.get('id')}")
+            await invalidate_history(cache, user_id)
+            report_progress(STAGE_SAVED, analysis_id=analysis_record["id"])
             
             return {
                 "id": analysis_record["id"],
@@ -317,7 +649,8 @@ class AnalysisService:
                 "rank": analysis_record.get("rank"),
                 "rank_position": analysis_record.get("rank_position"),
                 "suggestions": analysis_record["suggestions"],
-                "analyzed_at": analysis_record["analyzed_at"]
+                "analyzed_at": analysis_record["analyzed_at"],
+                "prompt_version": analysis_record.get("prompt_version")
             }
         
         except Exception as e:
@@ -331,6 +664,175 @@ class AnalysisService:
                 detail=f"保存分析结果失败: {str(e)}"
             )
     
+    def _insert_analysis(self, analysis_data: dict) -> dict:
+        """直接插入一条分析记录，返回数据库中的记录"""
+        try:
+            db_response = self.db.table("analyses").insert(analysis_data).execute()
+        except Exception as e:
+            # 兼容尚未执行迁移、没有 prompt_version 字段的数据库
+            if "prompt_version" not in str(e):
+                raise
+            print("analyses 表缺少 prompt_version 字段，跳过保存 Prompt 版本")
+            analysis_data.pop("prompt_version")
+            db_response = self.db.table("analyses").insert(analysis_data).execute()
+        
+        if not db_response.data:
+            print(f"数据库插入失败: 响应为空")
+            raise Exception("数据库插入失败")
+        return db_response.data[0]
+    
+    async def _refund_points(self, user_id: str, points: int, description: str) -> None:
+        """退回预扣的积分；失败只记录日志（需要人工补偿）"""
+        try:
+            from app.services.points_service import PointsService
+            await PointsService(self.db).adjust_points(
+                user_id=user_id,
+                points=points,
+                transaction_type="refund",
+                description=description,
+                related_type="analysis",
+                write_behind=settings.db_write_batching_enabled
+            )
+            print(f"成功退回积分: {points}，用户ID: {user_id}")
+        except HTTPException as e:
+            print(f"退回积分失败，需要人工补偿: 用户ID={user_id}，积分={points}，原因: {e.detail}")
+        except Exception as e:
+            print(f"退回积分失败，需要人工补偿: 用户ID={user_id}，积分={points}，原因: {str(e)}")
+    
+    async def _refund_in_background(self, user_id: str, points: int, description: str) -> None:
+        """
+        在独立任务中退回积分并等待完成
+        
+        客户端断开时批量分析的生成器会被取消，这里的 await 随之被取消，但退款任务保留引用并继续执行
+        """
+        refund = asyncio.ensure_future(self._refund_points(user_id, points, description))
+        _pending_refunds.add(refund)
+        refund.add_done_callback(_pending_refunds.discard)
+        await asyncio.shield(refund)
+    
+    async def prepare_batch(self, video_ids: List[str], user_id: str) -> Tuple[List[str], int]:
+        """
+        校验批量分析请求：去重、检查数量上限，并按整批费用预扣积分
+        
+        预扣在开始分析前完成，并发的批次不会在余额检查后共同透支；失败的视频在批次结束时退回
+        
+        Returns:
+            (去重后的视频ID列表, 预扣的积分)，积分系统未启用时预扣为 0
+        """
+        video_ids = list(dict.fromkeys(video_ids))
+        if len(video_ids) > settings.analysis_batch_max_videos:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"单次最多分析 {settings.analysis_batch_max_videos} 个视频"
+            )
+        
+        reserved_points = 0
+        if self._points_enabled():
+            points_cost = ANALYSIS_POINTS_COST * len(video_ids)
+            if await self._deduct_points(
+                user_id, points_cost, f"批量视频分析预扣（{len(video_ids)} 个视频）", raise_insufficient=True
+            ):
+                reserved_points = points_cost
+        return video_ids, reserved_points
+    
+    async def analyze_batch(
+        self,
+        video_ids: List[str],
+        user_id: str,
+        mode: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        reserved_points: int = 0
+    ) -> AsyncIterator[dict]:
+        """
+        并发分析多个视频，按完成顺序逐个返回结果，结束后退回失败部分的预扣积分
+        
+        并发数受 analysis_batch_concurrency 限制，实际调用 Gemini 时仍受全局配额调度器约束
+        
+        Args:
+            reserved_points: prepare_batch 预扣的积分
+        
+        Yields:
+            每个视频的结果 {"type": "result", ...}，最后是汇总 {"type": "summary", ...}
+        """
+        start_time = time.time()
+        semaphore = asyncio.Semaphore(max(1, settings.analysis_batch_concurrency))
+        # 按实际保存的分析结果计费（包括已完成但还没推送给客户端的结果）
+        started = set()
+        succeeded = 0
+        
+        async def _analyze(index: int, video_id: str) -> dict:
+            nonlocal succeeded
+            async with semaphore:
+                started.add(index)
+                try:
+                    analysis = await self.analyze_video(
+                        video_id, user_id, mode=mode, priority=priority, charge_points=False
+                    )
+                    succeeded += 1
+                    return {"type": "result", "index": index, "video_id": video_id,
+                            "status": "success", "analysis": analysis}
+                except HTTPException as e:
+                    return {"type": "result", "index": index, "video_id": video_id,
+                            "status": "failed", "status_code": e.status_code, "error": e.detail}
+                except Exception as e:
+                    return {"type": "result", "index": index, "video_id": video_id,
+                            "status": "failed", "status_code": 500, "error": f"分析失败: {str(e)}"}
+        
+        def _refund_amount() -> int:
+            return max(0, reserved_points - ANALYSIS_POINTS_COST * succeeded)
+        
+        async def _settle_after_disconnect(running: List["asyncio.Future"]) -> None:
+            # 已开始的分析在 single-flight 的独立任务中继续执行并保存结果，等它们结束后再按实际结果结算
+            await asyncio.gather(*running, return_exceptions=True)
+            refund = _refund_amount()
+            print(f"批量分析在客户端断开后结算: 共 {len(video_ids)} 个，成功 {succeeded} 个，退回积分 {refund}")
+            if refund > 0:
+                await self._refund_points(
+                    user_id, refund,
+                    f"批量视频分析退回（客户端断开，{len(video_ids) - succeeded} 个视频未完成）"
+                )
+        
+        tasks = [asyncio.ensure_future(_analyze(i, vid)) for i, vid in enumerate(video_ids)]
+        settled = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+            
+            # 退回失败视频的预扣积分（整批只记一笔退款流水）
+            points_cost = reserved_points - _refund_amount()
+            settled = True
+            if reserved_points > points_cost:
+                await self._refund_in_background(
+                    user_id, reserved_points - points_cost,
+                    f"批量视频分析退回（{len(video_ids) - succeeded} 个视频失败）"
+                )
+            
+            duration = time.time() - start_time
+            print(f"批量分析完成: 共 {len(video_ids)} 个，成功 {succeeded} 个，耗时 {duration:.2f} 秒")
+            yield {
+                "type": "summary",
+                "total": len(video_ids),
+                "succeeded": succeeded,
+                "failed": len(video_ids) - succeeded,
+                "points_cost": points_cost,
+                "duration": round(duration, 2)
+            }
+        finally:
+            if not settled:
+                # 客户端断开：还没开始的视频不再分析；已开始的分析无法中止（结果会保存），照常计费
+                running = []
+                for index, task in enumerate(tasks):
+                    if task.done():
+                        continue
+                    if index in started:
+                        running.append(task)
+                    else:
+                        task.cancel()
+                if reserved_points > 0:
+                    settle = asyncio.ensure_future(_settle_after_disconnect(running))
+                    _pending_refunds.add(settle)
+                    settle.add_done_callback(_pending_refunds.discard)
+    
     async def get_analysis(self, analysis_id: str, user_id: str) -> dict:
         """
         获取分析结果
@@ -367,7 +869,8 @@ class AnalysisService:
                 "rank": record.get("rank"),
                 "rank_position": record.get("rank_position"),
                 "suggestions": record["suggestions"],
-                "analyzed_at": record["analyzed_at"]
+                "analyzed_at": record["analyzed_at"],
+                "prompt_version": record.get("prompt_version")
             }
         
         except HTTPException:
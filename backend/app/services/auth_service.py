@@ -2,10 +2,11 @@
 认证服务
 处理用户注册、登录等业务逻辑
 """
+import asyncio
 from datetime import timedelta
 from typing import Optional
 from fastapi import HTTPException, status
-from supabase import Client
+from app.database import Client
 from app.models.user import UserCreate, UserLogin
 from app.utils.security import verify_password, get_password_hash, create_access_token
 from app.config import settings
@@ -48,7 +49,8 @@ class AuthService:
                 )
         
         # 创建用户
-        password_hash = get_password_hash(user_data.password)
+        # bcrypt 计算耗时较长，放到线程中执行，避免阻塞事件循环
+        password_hash = await asyncio.to_thread(get_password_hash, user_data.password)
         
         # 基础用户数据（不包含积分字段，避免字段不存在导致错误）
         user_dict = {
@@ -172,7 +174,7 @@ class AuthService:
             user = response.data[0]
             
             # 验证密码
-            if not verify_password(login_data.password, user["password_hash"]):
+            if not await asyncio.to_thread(verify_password, login_data.password, user["password_hash"]):
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="用户名或密码错误"
@@ -258,7 +260,7 @@ class AuthService:
             # 3. 注册新用户
             # 生成随机密码 (用户不会用到这个密码，除非他们后来绑定了邮箱/手机)
             random_password = secrets.token_urlsafe(16)
-            password_hash = get_password_hash(random_password)
+            password_hash = await asyncio.to_thread(get_password_hash, random_password)
             
             # 生成唯一用户名
             username = f"wx_{openid[-8:]}_{secrets.token_hex(2)}"
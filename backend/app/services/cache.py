@@ -0,0 +1,341 @@
+"""
+服务层通用缓存
+按命名空间组织缓存数据，支持 TTL、LRU 容量上限、分组失效、防击穿（并发未命中时只加载一次）和命中率统计。
+后端可选进程内 LRU（单进程）或 Redis 协议服务（多个 uvicorn worker 共享缓存和失效）
+"""
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+from app.config import settings
+from app.utils.singleflight import SingleFlight
+
+
+class MemoryCacheBackend:
+    """进程内缓存后端（LRU + TTL），只在当前 worker 内有效"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # 计数器（分组版本号）单独保存，不参与 LRU 淘汰，否则版本号被淘汰后旧数据会重新生效
+        self._counters: Dict[str, int] = {}
+        self.evictions = 0
+
+    def _get_entry(self, key: str) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def get(self, key: str) -> Optional[str]:
+        if key in self._counters:
+            return str(self._counters[key])
+        entry = self._get_entry(key)
+        return entry[0] if entry else None
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float]) -> None:
+        expires_at = time.time() + ttl_seconds if ttl_seconds else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def add(self, key: str, value: str, ttl_seconds: Optional[float]) -> bool:
+        """键不存在时写入（用于加载锁），返回是否写入"""
+        if self._get_entry(key) is not None:
+            return False
+        await self.set(key, value, ttl_seconds)
+        return True
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    async def close(self) -> None:
+        self._entries.clear()
+        self._counters.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "max_entries": self.max_entries, "evictions": self.evictions}
+
+
+class RedisCacheBackend:
+    """
+    Redis 协议缓存后端（Redis、Valkey、KeyDB 等），多个 worker 和实例共享
+
+    容量和淘汰由服务端 maxmemory / maxmemory-policy 控制；建议使用 volatile-lru：
+    缓存数据都带 TTL 会被淘汰，不带 TTL 的分组版本号不会被淘汰
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str):
+        # 只在启用 Redis 后端时才需要安装 redis 包
+        import redis.asyncio as redis
+
+        self.url = url
+        self._client = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float]) -> None:
+        if ttl_seconds:
+            await self._client.set(key, value, px=int(ttl_seconds * 1000))
+        else:
+            await self._client.set(key, value)
+
+    async def add(self, key: str, value: str, ttl_seconds: Optional[float]) -> bool:
+        px = int(ttl_seconds * 1000) if ttl_seconds else None
+        return bool(await self._client.set(key, value, px=px, nx=True))
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self._client.delete(*keys)
+
+    async def incr(self, key: str) -> int:
+        return int(await self._client.incr(key))
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    def stats(self) -> dict:
+        # 不在统计中暴露包含密码的连接串
+        return {"url": self.url.split("@")[-1]}
+
+
+class CacheNamespace:
+    """
+    缓存命名空间
+
+    - 值以 JSON 保存，两种后端行为一致（读取到的是副本，修改不会影响缓存）
+    - group（如用户ID）用于批量失效：键中包含分组版本号，invalidate 递增版本号后旧键不再被读取
+    - 后端出错时按未命中处理，不影响请求
+    """
+
+    def __init__(self, cache: "Cache", name: str, ttl_seconds: float):
+        self.cache = cache
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self._singleflight = SingleFlight(f"缓存 {name}")
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.errors = 0
+
+    def _key(self, *parts: str) -> str:
+        return ":".join((self.cache.key_prefix, self.name) + parts)
+
+    async def _version(self, group: Optional[str]) -> str:
+        if group is None:
+            return "0"
+        version = await self.cache.backend.get(self._key("version", group))
+        return version or "0"
+
+    def _make_key(self, key: str, group: Optional[str], version: str) -> str:
+        if group is None:
+            return self._key("data", key)
+        return self._key("data", group, version, key)
+
+    async def _data_key(self, key: str, group: Optional[str]) -> str:
+        return self._make_key(key, group, await self._version(group))
+
+    async def get(self, key: str, group: Optional[str] = None) -> Optional[Any]:
+        """获取缓存值，不存在时返回 None"""
+        try:
+            raw = await self.cache.backend.get(await self._data_key(key, group))
+        except Exception as e:
+            self._on_error("读取", e)
+            return None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        group: Optional[str] = None,
+        ttl_seconds: Optional[float] = None
+    ) -> None:
+        """写入缓存值"""
+        try:
+            await self._set(await self._data_key(key, group), value, ttl_seconds)
+        except Exception as e:
+            self._on_error("写入", e)
+
+    async def _set(self, data_key: str, value: Any, ttl_seconds: Optional[float]) -> None:
+        raw = json.dumps(value, ensure_ascii=False, default=str)
+        await self.cache.backend.set(data_key, raw, ttl_seconds or self.ttl_seconds)
+
+    async def delete(self, key: str, group: Optional[str] = None) -> None:
+        """删除缓存值"""
+        try:
+            await self.cache.backend.delete(await self._data_key(key, group))
+        except Exception as e:
+            self._on_error("删除", e)
+
+    async def invalidate(self, group: str) -> None:
+        """使分组下的全部缓存失效（旧数据随 TTL 或 LRU 清理）"""
+        try:
+            await self.cache.backend.incr(self._key("version", group))
+        except Exception as e:
+            self._on_error("失效", e)
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        group: Optional[str] = None,
+        ttl_seconds: Optional[float] = None
+    ) -> Any:
+        """
+        获取缓存值，未命中时调用 loader 加载并写入缓存
+
+        防击穿：同一 worker 内并发未命中只调用一次 loader；Redis 后端下再通过加载锁
+        让其他 worker 等待已开始的加载，而不是同时查询数据库
+        """
+        try:
+            version = await self._version(group)
+            data_key = self._make_key(key, group, version)
+            raw = await self.cache.backend.get(data_key)
+        except Exception as e:
+            self._on_error("读取", e)
+            return await loader()
+
+        if raw is not None:
+            self.hits += 1
+            return json.loads(raw)
+
+        self.misses += 1
+        return await self._singleflight.do(
+            data_key, lambda: self._load(data_key, group, version, loader, ttl_seconds)
+        )
+
+    async def _load(
+        self,
+        data_key: str,
+        group: Optional[str],
+        version: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl_seconds: Optional[float]
+    ) -> Any:
+        lock_key = f"{data_key}:lock"
+        lock_token = uuid.uuid4().hex
+        backend = self.cache.backend
+        try:
+            locked = await backend.add(lock_key, lock_token, self.cache.lock_timeout_seconds)
+            if not locked:
+                # 其他 worker 正在加载，等待其写入缓存
+                deadline = time.time() + self.cache.lock_timeout_seconds
+                while time.time() < deadline:
+                    await asyncio.sleep(0.05)
+                    raw = await backend.get(data_key)
+                    if raw is not None:
+                        return json.loads(raw)
+        except Exception as e:
+            self._on_error("加锁", e)
+            locked = False
+
+        self.loads += 1
+        try:
+            value = await loader()
+            # 加载期间分组失效时不写入，避免缓存过期的数据
+            try:
+                if group is None or await self._version(group) == version:
+                    await self._set(data_key, value, ttl_seconds)
+            except Exception as e:
+                self._on_error("写入", e)
+            return value
+        finally:
+            if locked:
+                try:
+                    if await backend.get(lock_key) == lock_token:
+                        await backend.delete(lock_key)
+                except Exception as e:
+                    self._on_error("解锁", e)
+
+    def _on_error(self, action: str, error: Exception) -> None:
+        self.errors += 1
+        print(f"Warning: 缓存{action}失败 ({self.name}): {str(error)[:200]}")
+
+    def stats(self) -> dict:
+        """命名空间统计信息"""
+        lookups = self.hits + self.misses
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "loads": self.loads,
+            "coalesced": self._singleflight.total_coalesced,
+            "errors": self.errors
+        }
+
+
+class Cache:
+    """缓存入口：选择后端并管理命名空间"""
+
+    def __init__(self, backend, key_prefix: str, lock_timeout_seconds: float):
+        self.backend = backend
+        self.key_prefix = key_prefix
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self._namespaces: Dict[str, CacheNamespace] = {}
+
+    def namespace(self, name: str, ttl_seconds: float) -> CacheNamespace:
+        """获取（或创建）命名空间；同名命名空间共享统计信息"""
+        ns = self._namespaces.get(name)
+        if ns is None:
+            ns = CacheNamespace(self, name, ttl_seconds)
+            self._namespaces[name] = ns
+        return ns
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+    def stats(self, namespaces: Optional[Iterable[str]] = None) -> dict:
+        """缓存统计信息（用于健康检查）"""
+        names = namespaces if namespaces is not None else self._namespaces.keys()
+        return {
+            "backend": self.backend.name,
+            **self.backend.stats(),
+            "namespaces": {name: self._namespaces[name].stats() for name in names if name in self._namespaces}
+        }
+
+
+def _create_backend():
+    if settings.cache_backend == "redis":
+        return RedisCacheBackend(settings.redis_url)
+    if settings.cache_backend != "memory":
+        raise ValueError(f"不支持的缓存后端: {settings.cache_backend}（可选 memory、redis）")
+    if settings.gemini_quota_workers > 1:
+        # run.py 多 worker 启动时导出 worker 数；memory 后端的失效只作用于当前 worker
+        print(
+            f"⚠️ CACHE_BACKEND=memory 且有 {settings.gemini_quota_workers} 个 worker："
+            f"写入后其他 worker 最多在 {settings.history_cache_ttl_seconds} 秒内返回旧的历史记录，"
+            f"需要跨 worker 失效请使用 redis"
+        )
+    return MemoryCacheBackend(max_entries=settings.cache_max_entries)
+
+
+# 创建全局缓存实例
+cache = Cache(
+    backend=_create_backend(),
+    key_prefix=settings.cache_key_prefix,
+    lock_timeout_seconds=settings.cache_lock_timeout_seconds
+)
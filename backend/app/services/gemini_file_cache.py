@@ -0,0 +1,151 @@
+"""
+Gemini 文件句柄缓存
+按视频内容哈希复用已上传到 Gemini 的文件，避免重试和重复分析时再次上传
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+from app.config import settings
+
+
+class GeminiFileCache:
+    """Gemini 文件句柄缓存类（进程内，LRU + TTL）"""
+
+    # 距离远端过期时间不足该秒数时不再复用，避免生成过程中文件失效
+    EXPIRATION_MARGIN_SECONDS = 600
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def compute_key(file_path: str) -> str:
+        """计算视频文件内容的 SHA-256 哈希，作为缓存键"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _expires_at(self, video_file) -> float:
+        """缓存过期时间：配置 TTL 与远端文件剩余寿命取较小值"""
+        expires_at = time.time() + self.ttl_seconds
+        expiration_time = getattr(video_file, "expiration_time", None)
+        if isinstance(expiration_time, datetime):
+            if expiration_time.tzinfo is None:
+                expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+            remote_expires_at = expiration_time.timestamp() - self.EXPIRATION_MARGIN_SECONDS
+            expires_at = min(expires_at, remote_expires_at)
+        return expires_at
+
+    def get(self, key: str):
+        """获取缓存的 Gemini 文件对象，不存在或已过期时返回 None"""
+        expired = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] <= time.time():
+                expired.append(self._delete_item(self._entries.pop(key)))
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+        self._delete_in_background(expired)
+        return entry["file"] if entry else None
+
+    def put(
+        self,
+        key: str,
+        video_file,
+        deleter: Callable[[str], None]
+    ) -> None:
+        """
+        缓存 Gemini 文件对象，超出容量时淘汰最久未使用的条目
+        
+        Args:
+            key: 缓存键
+            video_file: Gemini 文件对象
+            deleter: 删除远端文件的函数（文件属于哪个 API Key 就用哪个 Key 删除）
+        """
+        self.evict_expired()
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None and old["file"].name != video_file.name:
+                evicted.append(self._delete_item(old))
+
+            self._entries[key] = {
+                "file": video_file,
+                "deleter": deleter,
+                "expires_at": self._expires_at(video_file)
+            }
+
+            while len(self._entries) > self.max_entries:
+                _, entry = self._entries.popitem(last=False)
+                evicted.append(self._delete_item(entry))
+
+        self._delete_in_background(evicted)
+
+    def invalidate(self, key: str) -> None:
+        """移除缓存条目并删除远端文件（例如文件已失效导致生成失败时）"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._delete_in_background([self._delete_item(entry)])
+
+    def evict_expired(self) -> int:
+        """清理所有过期条目，返回清理数量"""
+        now = time.time()
+        with self._lock:
+            expired_keys = [k for k, v in self._entries.items() if v["expires_at"] <= now]
+            expired = [self._delete_item(self._entries.pop(k)) for k in expired_keys]
+        self._delete_in_background(expired)
+        return len(expired)
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    @staticmethod
+    def _delete_item(entry: dict) -> Tuple[str, Callable[[str], None]]:
+        return entry["file"].name, entry["deleter"]
+
+    @staticmethod
+    def _delete_in_background(items: List[Tuple[str, Callable[[str], None]]]) -> None:
+        """在后台线程中删除远端文件，不阻塞请求"""
+        if not items:
+            return
+
+        def _delete():
+            for name, deleter in items:
+                try:
+                    deleter(name)
+                    print(f"已删除 Gemini 缓存文件: {name}")
+                except Exception as e:
+                    print(f"Warning: 删除 Gemini 文件失败 {name}: {str(e)}")
+
+        threading.Thread(target=_delete, daemon=True).start()
+
+
+# 创建全局缓存实例
+gemini_file_cache = GeminiFileCache(
+    ttl_seconds=settings.gemini_file_cache_ttl_seconds,
+    max_entries=settings.gemini_file_cache_max_entries
+)
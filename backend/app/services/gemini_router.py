@@ -0,0 +1,319 @@
+"""
+Gemini 多 Key / 多模型路由
+每条路线（API Key + 模型）拥有独立的客户端、配额调度器和熔断器，
+按权重分配流量，配额不足或服务不可用时切换到其他路线
+"""
+import asyncio
+import hashlib
+import mimetypes
+import os
+import random
+from typing import TYPE_CHECKING, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+from app.config import settings, GeminiRouteConfig
+from app.utils.rate_limiter import QuotaScheduler
+from app.utils.resilience import CircuitBreaker
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+    from google.generativeai.types import file_types
+
+# google.generativeai 导入耗时较长（约 0.5 秒），在第一次创建客户端时才导入，缩短冷启动时间
+
+# 每个 API Key 使用独立客户端依赖 SDK 的私有实现：genai.configure 是进程级全局配置，
+# SDK 没有按 Key 创建客户端的公开接口，这里直接创建 client._ClientManager，并替换 GenerativeModel._client。
+# requirements.txt 固定了经过验证的版本，升级 SDK 时需重新验证；私有实现变化时 _check_sdk_internals 直接报错
+SUPPORTED_SDK_VERSION = "0.8.3"
+
+# 多 worker 启动时，启动脚本在主进程中完成一次就绪检查，通过该环境变量把结果传给各个 worker
+READY_STATE_ENV = "GEMINI_READY_STATE"
+
+# 就绪检查中说明 Key 或模型配置错误的异常，出现时该路线不再接收请求
+CONFIG_ERRORS = (
+    google_exceptions.PermissionDenied,
+    google_exceptions.Unauthenticated,
+    google_exceptions.InvalidArgument,
+    google_exceptions.NotFound,
+)
+
+
+def _per_worker(limit: int) -> int:
+    """配额在进程内调度，多 worker 时每个 worker 只使用平分后的份额（0 表示不限制）"""
+    if not limit:
+        return limit
+    return max(1, limit // max(1, settings.gemini_quota_workers))
+
+
+class GeminiRoute:
+    """一条调用路线：API Key + 模型"""
+
+    def __init__(self, config: GeminiRouteConfig, clients: "_LazyClients"):
+        self.api_key = config.api_key
+        # Key 的短哈希，用于日志、健康检查和文件缓存键，不暴露 Key 本身
+        self.key_id = hashlib.sha256(config.api_key.encode()).hexdigest()[:8]
+        self.model_name = config.model
+        self.weight = config.weight
+        self.tier = config.tier
+        self.name = f"{self.model_name}@{self.key_id}"
+        self._clients = clients
+        self._model = None
+        # 就绪状态：None 未检查（或检查时网络异常），True 可用，False Key/模型配置错误
+        self.ready: Optional[bool] = None
+        self.ready_error: Optional[str] = None
+
+        self.scheduler = QuotaScheduler(
+            name=self.name,
+            rpm=_per_worker(config.rpm if config.rpm is not None else settings.gemini_rpm_limit),
+            tpm=_per_worker(config.tpm if config.tpm is not None else settings.gemini_tpm_limit),
+            max_queue_size=settings.gemini_queue_max_size,
+            max_wait_seconds=settings.gemini_queue_max_wait_seconds
+        )
+        self.breaker = CircuitBreaker(
+            name=self.name,
+            failure_threshold=settings.gemini_breaker_failure_threshold,
+            recovery_seconds=settings.gemini_breaker_recovery_seconds
+        )
+
+    @property
+    def available(self) -> bool:
+        """路线当前是否可接收请求（配置有效、未熔断且排队未满）"""
+        return (
+            self.ready is not False
+            and self.breaker.state != "open"
+            and not self.scheduler.is_saturated()
+        )
+
+    def get_model(self) -> "genai.GenerativeModel":
+        """获取绑定本路线 API Key 的模型对象（创建一次后复用）"""
+        if self._model is None:
+            import google.generativeai as genai
+
+            # 所有路线共用的生成配置（要求模型返回 JSON）
+            model = genai.GenerativeModel(
+                self.model_name,
+                generation_config=genai.GenerationConfig(response_mime_type="application/json")
+            )
+            # 私有属性：让模型使用本路线 Key 的客户端，而不是 genai.configure 的全局客户端
+            if not hasattr(model, "_client"):
+                raise RuntimeError(
+                    f"google-generativeai {getattr(genai, '__version__', 'unknown')} 不支持按 API Key 创建客户端"
+                    f"（缺少 GenerativeModel._client），请安装 {SUPPORTED_SDK_VERSION} 版本"
+                )
+            model._client = self._clients.get_default_client("generative")
+            self._model = model
+        return self._model
+
+    def check_ready(self) -> bool:
+        """
+        就绪检查：创建模型对象并查询模型信息，验证 API Key 和模型名称
+        
+        Returns:
+            是否就绪；网络等临时故障时返回 False，但不标记为配置错误
+        """
+        self.get_model()
+        try:
+            self._clients.get_default_client("model").get_model(name=f"models/{self.model_name}")
+        except CONFIG_ERRORS as e:
+            self.ready = False
+            self.ready_error = f"{type(e).__name__}: {str(e)[:200]}"
+            return False
+        except Exception as e:
+            self.ready = None
+            self.ready_error = f"{type(e).__name__}: {str(e)[:200]}"
+            return False
+
+        self.ready = True
+        self.ready_error = None
+        return True
+
+    def upload_file(self, path: str) -> "file_types.File":
+        """使用本路线的 API Key 上传文件"""
+        from google.generativeai.types import file_types
+
+        mime_type, _ = mimetypes.guess_type(path)
+        response = self._clients.get_default_client("file").create_file(
+            path=path,
+            mime_type=mime_type,
+            display_name=os.path.basename(path)
+        )
+        return file_types.File(response)
+
+    def get_file(self, name: str) -> "file_types.File":
+        """查询文件状态"""
+        from google.generativeai.types import file_types
+
+        return file_types.File(self._clients.get_default_client("file").get_file(name=name))
+
+    def delete_file(self, name: str) -> None:
+        """删除文件"""
+        from google.generativeai import protos
+
+        self._clients.get_default_client("file").delete_file(
+            request=protos.DeleteFileRequest(name=name)
+        )
+
+    def snapshot(self) -> dict:
+        """路线当前状态（用于健康检查）"""
+        return {
+            "name": self.name,
+            "model": self.model_name,
+            "tier": self.tier,
+            "weight": self.weight,
+            "ready": self.ready,
+            "ready_error": self.ready_error,
+            "available": self.available,
+            "circuit_breaker": self.breaker.snapshot(),
+            "quota_scheduler": self.scheduler.snapshot()
+        }
+
+
+class GeminiRouter:
+    """Gemini 路由器：按权重和流量比例选择路线，并提供故障切换顺序"""
+
+    def __init__(self, routes: List[GeminiRoute], cheap_traffic_ratio: float = 0.0):
+        self.routes = routes
+        self.cheap_traffic_ratio = cheap_traffic_ratio
+
+    @staticmethod
+    def _weighted_order(routes: List[GeminiRoute]) -> List[GeminiRoute]:
+        """按权重随机排序（权重越大越可能排在前面）"""
+        return sorted(
+            routes,
+            key=lambda r: random.random() ** (1.0 / r.weight) if r.weight > 0 else 0.0,
+            reverse=True
+        )
+
+    def plan(self) -> List[GeminiRoute]:
+        """
+        生成本次请求的候选路线（按尝试顺序），已熔断或排队已满的路线不参与
+
+        按 cheap_traffic_ratio 的比例优先使用 cheap 路线，其余请求优先使用 primary 路线，
+        另一组路线作为故障切换的后备
+        """
+        available = [r for r in self.routes if r.available]
+        cheap = [r for r in available if r.tier == "cheap"]
+        primary = [r for r in available if r.tier != "cheap"]
+
+        if cheap and random.random() < self.cheap_traffic_ratio:
+            first, second = cheap, primary
+        else:
+            first, second = primary, cheap
+
+        return self._weighted_order(first) + self._weighted_order(second)
+
+    @property
+    def misconfigured(self) -> bool:
+        """是否所有路线都因 Key 或模型配置错误不可用"""
+        return all(r.ready is False for r in self.routes)
+
+    async def warm_up(self, timeout: float) -> bool:
+        """
+        启动预热：为每条路线创建客户端和模型对象，并并发执行就绪检查
+        
+        Args:
+            timeout: 单条路线检查的超时（秒）
+        
+        Returns:
+            是否至少有一条路线就绪
+        """
+        async def _check(route: GeminiRoute) -> None:
+            try:
+                ok = await asyncio.wait_for(asyncio.to_thread(route.check_ready), timeout=timeout)
+            except asyncio.TimeoutError:
+                route.ready_error = f"就绪检查超时（{timeout:.0f} 秒）"
+                ok = False
+            if ok:
+                print(f"✅ Gemini 路线就绪: {route.name}")
+            else:
+                print(f"❌ Gemini 路线未就绪: {route.name}，原因: {route.ready_error}")
+
+        await asyncio.gather(*[_check(r) for r in self.routes])
+        return any(r.ready for r in self.routes)
+
+    def export_ready_state(self) -> Dict[str, list]:
+        """导出各路线的就绪检查结果"""
+        return {r.name: [r.ready, r.ready_error] for r in self.routes}
+
+    def restore_ready_state(self, state: Dict[str, list]) -> bool:
+        """
+        使用启动脚本已完成的就绪检查结果，只在本地创建模型对象，不再访问网络
+
+        Returns:
+            是否至少有一条路线就绪
+        """
+        for route in self.routes:
+            route.get_model()
+            if route.name in state:
+                route.ready, route.ready_error = state[route.name]
+        return any(r.ready for r in self.routes)
+
+    def all_circuits_open(self) -> bool:
+        """是否所有路线都已熔断"""
+        return all(r.breaker.state == "open" for r in self.routes)
+
+    def min_retry_after(self) -> float:
+        """最早恢复的路线还需等待的秒数"""
+        return min(r.breaker.snapshot()["retry_after_seconds"] for r in self.routes)
+
+    def snapshot(self) -> dict:
+        """路由器当前状态（用于健康检查）"""
+        return {
+            "ready": any(r.ready for r in self.routes),
+            "cheap_traffic_ratio": self.cheap_traffic_ratio,
+            "routes": [r.snapshot() for r in self.routes]
+        }
+
+
+def _check_sdk_internals() -> None:
+    """检查按 Key 创建客户端依赖的 SDK 私有实现是否存在，版本与验证过的不同时给出警告"""
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+
+    version = getattr(genai, "__version__", "unknown")
+    if not hasattr(genai_client, "_ClientManager"):
+        raise RuntimeError(
+            f"google-generativeai {version} 不支持按 API Key 创建客户端"
+            f"（缺少 client._ClientManager），请安装 {SUPPORTED_SDK_VERSION} 版本"
+        )
+    if version != SUPPORTED_SDK_VERSION:
+        print(f"Warning: google-generativeai 版本为 {version}，按 API Key 创建客户端只在 {SUPPORTED_SDK_VERSION} 版本验证过")
+
+
+class _LazyClients:
+    """一个 API Key 的 Gemini 客户端管理器，第一次使用时才导入 SDK 并创建"""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._manager = None
+
+    def get_default_client(self, name: str):
+        if self._manager is None:
+            from google.generativeai import client as genai_client
+
+            _check_sdk_internals()
+            # 私有接口，见文件开头 SUPPORTED_SDK_VERSION 的说明
+            manager = genai_client._ClientManager()
+            manager.configure(api_key=self.api_key)
+            self._manager = manager
+        return self._manager.get_default_client(name)
+
+
+def _build_router() -> GeminiRouter:
+    """根据配置创建路由器；未配置 gemini_routes 时使用单个 gemini_api_key + gemini_model"""
+    configs = settings.gemini_routes or [
+        GeminiRouteConfig(api_key=settings.gemini_api_key, model=settings.gemini_model)
+    ]
+
+    # 同一个 Key 的多条路线共享客户端
+    clients_by_key: Dict[str, _LazyClients] = {}
+    routes = []
+    for config in configs:
+        if config.api_key not in clients_by_key:
+            clients_by_key[config.api_key] = _LazyClients(config.api_key)
+        routes.append(GeminiRoute(config, clients_by_key[config.api_key]))
+
+    return GeminiRouter(routes, cheap_traffic_ratio=settings.gemini_cheap_traffic_ratio)
+
+
+# 创建全局路由器实例
+gemini_router = _build_router()
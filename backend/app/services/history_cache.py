@@ -0,0 +1,59 @@
+"""
+历史记录响应缓存
+用户的历史记录只在保存新的分析结果时变化：按用户缓存列表页和详情的响应，
+写入时失效；响应带 ETag，客户端重新验证时返回 304
+"""
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Optional, Tuple
+from app.config import settings
+from app.services.cache import Cache, CacheNamespace
+
+
+def _namespace(cache: Cache) -> CacheNamespace:
+    return cache.namespace("history", ttl_seconds=settings.history_cache_ttl_seconds)
+
+
+def compute_etag(payload: Any) -> str:
+    """按响应内容计算强 ETag"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return f'"{hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 是否与 ETag 匹配（支持多个值、弱校验前缀和 *）"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+async def get_history_response(
+    cache: Cache,
+    user_id: str,
+    key: str,
+    loader: Callable[[], Awaitable[Any]]
+) -> Tuple[Any, str]:
+    """
+    获取缓存的历史记录响应，未命中时调用 loader 查询并缓存
+
+    Args:
+        cache: 服务层缓存
+        user_id: 用户ID（缓存按用户分组失效）
+        key: 用户内的缓存键（如列表的分页参数、详情的记录ID）
+        loader: 查询数据库并返回响应内容的函数
+
+    Returns:
+        (响应内容, ETag)
+    """
+    async def _load() -> dict:
+        payload = await loader()
+        return {"payload": payload, "etag": compute_etag(payload)}
+
+    entry = await _namespace(cache).get_or_load(key, _load, group=user_id)
+    return entry["payload"], entry["etag"]
+
+
+async def invalidate_history(cache: Cache, user_id: str) -> None:
+    """用户的分析记录新增或删除后，清除该用户的全部历史记录缓存"""
+    await _namespace(cache).invalidate(user_id)
@@ -0,0 +1,239 @@
+"""
+幂等请求存储
+客户端通过 Idempotency-Key 请求头标识一次操作，重试的请求复用进行中的任务或已保存的结果，
+避免重复处理视频、重复调用 Gemini 和重复扣除积分。
+
+CACHE_BACKEND=redis 时，进行中的标记和成功的结果同时保存在 Redis 中，重试落到其他 worker 也不会重新执行；
+memory 后端只在当前 worker 内有效
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+from fastapi import HTTPException, status
+from app.config import settings
+from app.services.cache import cache
+from app.services.progress_broker import join_progress, progress_jobs
+
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+
+
+class IdempotencyStore:
+    """
+    幂等存储（TTL + 容量上限），记录进行中和已完成的任务
+
+    进程内记录当前 worker 的任务（重试可以直接等待任务并接收进度）；
+    提供共享后端时，再通过后端在 worker 之间认领 Key 和共享结果
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int,
+        max_entries: int,
+        backend=None,
+        key_prefix: str = "idempotency",
+        in_flight_ttl_seconds: float = 600,
+        poll_interval_seconds: float = 0.2
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.backend = backend
+        self.key_prefix = key_prefix
+        self.in_flight_ttl_seconds = in_flight_ttl_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.replayed = 0
+        self.shared_replayed = 0
+        self.errors = 0
+
+    @staticmethod
+    def fingerprint(payload: dict) -> str:
+        """请求参数指纹，同一个 Key 只能用于参数相同的请求"""
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _evict(self) -> None:
+        """清理过期条目；超出容量时淘汰最早完成的条目（进行中的任务不淘汰）"""
+        now = time.time()
+        for key in [k for k, v in self._entries.items() if v["expires_at"] <= now]:
+            del self._entries[key]
+
+        if len(self._entries) > self.max_entries:
+            for key in [k for k, v in self._entries.items() if v["task"].done()]:
+                del self._entries[key]
+                if len(self._entries) <= self.max_entries:
+                    break
+
+    async def run(
+        self,
+        scope: str,
+        user_id: str,
+        idempotency_key: Optional[str],
+        payload: dict,
+        func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        以幂等方式执行操作
+
+        - 没有 Key：直接执行
+        - Key 首次出现：在独立任务中执行（客户端断开不会中断处理），成功结果保留 TTL
+        - Key 已存在：等待进行中的任务或直接返回已保存的结果；失败的结果不保留，重试会重新执行
+        - 有共享后端时，Key 在其他 worker 上进行中或已完成同样按已存在处理
+
+        Args:
+            scope: 操作类型（如 analysis.start），不同操作的 Key 互不影响
+            user_id: 用户ID，Key 按用户隔离
+            idempotency_key: 客户端提供的幂等 Key
+            payload: 用于计算请求指纹的参数
+            func: 实际执行的操作
+
+        Returns:
+            (操作结果, 是否为重放的结果)
+        """
+        if not idempotency_key:
+            return await func(), False
+
+        key = f"{scope}:{user_id}:{idempotency_key}"
+        fingerprint = self.fingerprint(payload)
+        self._evict()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry["fingerprint"] != fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="Idempotency-Key 已用于参数不同的请求"
+                )
+            self.replayed += 1
+            print(f"幂等请求重放: {scope}, key={idempotency_key}")
+            # 重试请求的进度任务也接收执行中任务的进度（已完成时回放全部事件）
+            join_progress(entry["progress"])
+            result, _ = await asyncio.shield(entry["task"])
+            return result, True
+
+        progress = progress_jobs()
+        task = asyncio.ensure_future(self._execute(key, fingerprint, func))
+        self._entries[key] = {
+            "task": task,
+            "progress": progress,
+            "fingerprint": fingerprint,
+            "expires_at": time.time() + self.ttl_seconds
+        }
+
+        def _on_done(t: "asyncio.Future") -> None:
+            # 失败（或被取消）的任务不保留，允许客户端重试
+            if t.cancelled() or t.exception() is not None:
+                if self._entries.get(key, {}).get("task") is t:
+                    del self._entries[key]
+
+        task.add_done_callback(_on_done)
+        return await asyncio.shield(task)
+
+    def _shared_key(self, key: str) -> str:
+        return f"{self.key_prefix}:{key}"
+
+    def _on_error(self, action: str, error: Exception) -> None:
+        self.errors += 1
+        print(f"Warning: 幂等记录{action}失败: {str(error)[:200]}")
+
+    async def _execute(
+        self,
+        key: str,
+        fingerprint: str,
+        func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        在共享后端认领 Key 后执行操作，返回 (操作结果, 是否为其他 worker 的结果)
+
+        其他 worker 已完成时直接返回其结果；正在执行时等待其完成，执行失败（标记被删除）或
+        标记过期（worker 退出）后由当前 worker 重新认领执行。共享后端不可用时按进程内处理
+        """
+        if self.backend is None:
+            return await func(), False
+
+        shared_key = self._shared_key(key)
+        running = json.dumps({"state": STATE_RUNNING, "fingerprint": fingerprint})
+        deadline = time.time() + self.in_flight_ttl_seconds
+        while True:
+            try:
+                if await self.backend.add(shared_key, running, self.in_flight_ttl_seconds):
+                    break
+                raw = await self.backend.get(shared_key)
+            except Exception as e:
+                self._on_error("读取", e)
+                return await func(), False
+
+            if raw is not None:
+                record = json.loads(raw)
+                if record["fingerprint"] != fingerprint:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail="Idempotency-Key 已用于参数不同的请求"
+                    )
+                if record["state"] == STATE_DONE:
+                    self.shared_replayed += 1
+                    print(f"幂等请求重放（其他 worker 的结果）: key={key}")
+                    return record["result"], True
+                if time.time() >= deadline:
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail="相同 Idempotency-Key 的请求正在处理，请稍后重试"
+                    )
+            await asyncio.sleep(self.poll_interval_seconds)
+
+        try:
+            result = await func()
+        except BaseException:
+            # 失败的结果不保留，其他 worker 上等待的重试会重新认领执行
+            try:
+                await self.backend.delete(shared_key)
+            except Exception as e:
+                self._on_error("删除", e)
+            raise
+
+        done = {"state": STATE_DONE, "fingerprint": fingerprint, "result": result}
+        try:
+            await self.backend.set(
+                shared_key, json.dumps(done, ensure_ascii=False, default=str), self.ttl_seconds
+            )
+        except Exception as e:
+            self._on_error("写入", e)
+        return result, False
+
+    def stats(self) -> dict:
+        """存储统计信息"""
+        in_flight = sum(1 for v in self._entries.values() if not v["task"].done())
+        return {
+            "backend": self.backend.name if self.backend is not None else "memory",
+            "size": len(self._entries),
+            "in_flight": in_flight,
+            "replayed": self.replayed,
+            "shared_replayed": self.shared_replayed,
+            "errors": self.errors
+        }
+
+
+def _shared_backend():
+    # memory 缓存后端也只在当前 worker 内有效，进程内记录已经覆盖
+    if cache.backend.name == "memory":
+        if settings.gemini_quota_workers > 1:
+            print(
+                f"⚠️ CACHE_BACKEND=memory 且有 {settings.gemini_quota_workers} 个 worker："
+                f"Idempotency-Key 只在同一 worker 内生效，重试落到其他 worker 时会重新执行（重复处理、重复扣积分），"
+                f"请使用 redis"
+            )
+        return None
+    return cache.backend
+
+
+# 创建全局幂等存储实例
+idempotency_store = IdempotencyStore(
+    ttl_seconds=settings.idempotency_ttl_seconds,
+    max_entries=settings.idempotency_max_entries,
+    backend=_shared_backend(),
+    key_prefix=f"{settings.cache_key_prefix}:idempotency",
+    in_flight_ttl_seconds=settings.idempotency_in_flight_ttl_seconds
+)
@@ -2,11 +2,22 @@
 积分服务
 处理积分相关的业务逻辑
 """
-from typing import Optional, List
+import asyncio
+import uuid
+from datetime import datetime, timezone
+from typing import Optional, List, Tuple
 from decimal import Decimal
 from fastapi import HTTPException, status
-from supabase import Client
+from app.database import Client
 from app.models.points import PointsTransaction, PurchaseRecord, PurchaseCreate, PointsAdjustRequest
+from app.services.write_batcher import write_batcher
+
+
+# 数据库中是否有 adjust_user_points 函数（None 未检查；尚未执行迁移时改用条件更新）
+_adjust_rpc_available: Optional[bool] = None
+
+# 条件更新因并发修改失败时的最大重试次数
+BALANCE_UPDATE_MAX_ATTEMPTS = 5
 
 
 class PointsService:
@@ -53,7 +64,8 @@ class PointsService:
         transaction_type: str,
         description: str,
         related_id: Optional[str] = None,
-        related_type: Optional[str] = None
+        related_type: Optional[str] = None,
+        write_behind: bool = False
     ) -> dict:
         """
         调整用户积分
@@ -65,45 +77,18 @@ class PointsService:
             description: 描述
             related_id: 关联ID
             related_type: 关联类型
+            write_behind: 交易记录是否通过批量写入器合并插入（余额仍然同步原子更新）
         
         Returns:
             积分交易记录
         """
         try:
-            # 1. 获取当前积分
-            user_response = self.db.table("users").select("points, total_points_earned, total_points_spent").eq("id", user_id).execute()
-            
-            if not user_response.data:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="用户不存在"
-                )
-            
-            user = user_response.data[0]
-            balance_before = user["points"]
-            balance_after = balance_before + points
-            
-            # 检查余额是否足够（如果是消费）
-            if balance_after < 0:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"积分不足，当前余额: {balance_before}，需要: {abs(points)}"
-                )
-            
-            # 2. 更新用户积分
-            update_data = {
-                "points": balance_after,
-                "updated_at": "now()"
-            }
-            
-            if points > 0:
-                update_data["total_points_earned"] = user["total_points_earned"] + points
-            else:
-                update_data["total_points_spent"] = user["total_points_spent"] + abs(points)
-            
-            self.db.table("users").update(update_data).eq("id", user_id).execute()
+            # 1. 原子更新余额（余额检查和更新在同一条语句中完成）
+            balance_before, balance_after = await asyncio.to_thread(
+                self._apply_balance_change, user_id, points, transaction_type
+            )
             
-            # 3. 记录积分交易
+            # 2. 记录积分交易
             transaction_data = {
                 "user_id": user_id,
                 "transaction_type": transaction_type,
@@ -115,6 +100,11 @@ class PointsService:
                 "related_type": related_type
             }
             
+            if write_behind:
+                transaction_data["id"] = str(uuid.uuid4())
+                transaction_data["created_at"] = datetime.now(timezone.utc).isoformat()
+                return await write_batcher.submit("points_transactions", transaction_data)
+            
             transaction_response = self.db.table("points_transactions").insert(transaction_data).execute()
             
             if not transaction_response.data:
@@ -130,6 +120,87 @@ class PointsService:
                 detail=f"调整积分失败: {str(e)}"
             )
     
+    def _apply_balance_change(self, user_id: str, points: int, transaction_type: str) -> Tuple[int, int]:
+        """
+        原子调整余额，返回 (交易前余额, 交易后余额)
+        
+        优先调用数据库函数 adjust_user_points（一次往返）；数据库尚未创建该函数时，
+        按读取到的余额做条件更新，余额已被并发修改时重新读取后重试
+        
+        Raises:
+            HTTPException: 用户不存在（404）或积分不足（400）
+        """
+        global _adjust_rpc_available
+        if _adjust_rpc_available is not False:
+            try:
+                response = self.db.rpc("adjust_user_points", {
+                    "p_user_id": user_id,
+                    "p_points": points,
+                    "p_transaction_type": transaction_type
+                }).execute()
+                _adjust_rpc_available = True
+            except Exception as e:
+                if "adjust_user_points" not in str(e) and "PGRST202" not in str(e):
+                    raise
+                print("数据库缺少 adjust_user_points 函数，改用条件更新（请执行 database_init_with_points.sql）")
+                _adjust_rpc_available = False
+            else:
+                if response.data:
+                    row = response.data[0]
+                    return row["balance_before"], row["balance_after"]
+                # 没有更新任何行：用户不存在或积分不足
+                self._raise_balance_error(self._get_balance(user_id), points)
+        
+        for _ in range(BALANCE_UPDATE_MAX_ATTEMPTS):
+            user = self._get_balance(user_id)
+            balance_before = user["points"]
+            balance_after = balance_before + points
+            if balance_after < 0:
+                self._raise_balance_error(user, points)
+            
+            update_data = {
+                "points": balance_after,
+                "updated_at": "now()"
+            }
+            if transaction_type == "refund":
+                # 退款冲减已消费的积分，不计入累计获得（累计获得用于判断付费用户）
+                update_data["total_points_spent"] = max(0, user["total_points_spent"] - points)
+            elif points > 0:
+                update_data["total_points_earned"] = user["total_points_earned"] + points
+            else:
+                update_data["total_points_spent"] = user["total_points_spent"] + abs(points)
+            
+            # 只有余额仍为读取时的值才更新，否则说明有并发修改，重新读取
+            response = self.db.table("users").update(update_data).eq("id", user_id).eq(
+                "points", balance_before
+            ).execute()
+            if response.data:
+                return balance_before, balance_after
+        
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="积分正在被其他操作修改，请稍后重试"
+        )
+    
+    def _get_balance(self, user_id: str) -> Optional[dict]:
+        """读取用户余额和累计积分，用户不存在时返回 None"""
+        response = self.db.table("users").select(
+            "points, total_points_earned, total_points_spent"
+        ).eq("id", user_id).execute()
+        return response.data[0] if response.data else None
+    
+    @staticmethod
+    def _raise_balance_error(user: Optional[dict], points: int) -> None:
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="用户不存在"
+            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"积分不足，当前余额: {user['points']}，需要: {abs(points)}"
+        )
+    
     async def get_user_transactions(
         self, 
         user_id: str, 
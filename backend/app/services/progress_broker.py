@@ -0,0 +1,211 @@
+"""
+任务进度广播
+上传、分析等耗时任务按阶段发布进度事件，客户端通过 SSE 订阅，避免长时间等待时反复重试
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional
+from app.config import settings
+
+
+# 任务阶段
+STAGE_RECEIVED = "received"          # 服务端已收到请求
+STAGE_TRANSCODING = "transcoding"    # 视频裁剪/压缩，或抽取关键帧
+STAGE_UPLOADED = "uploaded"          # 视频已上传到模型
+STAGE_MODEL_ACTIVE = "model_active"  # 模型侧文件处理完成
+STAGE_GENERATING = "generating"      # 模型生成中
+STAGE_PARTIAL = "partial"            # 流式生成的部分结果（已完整生成的字段）
+STAGE_SAVED = "saved"                # 结果已保存
+STAGE_FAILED = "failed"              # 任务失败
+
+TERMINAL_STAGES = (STAGE_SAVED, STAGE_FAILED)
+
+# 当前请求跟踪的任务键列表（在 track 中设置，服务层通过 report_progress 发布进度）；
+# 合并执行（single-flight、幂等重放）时，加入的请求把自己的任务键追加到执行方的列表中
+_current_jobs: ContextVar[Optional[List[str]]] = ContextVar("progress_jobs", default=None)
+
+
+class ProgressBroker:
+    """进程内任务进度广播器，保留每个任务最近的事件，订阅时先回放历史"""
+
+    def __init__(self, history_size: int, ttl_seconds: float):
+        self.history_size = history_size
+        self.ttl_seconds = ttl_seconds
+        self._jobs: Dict[str, dict] = {}
+        # 等待任务开始的订阅（只登记在等待期间，任务由 track / publish 创建，订阅不创建任务）
+        self._waiters: Dict[str, List["asyncio.Future"]] = {}
+
+    @staticmethod
+    def job_key(user_id: str, job_id: str) -> str:
+        """任务键按用户隔离，避免通过猜测任务 ID 订阅他人的进度"""
+        return f"{user_id}:{job_id}"
+
+    def _get_job(self, key: str) -> dict:
+        job = self._jobs.get(key)
+        if job is None:
+            self._evict_expired()
+            job = {
+                "events": deque(maxlen=self.history_size),
+                "subscribers": set(),
+                "updated_at": time.time()
+            }
+            self._jobs[key] = job
+            for waiter in self._waiters.pop(key, ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+        return job
+
+    def _evict_expired(self) -> None:
+        """清理长时间没有更新且无人订阅的任务"""
+        deadline = time.time() - self.ttl_seconds
+        expired = [
+            key for key, job in self._jobs.items()
+            if job["updated_at"] < deadline and not job["subscribers"]
+        ]
+        for key in expired:
+            del self._jobs[key]
+
+    def history(self, key: str) -> List[dict]:
+        """任务已发布的事件（任务不存在时返回空列表，不创建任务）"""
+        job = self._jobs.get(key)
+        return list(job["events"]) if job is not None else []
+
+    def publish(self, key: str, stage: str, **data) -> None:
+        """发布一个阶段事件"""
+        job = self._get_job(key)
+        event = {"stage": stage, "timestamp": time.time(), **data}
+        job["events"].append(event)
+        job["updated_at"] = event["timestamp"]
+        for queue in job["subscribers"]:
+            queue.put_nowait(event)
+
+    async def wait_for_job(self, key: str, timeout: float) -> bool:
+        """
+        等待任务开始（客户端可以先订阅再发起任务）
+
+        Returns:
+            任务是否存在；超时仍未开始时返回 False
+        """
+        if key in self._jobs:
+            return True
+        if timeout <= 0:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[key]
+        return key in self._jobs
+
+    async def subscribe(self, key: str, heartbeat_seconds: float) -> AsyncIterator[Optional[dict]]:
+        """
+        订阅任务进度，先回放已有事件，到达终止阶段后结束；任务不存在时直接结束
+
+        Yields:
+            进度事件；超过 heartbeat_seconds 没有新事件时产出 None（用于发送心跳）
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            return
+        queue: asyncio.Queue = asyncio.Queue()
+        for event in job["events"]:
+            queue.put_nowait(event)
+        job["subscribers"].add(queue)
+
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+
+                yield event
+                if event["stage"] in TERMINAL_STAGES:
+                    return
+        finally:
+            job["subscribers"].discard(queue)
+            job["updated_at"] = time.time()
+
+    @contextmanager
+    def track(self, user_id: str, job_id: Optional[str]):
+        """
+        在 with 块内跟踪一个任务：进入时发布 received，异常时发布 failed
+
+        块内调用的 report_progress 会发布到该任务；job_id 为空时不跟踪
+        """
+        if not job_id:
+            yield
+            return
+
+        key = self.job_key(user_id, job_id)
+        token = _current_jobs.set([key])
+        self.publish(key, STAGE_RECEIVED)
+        try:
+            yield
+        except Exception as e:
+            self.publish(key, STAGE_FAILED, error=getattr(e, "detail", None) or str(e))
+            raise
+        finally:
+            _current_jobs.reset(token)
+
+
+# 创建全局进度广播实例
+progress_broker = ProgressBroker(
+    history_size=settings.progress_history_size,
+    ttl_seconds=settings.progress_ttl_seconds
+)
+
+
+def is_tracking() -> bool:
+    """当前请求是否在跟踪任务进度（客户端可能正在订阅）"""
+    return bool(_current_jobs.get())
+
+
+def report_progress(stage: str, **data) -> None:
+    """向当前请求跟踪的任务（包括合并执行时加入的任务）发布进度，未跟踪时忽略"""
+    for key in list(_current_jobs.get() or ()):
+        progress_broker.publish(key, stage, **data)
+
+
+def progress_jobs() -> List[str]:
+    """
+    当前请求的任务键列表，合并执行时由执行方保存，加入方传给 join_progress
+
+    未跟踪任务时在当前上下文中创建空列表，之后创建的任务共享该列表，加入方的进度同样能发布
+    """
+    jobs = _current_jobs.get()
+    if jobs is None:
+        jobs = []
+        _current_jobs.set(jobs)
+    return jobs
+
+
+def join_progress(jobs: Optional[List[str]]) -> None:
+    """
+    当前请求加入其他请求正在执行（或已完成）的任务：先回放执行方已发布的事件，
+    之后的进度同时发布到当前请求跟踪的任务
+    """
+    own = _current_jobs.get()
+    if not own or jobs is None or own is jobs:
+        return
+    history = progress_broker.history(jobs[0]) if jobs else []
+    for key in own:
+        if key in jobs:
+            continue
+        for event in history:
+            if event["stage"] != STAGE_RECEIVED:
+                data = {k: v for k, v in event.items() if k not in ("stage", "timestamp")}
+                progress_broker.publish(key, event["stage"], **data)
+        jobs.append(key)
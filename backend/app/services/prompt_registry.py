@@ -0,0 +1,181 @@
+"""
+分析 Prompt 注册表
+按版本管理 Prompt 和对应的结构化输出 Schema，分析记录中保存所用版本，便于对比和回滚
+"""
+from typing import Dict, Optional, Type
+from pydantic import BaseModel
+from app.config import settings
+from app.models.analysis import AnalysisModelOutput
+
+
+# Gemini Schema 支持的字段（JSON Schema 中的 minimum/maximum/title 等不被接受）
+_SCHEMA_KEYS = {"type", "format", "description", "nullable", "enum", "items", "properties", "required"}
+_SCHEMA_KEY_ALIASES = {"maxItems": "max_items", "minItems": "min_items"}
+
+
+def _to_gemini_schema(schema: dict, defs: dict) -> dict:
+    """将 Pydantic 生成的 JSON Schema 转换为 Gemini response_schema 支持的子集"""
+    if "$ref" in schema:
+        schema = defs[schema["$ref"].split("/")[-1]]
+
+    # Optional[X] 生成 anyOf: [X, null]，转换为 nullable
+    any_of = schema.get("anyOf")
+    if any_of:
+        types = [s for s in any_of if s.get("type") != "null"]
+        merged = {k: v for k, v in schema.items() if k != "anyOf"}
+        merged.update(_to_gemini_schema(types[0], defs))
+        merged["nullable"] = True
+        schema = merged
+
+    result = {}
+    for key, value in schema.items():
+        if key == "properties":
+            result[key] = {name: _to_gemini_schema(prop, defs) for name, prop in value.items()}
+        elif key == "items":
+            result[key] = _to_gemini_schema(value, defs)
+        elif key in _SCHEMA_KEYS:
+            result[key] = value
+        elif key in _SCHEMA_KEY_ALIASES:
+            result[_SCHEMA_KEY_ALIASES[key]] = value
+    return result
+
+
+def build_response_schema(model: Type[BaseModel]) -> dict:
+    """根据 Pydantic 模型生成 Gemini response_schema（所有字段均要求输出）"""
+    json_schema = model.model_json_schema()
+    schema = _to_gemini_schema(json_schema, json_schema.get("$defs", {}))
+    # 顶层描述是模型类的文档字符串，对生成没有帮助
+    schema.pop("description", None)
+
+    def _require_all(node: dict) -> None:
+        if "properties" in node:
+            node["required"] = list(node["properties"].keys())
+            for prop in node["properties"].values():
+                _require_all(prop)
+        if "items" in node:
+            _require_all(node["items"])
+
+    _require_all(schema)
+    return schema
+
+
+class AnalysisPrompt:
+    """一个版本的分析 Prompt 及其生成配置"""
+
+    def __init__(
+        self,
+        version: str,
+        text: str,
+        output_model: Type[BaseModel] = AnalysisModelOutput,
+        use_response_schema: bool = True
+    ):
+        self.version = version
+        self.text = text
+        self.output_model = output_model
+        self.total_calls = 0
+        self.parse_failures = 0
+        self.output_tokens = 0
+        self.use_response_schema = use_response_schema
+        self._generation_config = None
+
+    @property
+    def generation_config(self):
+        """生成配置（第一次调用模型时才导入 SDK 并创建）"""
+        if self._generation_config is None:
+            import google.generativeai as genai
+
+            self._generation_config = genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=build_response_schema(self.output_model) if self.use_response_schema else None
+            )
+        return self._generation_config
+
+    def parse(self, text: str) -> BaseModel:
+        """校验模型返回的 JSON（pydantic-core 直接解析，不经过 json.loads）"""
+        return self.output_model.model_validate_json(text)
+
+    def record(self, response, parsed: bool) -> None:
+        """记录一次调用的输出 Token 数和解析结果，用于对比不同版本"""
+        self.total_calls += 1
+        if not parsed:
+            self.parse_failures += 1
+        usage = getattr(response, "usage_metadata", None)
+        self.output_tokens += getattr(usage, "candidates_token_count", None) or 0
+
+    def snapshot(self) -> dict:
+        """版本统计信息（用于健康检查）"""
+        return {
+            "version": self.version,
+            "total_calls": self.total_calls,
+            "parse_failures": self.parse_failures,
+            "avg_output_tokens": round(self.output_tokens / self.total_calls, 1) if self.total_calls else None
+        }
+
+
+# v1：最初的自由格式 Prompt，在文本中描述 JSON 结构，不约束输出
+PROMPT_V1 = """
+你是一位世界顶级的羽毛球科研专家和运动生物力学分析师。请对上传的视频进行极高精度的量化分析，结果必须严谨且经得住推敲。
+
+请执行以下思维过程来确保准确性：
+1. **视觉测距与物理建模**：
+   - 仔细观察视频中的环境参照物（标准羽毛球场长13.40米，宽6.10米，网高1.55米）。
+   - 估算羽毛球从击球点到落地点的飞行距离。
+   - 计算飞行时间，从而推算平均速度和初速度。
+2. **动作生物力学诊断**：
+   - 逐帧分析"鞭打动作"：检查力量是否从蹬地 -> 转髋 -> 展胸 -> 大臂 -> 小臂 -> 手腕 -> 手指顺畅传递。
+   - 观察击球点高度：是否在人体中轴线的前上方最高点。
+3. **数据合理性校验**：
+   - 业余初级：< 150 km/h
+   - 业余中高级：150 - 250 km/h
+   - 职业级：> 250 km/h
+   - 请根据视频中选手的动作流畅度和爆发力，给出符合物理常识的速度估算。
+
+请以 JSON 格式返回分析结果，包含以下字段（所有文本使用简体中文）：
+{
+  "speed": 整数(km/h),
+  "rank": 百分位排名(0-100),
+  "rank_position": 前X%,
+  "level": "技术等级",
+  "technique": {
+    "power": 发力评分(0-100),
+    "angle": 角度评分(0-100),
+    "coordination": 协调性评分(0-100)
+  },
+  "score": 综合评分(0-10),
+  "suggestions": [
+    {
+      "title": "建议标题",
+      "desc": "详细建议",
+      "icon": "Material图标名",
+      "highlight": "关键数据"
+    }
+  ]
+}
+"""
+
+# v2：输出结构由 response_schema 约束，Prompt 只保留分析方法和取值要求
+PROMPT_V2 = """
+你是顶级羽毛球运动生物力学分析师，请对视频中的杀球做量化分析，结果需符合物理常识。
+
+分析方法：
+1. 测速：以球场尺寸为参照（长13.40米，宽6.10米，网高1.55米），估算球的飞行距离和时间，推算初速度。
+2. 动作诊断：检查蹬地→转髋→展胸→大臂→小臂→手腕→手指的鞭打发力链，以及击球点是否在身体前上方最高点。
+3. 合理性校验：业余初级 < 150 km/h，业余中高级 150-250 km/h，职业级 > 250 km/h。
+
+输出要求：所有文本使用简体中文；rank 为百分位排名，rank_position 为"前 X%"中的 X；
+最多 3 条建议，按重要性排序，每条建议简洁具体。
+"""
+
+
+PROMPTS: Dict[str, AnalysisPrompt] = {
+    "v1": AnalysisPrompt("v1", PROMPT_V1, use_response_schema=False),
+    "v2": AnalysisPrompt("v2", PROMPT_V2),
+}
+
+
+def get_analysis_prompt(version: Optional[str] = None) -> AnalysisPrompt:
+    """获取指定版本的分析 Prompt，默认使用配置 analysis_prompt_version"""
+    version = version or settings.analysis_prompt_version
+    if version not in PROMPTS:
+        raise ValueError(f"未知的 Prompt 版本: {version}，可选: {', '.join(PROMPTS)}")
+    return PROMPTS[version]
@@ -0,0 +1,337 @@
+"""
+断点续传上传会话
+小程序按顺序上传分片（PUT + Upload-Offset），网络中断后查询已接收的字节数，从该位置继续上传，
+不必重新传输整个文件。会话保存在磁盘上（<upload_tmp_dir>/chunks/<upload_id>/），多个 worker 共享；
+已接收的字节数以数据文件大小为准，超过有效期未更新的会话自动清理
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Optional
+from fastapi import HTTPException, status
+from app.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境：不做跨进程加锁
+    fcntl = None
+
+
+# 会话状态
+STATE_UPLOADING = "uploading"
+STATE_PROCESSING = "processing"    # 最后一个分片已接收，正在处理视频
+STATE_COMPLETED = "completed"      # 处理完成，保留结果供客户端重试时读取
+
+# 分片校验支持的算法（Upload-Checksum: <算法> <Base64 摘要>）
+CHECKSUM_ALGORITHMS = ("sha256", "sha1", "md5")
+
+
+class UploadSessionStore:
+    """磁盘上的上传会话存储"""
+
+    META_FILE = "meta.json"
+    DATA_FILE = "data"
+
+    def __init__(self, root_dir: str, chunk_size: int, ttl_seconds: int):
+        self.root_dir = root_dir
+        self.chunk_size = chunk_size
+        self.ttl_seconds = ttl_seconds
+        self.cleaned = 0
+
+    def _session_dir(self, upload_id: str) -> str:
+        # upload_id 必须是 UUID，防止路径穿越
+        try:
+            upload_id = str(uuid.UUID(upload_id))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="上传会话不存在或已过期"
+            )
+        return os.path.join(self.root_dir, upload_id)
+
+    def _read_meta(self, session_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(session_dir, self.META_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, session_dir: str, meta: dict) -> None:
+        # 先写临时文件再替换，其他 worker 不会读到写了一半的内容
+        path = os.path.join(session_dir, self.META_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _load(self, upload_id: str, user_id: str) -> tuple:
+        """读取会话，返回 (会话目录, 会话信息)；不存在或不属于该用户时返回 404"""
+        session_dir = self._session_dir(upload_id)
+        meta = self._read_meta(session_dir)
+        if meta is None or meta["user_id"] != user_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="上传会话不存在或已过期"
+            )
+        return session_dir, meta
+
+    def _offset(self, session_dir: str, meta: dict) -> int:
+        if meta["state"] != STATE_UPLOADING:
+            return meta["size"]
+        try:
+            return os.path.getsize(os.path.join(session_dir, self.DATA_FILE))
+        except OSError:
+            return 0
+
+    def _status(self, session_dir: str, meta: dict) -> dict:
+        return {
+            "upload_id": meta["upload_id"],
+            "offset": self._offset(session_dir, meta),
+            "size": meta["size"],
+            "chunk_size": self.chunk_size,
+            "state": meta["state"],
+            "expires_at": meta["updated_at"] + self.ttl_seconds,
+            "job_id": meta["params"].get("job_id"),
+            "video": meta.get("result")
+        }
+
+    def create(self, user_id: str, filename: str, size: int, sha256: Optional[str], params: dict) -> dict:
+        """
+        创建上传会话
+
+        Args:
+            user_id: 用户ID
+            filename: 原始文件名
+            size: 文件总字节数
+            sha256: 可选，整个文件的 SHA-256（十六进制），接收完成后校验
+            params: 处理参数（裁剪范围、任务ID 等），最后一个分片到达后使用
+
+        Returns:
+            会话状态
+        """
+        self.cleanup_expired()
+
+        upload_id = str(uuid.uuid4())
+        session_dir = os.path.join(self.root_dir, upload_id)
+        os.makedirs(session_dir)
+        open(os.path.join(session_dir, self.DATA_FILE), "wb").close()
+
+        now = time.time()
+        meta = {
+            "upload_id": upload_id,
+            "user_id": user_id,
+            "filename": filename,
+            "size": size,
+            "sha256": sha256.lower() if sha256 else None,
+            "params": params,
+            "state": STATE_UPLOADING,
+            "created_at": now,
+            "updated_at": now
+        }
+        self._write_meta(session_dir, meta)
+        return self._status(session_dir, meta)
+
+    def get_status(self, upload_id: str, user_id: str) -> dict:
+        """查询会话状态（客户端断线重连后从返回的 offset 继续上传）"""
+        return self._status(*self._load(upload_id, user_id))
+
+    @staticmethod
+    def verify_checksum(data: bytes, checksum: Optional[str]) -> None:
+        """校验分片摘要（Upload-Checksum: <算法> <Base64 摘要>），未提供时跳过"""
+        if not checksum:
+            return
+        try:
+            algorithm, expected = checksum.strip().split(" ", 1)
+            algorithm = algorithm.lower()
+            expected_digest = base64.b64decode(expected.strip(), validate=True)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Upload-Checksum 格式错误，应为 \"<算法> <Base64 摘要>\""
+            )
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"不支持的校验算法。允许的算法: {', '.join(CHECKSUM_ALGORITHMS)}"
+            )
+        if hashlib.new(algorithm, data).digest() != expected_digest:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="分片校验失败，请重新上传该分片"
+            )
+
+    def write_chunk(self, upload_id: str, user_id: str, offset: int, data: bytes) -> tuple:
+        """
+        在 offset 位置追加一个分片（分片已通过校验）
+
+        offset 必须等于已接收的字节数，否则返回 409 和当前的 Upload-Offset；
+        同一会话的并发写入（包括其他 worker）返回 409，客户端查询状态后重试
+
+        Returns:
+            (会话状态, 当前请求是否接收了最后一个分片)；为 True 时由当前请求处理视频
+        """
+        session_dir, meta = self._load(upload_id, user_id)
+        if meta["state"] != STATE_UPLOADING:
+            return self._status(session_dir, meta), False
+
+        data_path = os.path.join(session_dir, self.DATA_FILE)
+        with open(data_path, "r+b") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail="该上传会话正在接收其他分片"
+                    )
+
+            # 加锁后重新读取状态，其他 worker 可能刚刚完成了上传
+            meta = self._read_meta(session_dir) or meta
+            if meta["state"] != STATE_UPLOADING:
+                return self._status(session_dir, meta), False
+
+            current = os.fstat(f.fileno()).st_size
+            if current == meta["size"]:
+                # 数据已全部接收，但上次处理被中断（release 后恢复为 uploading）：
+                # 客户端重试最后一个分片时不再写入，由当前请求重新处理
+                meta["state"] = STATE_PROCESSING
+                meta["updated_at"] = time.time()
+                self._write_meta(session_dir, meta)
+                return self._status(session_dir, meta), True
+            if offset != current:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"分片位置不匹配，已接收 {current} 字节",
+                    headers={"Upload-Offset": str(current)}
+                )
+            if current + len(data) > meta["size"]:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="分片超出文件大小"
+                )
+
+            f.seek(current)
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # 写入一半失败时回退到分片开始的位置，客户端重传该分片
+                f.truncate(current)
+                raise
+
+            finished = current + len(data) == meta["size"]
+            meta["updated_at"] = time.time()
+            if finished:
+                meta["state"] = STATE_PROCESSING
+            self._write_meta(session_dir, meta)
+
+        return self._status(session_dir, meta), finished
+
+    def claim_file(self, upload_id: str, user_id: str, dest_dir: str, unique_id: str) -> tuple:
+        """
+        校验整个文件的 SHA-256（创建会话时提供了才校验），并移动到 dest_dir
+
+        Returns:
+            (文件路径 <dest_dir>/<unique_id>.<扩展名>, 会话信息)
+        """
+        session_dir, meta = self._load(upload_id, user_id)
+        data_path = os.path.join(session_dir, self.DATA_FILE)
+
+        if meta["sha256"]:
+            digest = hashlib.sha256()
+            with open(data_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            if digest.hexdigest() != meta["sha256"]:
+                self.discard(upload_id)
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="文件校验失败，请重新上传"
+                )
+
+        file_ext = meta["filename"].rsplit('.', 1)[-1].lower()
+        dest_path = os.path.join(dest_dir, f"{unique_id}.{file_ext}")
+        shutil.move(data_path, dest_path)  # 与 upload_dir 不在同一文件系统时复制
+        return dest_path, meta
+
+    def release(self, upload_id: str, user_id: str, dest_dir: str, unique_id: str) -> None:
+        """
+        处理被中断（如请求被取消）时撤销 claim_file：把文件移回会话并恢复为 uploading，
+        客户端重试最后一个分片时重新处理；文件已不存在时从头接收
+        """
+        session_dir, meta = self._load(upload_id, user_id)
+        if meta["state"] != STATE_PROCESSING:
+            return
+
+        data_path = os.path.join(session_dir, self.DATA_FILE)
+        file_ext = meta["filename"].rsplit('.', 1)[-1].lower()
+        dest_path = os.path.join(dest_dir, f"{unique_id}.{file_ext}")
+        if os.path.exists(dest_path):
+            shutil.move(dest_path, data_path)
+        elif not os.path.exists(data_path):
+            open(data_path, "wb").close()
+
+        meta["state"] = STATE_UPLOADING
+        meta["updated_at"] = time.time()
+        self._write_meta(session_dir, meta)
+
+    def complete(self, upload_id: str, user_id: str, result: dict) -> dict:
+        """保存处理结果；会话保留到过期，最后一个分片的重试请求直接返回该结果"""
+        session_dir, meta = self._load(upload_id, user_id)
+        meta["state"] = STATE_COMPLETED
+        meta["result"] = json.loads(json.dumps(result, default=str))
+        meta["updated_at"] = time.time()
+        self._write_meta(session_dir, meta)
+        return self._status(session_dir, meta)
+
+    def delete(self, upload_id: str, user_id: str) -> None:
+        """取消上传会话，删除已接收的数据"""
+        session_dir, _ = self._load(upload_id, user_id)
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+    def discard(self, upload_id: str) -> None:
+        """删除会话（处理失败时调用，会话可能已被删除）"""
+        shutil.rmtree(self._session_dir(upload_id), ignore_errors=True)
+
+    def cleanup_expired(self) -> int:
+        """删除超过有效期未更新的会话（包括已完成的会话），返回删除的数量"""
+        if not os.path.isdir(self.root_dir):
+            return 0
+
+        deadline = time.time() - self.ttl_seconds
+        removed = 0
+        for name in os.listdir(self.root_dir):
+            session_dir = os.path.join(self.root_dir, name)
+            try:
+                # 会话目录中最后修改的文件时间即最后一次接收分片的时间
+                paths = [session_dir] + [os.path.join(session_dir, f) for f in os.listdir(session_dir)]
+                last_active = max(os.path.getmtime(path) for path in paths)
+            except OSError:
+                continue
+            if last_active < deadline:
+                shutil.rmtree(session_dir, ignore_errors=True)
+                removed += 1
+
+        self.cleaned += removed
+        return removed
+
+    def stats(self) -> dict:
+        """上传会话统计信息（用于健康检查）"""
+        try:
+            active = len(os.listdir(self.root_dir))
+        except OSError:
+            active = 0
+        return {"sessions": active, "cleaned": self.cleaned, "chunk_size": self.chunk_size}
+
+
+# 创建全局上传会话存储
+upload_sessions = UploadSessionStore(
+    root_dir=os.path.join(settings.upload_tmp_dir, "chunks"),
+    chunk_size=settings.upload_chunk_size_mb * 1024 * 1024,
+    ttl_seconds=settings.upload_session_ttl_seconds
+)
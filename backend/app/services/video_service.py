@@ -1,21 +1,33 @@
 """
 视频处理服务
 """
+import asyncio
 import os
+import time
 import uuid
-import httpx
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from fastapi import UploadFile, HTTPException, status
-from supabase import Client
+from app.database import Client
 from app.config import settings
-from app.utils.ffmpeg_helper import FFmpegHelper
-from app.utils.validators import validate_video_file, validate_video_size, validate_trim_range
+from app.services.progress_broker import STAGE_SAVED, STAGE_TRANSCODING, report_progress
+from app.services.upload_sessions import upload_sessions
+from app.utils.ffmpeg_helper import FFmpegHelper, transcode_slots
+from app.utils.ffmpeg_pipe import FFmpegPipe
+from app.utils.validators import validate_video_file, validate_video_size, validate_trim_bounds, validate_trim_range
+
+
+# 微信云托管内部接口：换取云存储文件的下载链接（一次最多 50 个文件）
+CLOUD_DOWNLOAD_API_URL = "http://api.weixin.qq.com/tcb/batchdownloadfile"
 
 
 class VideoService:
     """视频处理服务类"""
     
+    # 云存储下载的块大小，以及判断能否边下载边处理所需的文件开头长度
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024
+    STREAM_PROBE_BYTES = 64 * 1024
+    
     def __init__(self, db: Client):
         self.db = db
         self.upload_dir = settings.upload_dir
@@ -25,109 +37,436 @@ class VideoService:
         os.makedirs(os.path.join(self.upload_dir, "processed"), exist_ok=True)
         os.makedirs(os.path.join(self.upload_dir, "thumbnails"), exist_ok=True)
     
-    async def sync_cloud_video(
+    def _prepare_analysis_rendition(self, processed_path: str) -> Optional[str]:
+        """
+        生成 AI 分析用的轻量视频（失败不影响主流程）
+        
+        Returns:
+            分析视频路径，未生成时返回 None
+        """
+        if not settings.analysis_profile_enabled:
+            return None
+        
+        analysis_path = FFmpegHelper.get_analysis_rendition_path(processed_path)
+        try:
+            return FFmpegHelper.create_analysis_rendition(processed_path, analysis_path)
+        except Exception as e:
+            print(f"Warning: 分析视频生成失败: {str(e)}")
+            return None
+    
+    def _resolve_trim_range(
         self,
-        file_id: str,
+        file_path: str,
+        duration: float,
+        trim_start: Optional[float],
+        trim_end: Optional[float],
+        auto_trim: Optional[bool] = None,
+        motion_scores: Optional[list] = None
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """
+        确定视频裁剪范围
+        
+        手动指定了裁剪范围时校验后使用；否则在开启自动裁剪时，
+        检测运动最剧烈的片段作为裁剪范围
+        
+        Args:
+            file_path: 原始视频路径
+            duration: 原始视频时长
+            trim_start: 手动指定的裁剪起始时间
+            trim_end: 手动指定的裁剪结束时间
+            auto_trim: 是否自动裁剪，None 时使用配置 auto_trim_enabled
+            motion_scores: 已计算的逐帧运动强度（边下载边计算的结果），None 时重新计算
+        
+        Returns:
+            (trim_start, trim_end)，不裁剪时为 (None, None)
+        """
+        if trim_start is not None or trim_end is not None:
+            return validate_trim_range(trim_start, trim_end, duration)
+        
+        if auto_trim is None:
+            auto_trim = settings.auto_trim_enabled
+        if not auto_trim:
+            return None, None
+        
+        try:
+            segment = FFmpegHelper.detect_motion_segment(file_path, duration=duration, scores=motion_scores)
+        except Exception as e:
+            # 检测失败时不裁剪，不影响主流程
+            print(f"Warning: 杀球片段检测失败: {str(e)}")
+            return None, None
+        
+        if segment is None:
+            return None, None
+        
+        print(f"检测到杀球片段: {segment['start']}s - {segment['end']}s，峰值 {segment['peak']}s")
+        return validate_trim_range(segment['start'], segment['end'], duration)
+    
+    async def _start_pipe(self, args: List[str], head: bytes) -> Optional[FFmpegPipe]:
+        """
+        视频能顺序读取时启动 ffmpeg 并写入已下载的开头部分，否则返回 None
+        
+        启动的 ffmpeg 占用一个转码名额（由调用方在结束后释放）；名额已满时不等待，
+        返回 None，下载完成后再排队处理，避免下载被转码阻塞
+        """
+        if not FFmpegHelper.is_streamable(head):
+            return None
+        slots = transcode_slots()
+        if slots.locked():
+            return None
+        await slots.acquire()
+        try:
+            pipe = FFmpegPipe(args)
+            await pipe.start()
+            await pipe.feed(head)
+        except BaseException:
+            slots.release()
+            raise
+        return pipe
+    
+    async def _download_file(
+        self,
+        client,
+        download_url: str,
+        original_path: str,
+        streaming_args: Optional[List[str]] = None
+    ) -> Optional[bytes]:
+        """
+        下载文件到 original_path（文件写入在线程中执行，不阻塞事件循环）
+        
+        指定 streaming_args、视频能顺序读取且有空闲的转码名额时，下载的同时把数据写入该 ffmpeg 命令的 stdin，
+        处理与下载并行
+        
+        Returns:
+            ffmpeg 的 stdout 输出；没有边下载边处理或处理失败时返回 None，由调用方在下载完成后处理
+        """
+        pipe = None
+        head = bytearray()
+        try:
+            async with client.stream("GET", download_url) as r:
+                r.raise_for_status()
+                with open(original_path, "wb") as f:
+                    async for chunk in r.aiter_bytes(self.DOWNLOAD_CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+                        if pipe is not None:
+                            await pipe.feed(chunk)
+                        elif streaming_args is not None:
+                            head += chunk
+                            if len(head) >= self.STREAM_PROBE_BYTES:
+                                pipe = await self._start_pipe(streaming_args, bytes(head))
+                                streaming_args = None
+                    if streaming_args is not None and head:
+                        # 文件比探测长度还短
+                        pipe = await self._start_pipe(streaming_args, bytes(head))
+        except BaseException:
+            if pipe is not None:
+                try:
+                    await pipe.abort()
+                finally:
+                    transcode_slots().release()
+            raise
+        
+        if pipe is None:
+            return None
+        try:
+            return await pipe.finish()
+        except Exception as e:
+            print(f"Warning: 边下载边处理失败，改为下载完成后处理: {str(e)[-200:]}")
+            return None
+        except BaseException:
+            await pipe.abort()
+            raise
+        finally:
+            transcode_slots().release()
+    
+    async def _get_download_urls(self, client, file_ids: List[str]) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """
+        一次 batchdownloadfile 调用换取多个云存储文件的下载链接
+        
+        微信云托管内部可以通过该接口获取文件下载链接，无需额外鉴权
+        
+        Returns:
+            {file_id: (下载链接, 错误信息)}，获取失败的文件下载链接为 None
+        """
+        payload = {
+            "env": settings.wechat_cloud_env,
+            "file_list": [{"fileid": file_id, "max_age": 7200} for file_id in file_ids]
+        }
+        response = await client.post(CLOUD_DOWNLOAD_API_URL, json=payload)
+        res_data = response.json()
+        if res_data.get("errcode") != 0:
+            raise Exception(f"获取下载链接失败: {res_data.get('errmsg')}")
+        
+        urls = {}
+        for item in res_data.get("file_list") or []:
+            if item.get("status", 0) == 0 and item.get("download_url"):
+                urls[item["fileid"]] = (item["download_url"], None)
+            else:
+                urls[item.get("fileid")] = (None, item.get("errmsg") or "未返回下载链接")
+        return urls
+    
+    async def _sync_file(
+        self,
+        client,
+        download_url: str,
         user_id: str,
         trim_start: Optional[float] = None,
-        trim_end: Optional[float] = None
+        trim_end: Optional[float] = None,
+        auto_trim: Optional[bool] = None,
+        download_slots: Optional[asyncio.Semaphore] = None
     ) -> dict:
         """
-        从微信云存储同步视频并处理
+        下载一个云存储视频并处理、保存到数据库
+        
+        ffmpeg 处理在线程中执行，不阻塞事件循环（其他文件可以同时下载）；
+        同时进行的处理数受 cloud_sync_transcode_concurrency 限制
+        
+        Args:
+            download_slots: 批量同步的下载并发名额，只在下载期间占用，等待转码时已释放
         """
-        # 1. 微信云托管内部接口换取下载链接
-        # 微信云托管内部可以通过该地址获取文件下载链接，无需额外鉴权
-        try:
-            async with httpx.AsyncClient() as client:
-                # 微信云托管内部 API
-                cloud_api_url = "http://api.weixin.qq.com/tcb/batchdownloadfile"
-                payload = {
-                    "env": "cloud1-1grfk67f82062cc1",
-                    "file_list": [
-                        {
-                            "fileid": file_id,
-                            "max_age": 7200
-                        }
-                    ]
-                }
-                response = await client.post(cloud_api_url, json=payload)
-                res_data = response.json()
-                
-                if res_data.get("errcode") == 0 and res_data.get("file_list"):
-                    download_url = res_data["file_list"][0]["download_url"]
+        # 1. 下载文件到本地 original 目录
+        unique_id = str(uuid.uuid4())
+        stored_filename = f"{unique_id}.mp4"
+        original_path = os.path.join(self.upload_dir, "original", stored_filename)
+        processed_filename = f"{unique_id}_processed.mp4"
+        processed_path = os.path.join(self.upload_dir, "processed", processed_filename)
+        
+        # 能顺序读取的视频边下载边处理：已知裁剪范围（或不裁剪）时直接转码，
+        # 需要自动裁剪时先计算运动强度，下载完成后只需转码选中的片段
+        manual_trim = trim_start is not None or trim_end is not None
+        if manual_trim:
+            # 不依赖时长的检查在下载前完成，明显无效的范围不下载、不转码
+            validate_trim_bounds(trim_start, trim_end)
+        detect_motion = not manual_trim and (
+            auto_trim if auto_trim is not None else settings.auto_trim_enabled
+        )
+        streaming_args = None
+        if settings.cloud_sync_streaming_enabled:
+            try:
+                if detect_motion:
+                    streaming_args = FFmpegHelper.streaming_motion_scores_args()
                 else:
-                    raise Exception(f"获取下载链接失败: {res_data.get('errmsg')}")
-
-                # 2. 下载文件到本地 original 目录
-                unique_id = str(uuid.uuid4())
-                stored_filename = f"{unique_id}.mp4"
-                original_path = os.path.join(self.upload_dir, "original", stored_filename)
-                
-                async with client.stream("GET", download_url) as r:
-                    with open(original_path, "wb") as f:
-                        async for chunk in r.aiter_bytes():
-                            f.write(chunk)
-                
-                # 3. 后续处理（复用现有逻辑）
+                    streaming_args = FFmpegHelper.streaming_transcode_args(
+                        processed_path, trim_start, trim_end
+                    )
+            except RuntimeError as e:
+                print(f"Warning: {str(e)}")
+        
+        if download_slots is not None:
+            await download_slots.acquire()
+        try:
+            streamed_output = await self._download_file(
+                client, download_url, original_path, streaming_args
+            )
+        finally:
+            if download_slots is not None:
+                download_slots.release()
+        
+        # 2. 后续处理（复用现有逻辑）
+        try:
+            async with transcode_slots():
                 # 获取视频时长
-                video_info = FFmpegHelper.get_video_info(original_path)
+                video_info = await asyncio.to_thread(FFmpegHelper.get_video_info, original_path)
                 duration = video_info['duration']
+            
+                report_progress(STAGE_TRANSCODING)
+                if streamed_output is not None and not detect_motion:
+                    # 下载时已完成转码，按实际时长校验裁剪范围（保存校验后的值，如未指定的结束时间补为视频时长）
+                    trim_start, trim_end = await asyncio.to_thread(
+                        self._resolve_trim_range, original_path, duration, trim_start, trim_end, False
+                    )
+                    processed_info = await asyncio.to_thread(FFmpegHelper.get_video_info, processed_path)
+                else:
+                    # 确定裁剪范围（手动指定或自动检测杀球片段）
+                    motion_scores = None
+                    if streamed_output is not None:
+                        motion_scores = FFmpegHelper.parse_motion_scores(streamed_output)
+                    trim_start, trim_end = await asyncio.to_thread(
+                        self._resolve_trim_range,
+                        original_path, duration, trim_start, trim_end, auto_trim, motion_scores
+                    )
                 
-                # 处理视频
-                processed_filename = f"{unique_id}_processed.mp4"
-                processed_path = os.path.join(self.upload_dir, "processed", processed_filename)
-                
-                _, processed_info = FFmpegHelper.process_video(
-                    input_path=original_path,
-                    output_path=processed_path,
-                    trim_start=trim_start,
-                    trim_end=trim_end,
-                    compress=True
-                )
-                
-                # 生成缩略图
+                    # 处理视频
+                    _, processed_info = await asyncio.to_thread(
+                        FFmpegHelper.process_video,
+                        input_path=original_path,
+                        output_path=processed_path,
+                        trim_start=trim_start,
+                        trim_end=trim_end,
+                        compress=True
+                    )
+            
+                # 生成缩略图（多个尺寸、WebP 和动态预览，复用处理时获取的时长）
                 thumbnail_filename = f"{unique_id}_thumb.jpg"
                 thumbnail_path = os.path.join(self.upload_dir, "thumbnails", thumbnail_filename)
-                FFmpegHelper.generate_thumbnail(processed_path, thumbnail_path)
-                
-                # 保存数据库
-                video_data = {
-                    "user_id": user_id,
-                    "original_filename": f"cloud_{unique_id[:8]}.mp4",
-                    "stored_filename": processed_filename,
-                    "file_path": processed_path,
-                    "file_size": os.path.getsize(processed_path),
-                    "duration": processed_info['duration'],
-                    "thumbnail_path": thumbnail_path,
-                    "trim_start": trim_start or 0.0,
-                    "trim_end": trim_end,
-                }
-                
-                db_res = self.db.table("videos").insert(video_data).execute()
-                video_record = db_res.data[0]
+                await asyncio.to_thread(
+                    FFmpegHelper.generate_thumbnails,
+                    processed_path, thumbnail_path, duration=processed_info['duration']
+                )
+            
+                # 预先生成 AI 分析用的轻量视频
+                await asyncio.to_thread(self._prepare_analysis_rendition, processed_path)
+        except BaseException:
+            # 处理失败（包括裁剪范围超出视频时长）时清理文件，HTTPException 原样抛出
+            for path in (original_path, processed_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        
+        # 3. 保存数据库
+        video_data = {
+            "user_id": user_id,
+            "original_filename": f"cloud_{unique_id[:8]}.mp4",
+            "stored_filename": processed_filename,
+            "file_path": processed_path,
+            "file_size": os.path.getsize(processed_path),
+            "duration": processed_info['duration'],
+            "thumbnail_path": thumbnail_path,
+            "trim_start": trim_start or 0.0,
+            "trim_end": trim_end,
+        }
+        
+        db_res = self.db.table("videos").insert(video_data).execute()
+        video_record = db_res.data[0]
+        report_progress(STAGE_SAVED, video_id=video_record["id"])
+        
+        return {
+            "id": video_record["id"],
+            "original_filename": video_record["original_filename"],
+            "file_path": video_record["file_path"],
+            "duration": video_record["duration"],
+            "file_size": video_record["file_size"],
+            "thumbnail_path": video_record["thumbnail_path"],
+            "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(video_record["thumbnail_path"]),
+            "uploaded_at": video_record["uploaded_at"]
+        }
+    
+    async def sync_cloud_video(
+        self,
+        file_id: str,
+        user_id: str,
+        trim_start: Optional[float] = None,
+        trim_end: Optional[float] = None,
+        auto_trim: Optional[bool] = None
+    ) -> dict:
+        """
+        从微信云存储同步视频并处理
+        """
+        import httpx
+
+        try:
+            async with httpx.AsyncClient() as client:
+                urls = await self._get_download_urls(client, [file_id])
+                download_url, error = urls.get(file_id, (None, "未返回下载链接"))
+                if download_url is None:
+                    raise Exception(f"获取下载链接失败: {error}")
                 
-                return {
-                    "id": video_record["id"],
-                    "original_filename": video_record["original_filename"],
-                    "file_path": video_record["file_path"],
-                    "duration": video_record["duration"],
-                    "file_size": video_record["file_size"],
-                    "thumbnail_path": video_record["thumbnail_path"],
-                    "uploaded_at": video_record["uploaded_at"]
-                }
+                return await self._sync_file(
+                    client, download_url, user_id, trim_start, trim_end, auto_trim
+                )
+        except HTTPException:
+            # 裁剪范围无效等请求错误原样返回，不改为 500
+            raise
         except Exception as e:
             print(f"云存储视频同步失败: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"从云存储同步视频失败: {str(e)}"
             )
+    
+    def prepare_cloud_batch(self, files: List[dict]) -> List[dict]:
+        """
+        校验批量同步请求：按 file_id 去重、检查数量上限
+        
+        Returns:
+            去重后的文件列表
+        """
+        unique = {}
+        for item in files:
+            unique.setdefault(item["file_id"], item)
+        files = list(unique.values())
+        if len(files) > settings.cloud_sync_batch_max_files:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"单次最多同步 {settings.cloud_sync_batch_max_files} 个视频"
+            )
+        return files
+    
+    async def sync_cloud_videos_batch(self, files: List[dict], user_id: str) -> AsyncIterator[dict]:
+        """
+        批量同步云存储视频，按完成顺序逐个返回结果
+        
+        一次 batchdownloadfile 调用换取全部下载链接；下载并发数受 cloud_sync_download_concurrency 限制，
+        下载完成的文件进入转码（并发数受 cloud_sync_transcode_concurrency 限制），其他文件继续下载
+        
+        Yields:
+            每个文件的结果 {"type": "result", ...}，最后是汇总 {"type": "summary", ...}
+        """
+        import httpx
+
+        start_time = time.time()
+        # 下载名额在下载完成后立即释放，等待转码的文件不占用下载名额
+        download_slots = asyncio.Semaphore(max(1, settings.cloud_sync_download_concurrency))
+        
+        async with httpx.AsyncClient() as client:
+            url_error = "未返回下载链接"
+            try:
+                urls = await self._get_download_urls(client, [item["file_id"] for item in files])
+            except Exception as e:
+                print(f"云存储视频批量同步失败: {str(e)}")
+                urls, url_error = {}, str(e)
+            
+            async def _sync(index: int, item: dict) -> dict:
+                result = {"type": "result", "index": index, "file_id": item["file_id"]}
+                download_url, error = urls.get(item["file_id"], (None, url_error))
+                if download_url is None:
+                    return {**result, "status": "failed", "status_code": 502,
+                            "error": f"获取下载链接失败: {error}"}
+                try:
+                    video = await self._sync_file(
+                        client, download_url, user_id,
+                        item.get("trim_start"), item.get("trim_end"), item.get("auto_trim"),
+                        download_slots=download_slots
+                    )
+                    return {**result, "status": "success", "video": video}
+                except HTTPException as e:
+                    return {**result, "status": "failed", "status_code": e.status_code, "error": e.detail}
+                except Exception as e:
+                    print(f"云存储视频同步失败: {str(e)}")
+                    return {**result, "status": "failed", "status_code": 500,
+                            "error": f"从云存储同步视频失败: {str(e)}"}
+            
+            tasks = [asyncio.ensure_future(_sync(i, item)) for i, item in enumerate(files)]
+            succeeded = 0
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    item = await next_done
+                    if item["status"] == "success":
+                        succeeded += 1
+                    yield item
+                
+                duration = time.time() - start_time
+                print(f"批量同步完成: 共 {len(files)} 个，成功 {succeeded} 个，耗时 {duration:.2f} 秒")
+                yield {
+                    "type": "summary",
+                    "total": len(files),
+                    "succeeded": succeeded,
+                    "failed": len(files) - succeeded,
+                    "duration": round(duration, 2)
+                }
+            finally:
+                # 客户端断开时取消未完成的同步
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
     async def upload_video(
         self,
         file: UploadFile,
         user_id: str,
         trim_start: Optional[float] = None,
-        trim_end: Optional[float] = None
+        trim_end: Optional[float] = None,
+        auto_trim: Optional[bool] = None
     ) -> dict:
         """
         上传并处理视频
@@ -137,17 +476,40 @@ class VideoService:
             user_id: 用户ID
             trim_start: 裁剪起始时间
             trim_end: 裁剪结束时间
+            auto_trim: 未指定裁剪范围时是否自动截取杀球片段
         
         Returns:
             视频信息字典
         """
+        original_path, unique_id = await self.save_upload(file)
+        return await self.process_stored_video(
+            original_path=original_path,
+            original_filename=file.filename,
+            unique_id=unique_id,
+            user_id=user_id,
+            trim_start=trim_start,
+            trim_end=trim_end,
+            auto_trim=auto_trim
+        )
+    
+    async def save_upload(self, file: UploadFile) -> Tuple[str, str]:
+        """
+        校验上传的文件并流式保存到 original 目录
+        
+        上传的文件只在请求内有效，需要在请求结束后继续处理时（如幂等请求的独立任务）先调用本方法保存
+        
+        Args:
+            file: 上传的视频文件
+        
+        Returns:
+            (原始视频路径, 文件唯一ID)
+        """
         # 1. 验证文件
         validate_video_file(file)
         
         # 2. 生成唯一文件名
         file_ext = file.filename.rsplit('.', 1)[-1].lower()
         unique_id = str(uuid.uuid4())
-        original_filename = file.filename
         stored_filename = f"{unique_id}.{file_ext}"
         
         # 3. 保存原始文件
@@ -177,10 +539,55 @@ class VideoService:
             
             # 指针回到文件开头(如果后续还需要读取，但这里都是用路径处理了，所以不需要seek)
             # await file.seek(0)
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            # 清理可能的文件
+            if os.path.exists(original_path):
+                try:
+                    os.remove(original_path)
+                except:
+                    pass
             
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"上传视频失败: {str(e)}"
+            )
+        
+        return original_path, unique_id
+    
+    async def process_stored_video(
+        self,
+        original_path: str,
+        original_filename: str,
+        unique_id: str,
+        user_id: str,
+        trim_start: Optional[float] = None,
+        trim_end: Optional[float] = None,
+        auto_trim: Optional[bool] = None,
+        keep_original_on_error: bool = False
+    ) -> dict:
+        """
+        处理已保存到 original 目录的视频：裁剪压缩、生成缩略图并保存到数据库
+        
+        Args:
+            original_path: 原始视频路径
+            original_filename: 用户上传时的文件名
+            unique_id: 文件唯一ID（处理后的视频和缩略图以此命名）
+            user_id: 用户ID
+            trim_start: 裁剪起始时间
+            trim_end: 裁剪结束时间
+            auto_trim: 未指定裁剪范围时是否自动截取杀球片段
+            keep_original_on_error: 处理失败（非视频无效）时保留原始视频，由调用方决定是否重试
+        
+        Returns:
+            视频信息字典
+        """
+        try:
             # 4. 获取视频信息
             try:
-                video_info = FFmpegHelper.get_video_info(original_path)
+                video_info = await asyncio.to_thread(FFmpegHelper.get_video_info, original_path)
                 duration = video_info['duration']
             except Exception as e:
                 # 清理已保存的文件
@@ -191,30 +598,36 @@ class VideoService:
                     detail=f"无效的视频文件: {str(e)}"
                 )
             
-            # 5. 验证裁剪范围
-            if trim_start is not None or trim_end is not None:
-                trim_start, trim_end = validate_trim_range(trim_start, trim_end, duration)
+            # 5. 确定裁剪范围（手动指定或自动检测杀球片段；运动检测需要解码整个视频，在线程中执行）
+            report_progress(STAGE_TRANSCODING)
+            async with transcode_slots():
+                trim_start, trim_end = await asyncio.to_thread(
+                    self._resolve_trim_range,
+                    original_path, duration, trim_start, trim_end, auto_trim
+                )
             
-            # 6. 处理视频（裁剪 + 压缩）
+            # 6. 处理视频（裁剪 + 压缩，在线程中执行，占用转码名额）
             processed_filename = f"{unique_id}_processed.mp4"
             processed_path = os.path.join(self.upload_dir, "processed", processed_filename)
             
             try:
-                _, processed_info = FFmpegHelper.process_video(
-                    input_path=original_path,
-                    output_path=processed_path,
-                    trim_start=trim_start,
-                    trim_end=trim_end,
-                    compress=True,
-                    crf=28
-                )
+                async with transcode_slots():
+                    _, processed_info = await asyncio.to_thread(
+                        FFmpegHelper.process_video,
+                        input_path=original_path,
+                        output_path=processed_path,
+                        trim_start=trim_start,
+                        trim_end=trim_end,
+                        compress=True,
+                        crf=28
+                    )
                 
                 # 更新时长为处理后的时长
                 duration = processed_info['duration']
             
             except Exception as e:
                 # 清理文件
-                if os.path.exists(original_path):
+                if not keep_original_on_error and os.path.exists(original_path):
                     os.remove(original_path)
                 if os.path.exists(processed_path):
                     os.remove(processed_path)
@@ -224,17 +637,24 @@ class VideoService:
                     detail=f"视频处理失败: {str(e)}"
                 )
             
-            # 7. 生成缩略图
+            # 7. 生成缩略图（多个尺寸、WebP 和动态预览，复用处理时获取的时长；在线程中执行）
             thumbnail_filename = f"{unique_id}_thumb.jpg"
             thumbnail_path = os.path.join(self.upload_dir, "thumbnails", thumbnail_filename)
             
             try:
-                FFmpegHelper.generate_thumbnail(processed_path, thumbnail_path)
+                async with transcode_slots():
+                    await asyncio.to_thread(
+                        FFmpegHelper.generate_thumbnails, processed_path, thumbnail_path, duration=duration
+                    )
             except Exception as e:
                 # 缩略图生成失败不影响主流程
                 print(f"Warning: 缩略图生成失败: {str(e)}")
                 thumbnail_path = None
             
+            # 预先生成 AI 分析用的轻量视频，分析时可直接上传（转码在线程中执行，占用转码名额）
+            async with transcode_slots():
+                analysis_path = await asyncio.to_thread(self._prepare_analysis_rendition, processed_path)
+            
             # 8. 保存到数据库
             video_data = {
                 "user_id": user_id,
@@ -254,6 +674,7 @@ class VideoService:
                     raise Exception("数据库插入失败")
                 
                 video_record = response.data[0]
+                report_progress(STAGE_SAVED, video_id=video_record["id"])
                 
                 # 清理原始文件（可选，如果不需要保留）
                 # os.remove(original_path)
@@ -281,17 +702,22 @@ class VideoService:
                     "duration": video_record["duration"],
                     "file_size": video_record["file_size"],
                     "thumbnail_path": thumbnail_url,  # 返回 URL 而不是本地路径
+                    "thumbnails": FFmpegHelper.get_thumbnail_variant_urls(video_record.get("thumbnail_path")),
                     "uploaded_at": video_record["uploaded_at"]
                 }
             
             except Exception as e:
                 # 数据库操作失败，清理文件
-                if os.path.exists(original_path):
+                if not keep_original_on_error and os.path.exists(original_path):
                     os.remove(original_path)
                 if os.path.exists(processed_path):
                     os.remove(processed_path)
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    os.remove(thumbnail_path)
+                if thumbnail_path:
+                    for variant_path in FFmpegHelper.get_thumbnail_variant_paths(thumbnail_path).values():
+                        if os.path.exists(variant_path):
+                            os.remove(variant_path)
+                if analysis_path and os.path.exists(analysis_path):
+                    os.remove(analysis_path)
                 
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -302,7 +728,7 @@ class VideoService:
             raise
         except Exception as e:
             # 清理可能的文件
-            if os.path.exists(original_path):
+            if not keep_original_on_error and os.path.exists(original_path):
                 try:
                     os.remove(original_path)
                 except:
@@ -313,6 +739,64 @@ class VideoService:
                 detail=f"上传视频失败: {str(e)}"
             )
     
+    @staticmethod
+    def _release_upload(upload_id: str, user_id: str, original_dir: str, unique_id: str) -> None:
+        """把已认领的文件移回上传会话，客户端重试最后一个分片时重新处理"""
+        try:
+            upload_sessions.release(upload_id, user_id, original_dir, unique_id)
+        except Exception as e:
+            print(f"Warning: 恢复上传会话失败: {str(e)}")
+    
+    async def finish_chunked_upload(self, upload_id: str, user_id: str) -> dict:
+        """
+        分片上传的最后一个分片到达后立即处理视频
+        
+        校验整个文件并移动到 original 目录后按普通上传处理；处理结果保存在会话中，
+        客户端重试最后一个分片时直接返回。视频无效（4xx）时删除会话，客户端需重新上传；
+        其他失败（如数据库、ffmpeg 的临时错误）或请求被取消（如客户端断开、服务关闭）时文件移回会话，
+        客户端重试最后一个分片即可重新处理
+        
+        Args:
+            upload_id: 上传会话ID
+            user_id: 用户ID
+        
+        Returns:
+            会话状态（video 为视频信息）
+        """
+        unique_id = str(uuid.uuid4())
+        original_dir = os.path.join(self.upload_dir, "original")
+        original_path, session = await asyncio.to_thread(
+            upload_sessions.claim_file, upload_id, user_id, original_dir, unique_id
+        )
+        try:
+            params = session["params"]
+            result = await self.process_stored_video(
+                original_path=original_path,
+                original_filename=session["filename"],
+                unique_id=unique_id,
+                user_id=user_id,
+                trim_start=params.get("trim_start"),
+                trim_end=params.get("trim_end"),
+                auto_trim=params.get("auto_trim"),
+                keep_original_on_error=True
+            )
+        except HTTPException as e:
+            if e.status_code < 500:
+                # 视频本身无效（格式、时长、裁剪范围等），重试也不会成功
+                await asyncio.to_thread(upload_sessions.discard, upload_id)
+                if os.path.exists(original_path):
+                    os.remove(original_path)
+            else:
+                self._release_upload(upload_id, user_id, original_dir, unique_id)
+            raise
+        except BaseException:
+            # 临时错误或取消：恢复会话，避免一直停在 processing
+            # （同步执行：已取消的任务中再次 await 可能立即被取消）
+            self._release_upload(upload_id, user_id, original_dir, unique_id)
+            raise
+        
+        return await asyncio.to_thread(upload_sessions.complete, upload_id, user_id, result)
+    
     async def get_video(self, video_id: str, user_id: str) -> dict:
         """
         获取视频信息
@@ -0,0 +1,289 @@
+"""
+数据库批量写入
+并发请求的插入操作在短时间窗口内合并为多行插入，减少与 Supabase 的往返次数；
+因连接中断等临时错误写入失败时追加到本地 spool 文件，之后自动重放，保证记录不丢失。
+只用于写入后不需要立即读取的记录（如积分流水）：转存 spool 的行在重放前查询不到
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+from app.config import settings
+from app.database import Database
+
+
+# 临时错误：网关 5xx、超时和限流，以及数据库连接中断、资源不足、死锁等（SQLSTATE / PostgREST 连接错误）
+TRANSIENT_HTTP_STATUS = (408, 429)
+TRANSIENT_ERROR_CODES = ("08", "53", "57P", "40001", "40P01", "PGRST000", "PGRST001", "PGRST002", "PGRST003")
+
+
+def is_transient_error(error: Exception) -> bool:
+    """写入错误是否为临时错误（稍后重放可能成功）；约束冲突、字段错误等永久错误返回 False"""
+    from postgrest.exceptions import APIError
+    import httpx
+
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        if not code:
+            # PostgREST 的错误都带 code，没有 code 说明响应来自网关等中间层
+            return True
+        if code.isdigit() and len(code) == 3:
+            # 响应不是 JSON 时 code 为 HTTP 状态码
+            return int(code) >= 500 or int(code) in TRANSIENT_HTTP_STATUS
+        return code.startswith(TRANSIENT_ERROR_CODES)
+    return isinstance(error, (httpx.TransportError, OSError, TimeoutError))
+
+
+class WriteBatcher:
+    """
+    写后批量插入器（group commit）
+
+    submit 将一行数据放入队列并等待所在批次写入完成；同一批次中同一张表的行合并为一次多行插入。
+    行的主键由调用方生成，因临时错误写入失败时转存 spool 后视为成功，重放时按主键去重；
+    整批因永久错误失败时逐行重试，只有出错的行向调用方抛出异常，其他行正常写入
+    """
+
+    def __init__(
+        self,
+        interval_ms: int,
+        max_rows: int,
+        spool_path: str,
+        replay_interval_seconds: float,
+        optional_columns: Dict[str, Tuple[str, ...]] = None
+    ):
+        self.interval = interval_ms / 1000.0
+        self.max_rows = max_rows
+        self.spool_path = spool_path
+        self.replay_interval_seconds = replay_interval_seconds
+        self._last_replay_at = 0.0
+        # 旧数据库可能缺少的字段：插入报错提到这些字段时去掉后重试
+        self.optional_columns = optional_columns or {}
+        self._missing_columns: Dict[str, set] = {}
+        self._pending: List[Tuple[str, dict, "asyncio.Future"]] = []
+        self._wakeup: asyncio.Event = None
+        self._flusher: asyncio.Task = None
+        self._spool_lock = threading.Lock()
+        self.total_rows = 0
+        self.total_batches = 0
+        self.total_spooled = 0
+        self.total_rejected = 0
+
+    async def submit(self, table: str, row: dict) -> dict:
+        """提交一行插入，批次写入（或转存 spool）后返回该行"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((table, row, future))
+        self._ensure_flusher()
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+        return await asyncio.shield(future)
+
+    def _ensure_flusher(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        """等待一个时间窗口（或攒满一批）后写入，队列为空时退出"""
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            batch, self._pending = self._pending, []
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[str, dict, "asyncio.Future"]]) -> None:
+        by_table: Dict[str, List[Tuple[dict, "asyncio.Future"]]] = {}
+        for table, row, future in batch:
+            by_table.setdefault(table, []).append((row, future))
+
+        for table, items in by_table.items():
+            rows = [row for row, _ in items]
+            deferred, rejected = await asyncio.to_thread(self._write, table, rows)
+
+            # 按行记录失败原因：被拒绝的行，以及转存 spool 也失败的行
+            errors = {id(row): error for row, error in rejected}
+            if deferred:
+                print(f"批量写入 {table} 失败（{len(deferred)} 行），转存本地")
+                try:
+                    await asyncio.to_thread(self._spool, table, deferred)
+                except Exception as spool_error:
+                    errors.update({id(row): spool_error for row in deferred})
+
+            self.total_batches += 1
+            self.total_rows += len(rows) - len(errors)
+            for row, future in items:
+                if future.done():
+                    continue
+                if id(row) in errors:
+                    future.set_exception(errors[id(row)])
+                else:
+                    future.set_result(row)
+
+        # 数据库恢复后重放之前转存的写入
+        if (
+            os.path.exists(self.spool_path)
+            and time.time() - self._last_replay_at >= self.replay_interval_seconds
+        ):
+            self._last_replay_at = time.time()
+            await asyncio.to_thread(self.replay_spool)
+
+    async def drain(self) -> None:
+        """等待队列中的写入全部完成（应用关闭时调用）"""
+        if self._flusher is not None and not self._flusher.done():
+            self._wakeup.set()
+            await self._flusher
+
+    def _insert(self, table: str, rows: List[dict], upsert: bool = False) -> None:
+        """多行插入；字段缺少时补默认值而不是 null"""
+        from postgrest.types import ReturnMethod
+
+        db = Database.get_client()
+
+        def _execute(data: List[dict]) -> None:
+            builder = db.table(table)
+            if upsert:
+                builder.upsert(
+                    data, on_conflict="id", ignore_duplicates=True,
+                    returning=ReturnMethod.minimal, default_to_null=False
+                ).execute()
+            else:
+                builder.insert(data, returning=ReturnMethod.minimal, default_to_null=False).execute()
+
+        def _strip(data: List[dict]) -> List[dict]:
+            missing = self._missing_columns.get(table)
+            if not missing:
+                return data
+            return [{k: v for k, v in row.items() if k not in missing} for row in data]
+
+        try:
+            _execute(_strip(rows))
+        except Exception as e:
+            missing = [c for c in self.optional_columns.get(table, ()) if c in str(e)]
+            if not missing:
+                raise
+            # 记住缺少的字段，之后的批次直接去掉
+            print(f"{table} 表缺少字段 {', '.join(missing)}，去掉后重试")
+            self._missing_columns.setdefault(table, set()).update(missing)
+            _execute(_strip(rows))
+
+    def _write(self, table: str, rows: List[dict], upsert: bool = False) -> Tuple[List[dict], List[Tuple[dict, Exception]]]:
+        """
+        写入多行；整批因永久错误失败时逐行重试，找出出错的行，其他行照常写入
+
+        Returns:
+            (因临时错误未写入、需要转存 spool 的行, [(因永久错误被拒绝的行, 错误)])
+        """
+        try:
+            self._insert(table, rows, upsert=upsert)
+            return [], []
+        except Exception as e:
+            if is_transient_error(e):
+                return rows, []
+            if len(rows) == 1:
+                print(f"写入 {table} 失败（1 行）: {str(e)[:200]}")
+                return [], [(rows[0], e)]
+
+        deferred, rejected = [], []
+        for row in rows:
+            try:
+                self._insert(table, [row], upsert=upsert)
+            except Exception as e:
+                if is_transient_error(e):
+                    deferred.append(row)
+                else:
+                    print(f"写入 {table} 失败（1 行）: {str(e)[:200]}")
+                    rejected.append((row, e))
+        self.total_rejected += len(rejected)
+        return deferred, rejected
+
+    def _spool(self, table: str, rows: List[dict]) -> None:
+        """将写入失败的行追加到 spool 文件（每行一个 JSON）"""
+        with self._spool_lock:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps({"table": table, "row": row}, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.total_spooled += len(rows)
+
+    def _reject(self, table: str, rejected: List[Tuple[dict, Exception]]) -> None:
+        """把重放时被数据库拒绝的行追加到 <spool>.rejected 文件"""
+        with self._spool_lock:
+            with open(f"{self.spool_path}.rejected", "a", encoding="utf-8") as f:
+                for row, error in rejected:
+                    f.write(json.dumps(
+                        {"table": table, "row": row, "error": str(error)[:500]},
+                        ensure_ascii=False, default=str
+                    ) + "\n")
+        print(f"重放 {table} 时 {len(rejected)} 行被拒绝，已移到 {self.spool_path}.rejected")
+
+    def replay_spool(self) -> int:
+        """
+        重放 spool 文件中的写入（按主键去重）：临时错误的行写回 spool，被数据库拒绝的行移到 <spool>.rejected
+
+        Returns:
+            成功写入的行数
+        """
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return 0
+            # 多个 worker 共用 spool 文件，只有成功移走文件的 worker 负责重放
+            replay_path = f"{self.spool_path}.{os.getpid()}.{int(time.time())}.replay"
+            try:
+                os.replace(self.spool_path, replay_path)
+            except FileNotFoundError:
+                return 0
+
+        by_table: Dict[str, List[dict]] = {}
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    by_table.setdefault(item["table"], []).append(item["row"])
+
+        replayed = 0
+        for table, rows in by_table.items():
+            for start in range(0, len(rows), self.max_rows):
+                chunk = rows[start:start + self.max_rows]
+                deferred, rejected = self._write(table, chunk, upsert=True)
+                replayed += len(chunk) - len(deferred) - len(rejected)
+                if deferred:
+                    # 数据库仍不可用，写回 spool 等下次重放
+                    print(f"重放 {table} 写入失败（{len(deferred)} 行），稍后重试")
+                    self._spool(table, deferred)
+                    self.total_spooled -= len(deferred)
+                if rejected:
+                    # 永久错误的行重放也不会成功，移到 rejected 文件供人工处理，不阻塞其他行
+                    self._reject(table, rejected)
+
+        os.remove(replay_path)
+        if replayed:
+            print(f"已重放本地转存的数据库写入: {replayed} 行")
+        return replayed
+
+    def stats(self) -> dict:
+        """批量写入统计信息"""
+        return {
+            "pending": len(self._pending),
+            "total_rows": self.total_rows,
+            "total_batches": self.total_batches,
+            "avg_batch_size": round(self.total_rows / self.total_batches, 2) if self.total_batches else None,
+            "total_spooled": self.total_spooled,
+            "total_rejected": self.total_rejected
+        }
+
+
+# 创建全局批量写入实例
+write_batcher = WriteBatcher(
+    interval_ms=settings.db_batch_interval_ms,
+    max_rows=settings.db_batch_max_rows,
+    spool_path=settings.db_spool_path,
+    replay_interval_seconds=settings.db_spool_replay_seconds
+)
@@ -8,6 +8,7 @@ from app.utils.security import (
 from app.utils.validators import (
     validate_video_file,
     validate_video_size,
+    validate_trim_bounds,
     validate_trim_range
 )
 
@@ -18,5 +19,6 @@ __all__ = [
     "decode_access_token",
     "validate_video_file",
     "validate_video_size",
+    "validate_trim_bounds",
     "validate_trim_range",
 ]
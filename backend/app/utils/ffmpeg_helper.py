@@ -1,29 +1,144 @@
 """
 FFmpeg 视频处理工具
 """
+import asyncio
 import os
+import re
 import shutil
+import subprocess
+import threading
 import ffmpeg
-from typing import Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from app.config import settings
 
 
+# 每个 worker 同时进行的转码类 ffmpeg 任务数（云存储同步、上传处理和分析视频生成共用）
+_transcode_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def transcode_slots() -> asyncio.Semaphore:
+    """转码并发名额，在事件循环中首次使用时创建"""
+    global _transcode_semaphore
+    if _transcode_semaphore is None:
+        _transcode_semaphore = asyncio.Semaphore(max(1, settings.cloud_sync_transcode_concurrency))
+    return _transcode_semaphore
+
+
 class FFmpegHelper:
     """FFmpeg 视频处理辅助类"""
     
+    # 主缩略图宽度（数据库 thumbnail_path 指向的版本）
+    THUMBNAIL_WIDTH = 320
+    
+    # 探测的编码器和滤镜（H.264 编码器按优先顺序排列）
+    H264_ENCODERS = ('libx264', 'libopenh264')
+    PROBED_ENCODERS = H264_ENCODERS + ('aac', 'libwebp', 'libaom-av1', 'libsvtav1')
+    PROBED_FILTERS = ('scdet', 'split', 'fps', 'scale')
+    
+    # 一次性探测结果（二进制路径、版本、可用编码器和滤镜），探测成功后不再扫描 PATH
+    _capabilities: Optional[dict] = None
+    _probe_lock = threading.Lock()
+    
     @staticmethod
-    def _check_ffmpeg_installed():
-        """检查 FFmpeg 是否已安装"""
-        ffmpeg_path = shutil.which('ffmpeg')
-        ffprobe_path = shutil.which('ffprobe')
+    def capabilities() -> Optional[dict]:
+        """已缓存的探测结果（用于健康检查，不触发探测），尚未探测时返回 None"""
+        return FFmpegHelper._capabilities
+    
+    @staticmethod
+    def probe_capabilities(refresh: bool = False) -> dict:
+        """
+        探测 FFmpeg 的路径、版本、可用编码器和滤镜（结果缓存，启动时调用一次）
         
-        if not ffmpeg_path or not ffprobe_path:
+        Args:
+            refresh: 是否忽略缓存重新探测
+        
+        Returns:
+            探测结果；未安装时 installed 为 False
+        """
+        if FFmpegHelper._capabilities is not None and not refresh:
+            return FFmpegHelper._capabilities
+        
+        with FFmpegHelper._probe_lock:
+            if FFmpegHelper._capabilities is not None and not refresh:
+                return FFmpegHelper._capabilities
+            
+            ffmpeg_path = shutil.which('ffmpeg')
+            ffprobe_path = shutil.which('ffprobe')
+            capabilities = {
+                "installed": bool(ffmpeg_path and ffprobe_path),
+                "ffmpeg_path": ffmpeg_path,
+                "ffprobe_path": ffprobe_path,
+                "version": None,
+                "encoders": {},
+                "filters": {},
+                "h264_encoder": None
+            }
+            if not capabilities["installed"]:
+                # 未安装时不缓存，安装后无需重启即可使用
+                return capabilities
+            
+            def _list(option: str) -> str:
+                result = subprocess.run(
+                    [ffmpeg_path, '-hide_banner', option],
+                    capture_output=True, text=True, timeout=10
+                )
+                return result.stdout
+            
+            try:
+                version_line = _list('-version').splitlines()[0]
+                capabilities["version"] = version_line.split(' ')[2] if version_line.startswith('ffmpeg version') else version_line
+                # 每行格式: " V....D libx264   描述"，第二列为名称
+                encoders = {line.split()[1] for line in _list('-encoders').splitlines()[1:] if len(line.split()) > 1}
+                filters = {line.split()[1] for line in _list('-filters').splitlines() if len(line.split()) > 1}
+            except (OSError, subprocess.SubprocessError, IndexError) as e:
+                # 探测失败时不缓存，按默认编码器处理，下次调用重新探测
+                print(f"Warning: FFmpeg 能力探测失败: {str(e)}")
+                return capabilities
+            
+            capabilities["encoders"] = {name: name in encoders for name in FFmpegHelper.PROBED_ENCODERS}
+            capabilities["filters"] = {name: name in filters for name in FFmpegHelper.PROBED_FILTERS}
+            capabilities["h264_encoder"] = next(
+                (name for name in FFmpegHelper.H264_ENCODERS if name in encoders), 'libx264'
+            )
+            FFmpegHelper._capabilities = capabilities
+            return capabilities
+    
+    @staticmethod
+    def _check_ffmpeg_installed() -> dict:
+        """检查 FFmpeg 是否已安装（使用缓存的探测结果），返回探测结果"""
+        capabilities = FFmpegHelper.probe_capabilities()
+        
+        if not capabilities["installed"]:
             error_msg = "FFmpeg 未安装或不在 PATH 中。"
             error_msg += "\n请安装 FFmpeg："
             error_msg += "\n  macOS: brew install ffmpeg"
             error_msg += "\n  Ubuntu/Debian: sudo apt-get install ffmpeg"
             error_msg += "\n  Windows: 下载 https://ffmpeg.org/download.html"
             raise RuntimeError(error_msg)
+        return capabilities
+    
+    @staticmethod
+    def _ffmpeg_cmd() -> str:
+        """ffmpeg 可执行文件的绝对路径（调用时不再扫描 PATH）"""
+        return FFmpegHelper._check_ffmpeg_installed()["ffmpeg_path"]
+    
+    @staticmethod
+    def _h264_options(crf: int, preset: str, video_bitrate: Optional[int] = None) -> dict:
+        """
+        H.264 编码参数：优先 libx264（CRF 模式）；
+        ffmpeg 未编译 libx264 时使用 libopenh264（不支持 CRF，按 CRF 换算码率）；
+        指定 video_bitrate 时两种编码器都按该码率编码
+        """
+        encoder = FFmpegHelper._check_ffmpeg_installed()["h264_encoder"]
+        if video_bitrate is not None:
+            if encoder == 'libopenh264':
+                return {'vcodec': encoder, 'video_bitrate': video_bitrate}
+            return {'vcodec': 'libx264', 'video_bitrate': video_bitrate, 'preset': preset}
+        if encoder == 'libopenh264':
+            # CRF 每增加 6 码率约减半，CRF 28 约 1.4 Mbps
+            bitrate_kbps = int(100 * 2 ** ((51 - crf) / 6))
+            return {'vcodec': encoder, 'video_bitrate': f"{bitrate_kbps}k"}
+        return {'vcodec': 'libx264', 'crf': crf, 'preset': preset}
     
     @staticmethod
     def get_video_info(file_path: str) -> dict:
@@ -38,12 +153,12 @@ class FFmpegHelper:
         """
         try:
             # 检查 FFmpeg 是否安装
-            FFmpegHelper._check_ffmpeg_installed()
+            capabilities = FFmpegHelper._check_ffmpeg_installed()
             
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"视频文件不存在: {file_path}")
             
-            probe = ffmpeg.probe(file_path)
+            probe = ffmpeg.probe(file_path, cmd=capabilities["ffprobe_path"])
             video_stream = next(
                 (stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
                 None
@@ -97,7 +212,7 @@ class FFmpegHelper:
                     avoid_negative_ts='make_zero'
                 )
                 .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True, quiet=True)
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
             )
         
         except ffmpeg.Error as e:
@@ -137,13 +252,12 @@ class FFmpegHelper:
                     .input(input_path)
                     .output(
                         output_path,
-                        video_bitrate=video_bitrate,
+                        **FFmpegHelper._h264_options(crf, 'medium', video_bitrate=video_bitrate),
                         audio_bitrate='128k',
-                        vcodec='libx264',
                         acodec='aac'
                     )
                     .overwrite_output()
-                    .run(capture_stdout=True, capture_stderr=True, quiet=True)
+                    .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
                 )
             else:
                 # 使用 CRF 模式压缩
@@ -152,14 +266,12 @@ class FFmpegHelper:
                     .input(input_path)
                     .output(
                         output_path,
-                        vcodec='libx264',
-                        crf=crf,
-                        preset='medium',
+                        **FFmpegHelper._h264_options(crf, 'medium'),
                         acodec='aac',
                         audio_bitrate='128k'
                     )
                     .overwrite_output()
-                    .run(capture_stdout=True, capture_stderr=True, quiet=True)
+                    .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
                 )
         
         except ffmpeg.Error as e:
@@ -190,16 +302,500 @@ class FFmpegHelper:
             (
                 ffmpeg
                 .input(video_path, ss=time_offset)
-                .filter('scale', 320, -1)  # 宽度320px，高度自适应
+                .filter('scale', FFmpegHelper.THUMBNAIL_WIDTH, -1)  # 宽度320px，高度自适应
                 .output(thumbnail_path, vframes=1)
                 .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True, quiet=True)
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
             )
         
         except ffmpeg.Error as e:
             error_message = e.stderr.decode() if e.stderr else str(e)
             raise Exception(f"生成缩略图失败: {error_message}")
     
+    @staticmethod
+    def get_thumbnail_variant_paths(thumbnail_path: str) -> Dict[str, str]:
+        """
+        获取缩略图各个版本的文件路径（与主缩略图同目录，文件名以主缩略图为前缀）
+
+        Returns:
+            {版本名: 文件路径}，如 jpg_160、jpg_320（即主缩略图）、webp_320、preview
+        """
+        base = os.path.splitext(thumbnail_path)[0]
+        paths = {}
+        for width in sorted(set(settings.thumbnail_sizes_list) | {FFmpegHelper.THUMBNAIL_WIDTH}):
+            if width == FFmpegHelper.THUMBNAIL_WIDTH:
+                paths[f"jpg_{width}"] = thumbnail_path
+            else:
+                paths[f"jpg_{width}"] = f"{base}_{width}.jpg"
+        if settings.thumbnail_webp_enabled:
+            paths[f"webp_{FFmpegHelper.THUMBNAIL_WIDTH}"] = f"{base}.webp"
+        if settings.thumbnail_preview_enabled:
+            paths["preview"] = f"{base}_preview.webp"
+        return paths
+
+    @staticmethod
+    def get_thumbnail_variant_urls(thumbnail_path: Optional[str]) -> Optional[Dict[str, str]]:
+        """
+        获取已生成的缩略图版本的访问 URL（客户端按需选择最小的版本）
+
+        Args:
+            thumbnail_path: 数据库中保存的主缩略图路径
+
+        Returns:
+            {版本名: /uploads/thumbnails/... URL}，没有缩略图时返回 None
+        """
+        if not thumbnail_path:
+            return None
+        variants = {}
+        for name, path in FFmpegHelper.get_thumbnail_variant_paths(thumbnail_path).items():
+            if os.path.exists(path):
+                variants[name] = f"/uploads/thumbnails/{os.path.basename(path)}"
+        return variants or None
+
+    @staticmethod
+    def generate_thumbnails(
+        video_path: str,
+        thumbnail_path: str,
+        duration: Optional[float] = None,
+        time_offset: Optional[float] = None
+    ) -> Dict[str, str]:
+        """
+        一次 ffmpeg 调用生成全部缩略图版本：多个尺寸的 JPEG、WebP 版本和动态预览
+
+        解码一次、通过 split 滤镜分发给各个输出；主缩略图（宽 320 的 JPEG）路径与
+        generate_thumbnail 相同，数据库中保存的 thumbnail_path 不变
+
+        Args:
+            video_path: 视频文件路径
+            thumbnail_path: 主缩略图保存路径
+            duration: 视频时长（秒），传入处理视频时已获取的时长可避免再次 ffprobe
+            time_offset: 截取时间点（秒），如果为None则取视频中间帧
+
+        Returns:
+            {版本名: 文件路径}
+        """
+        capabilities = FFmpegHelper._check_ffmpeg_installed()
+        if duration is None:
+            duration = FFmpegHelper.get_video_info(video_path)['duration']
+        if time_offset is None:
+            time_offset = duration / 2
+        # ffmpeg 未编译 libwebp 时直接只生成 JPEG 版本，不必先失败一次
+        webp_supported = capabilities["encoders"].get("libwebp", True)
+
+        # 只解码动态预览需要的片段（以截图时间点为中心）
+        preview_seconds = min(settings.thumbnail_preview_seconds, duration)
+        start = max(0.0, min(time_offset - preview_seconds / 2, duration - preview_seconds))
+        paths = FFmpegHelper.get_thumbnail_variant_paths(thumbnail_path)
+
+        def _run(include_webp: bool) -> Dict[str, str]:
+            outputs = {
+                name: path for name, path in paths.items()
+                if include_webp or name.startswith("jpg_")
+            }
+            split = (
+                ffmpeg
+                .input(video_path, ss=start, t=max(preview_seconds, 0.1))
+                .video
+                .split()
+            )
+            streams = []
+            for i, (name, path) in enumerate(outputs.items()):
+                branch = split[i]
+                if name == "preview":
+                    streams.append(
+                        branch
+                        .filter('fps', fps=settings.thumbnail_preview_fps)
+                        .filter('scale', settings.thumbnail_preview_width, -2)
+                        .output(path, vcodec='libwebp', loop=0, quality=60)
+                    )
+                    continue
+
+                width = int(name.split("_")[1])
+                still = (
+                    branch
+                    .trim(start=time_offset - start)
+                    .setpts('PTS-STARTPTS')
+                    .filter('scale', width, -2)
+                )
+                if name.startswith("webp_"):
+                    streams.append(still.output(path, vframes=1, vcodec='libwebp', quality=80))
+                else:
+                    streams.append(still.output(path, vframes=1, **{'q:v': 3}))
+
+            (
+                ffmpeg
+                .merge_outputs(*streams)
+                .overwrite_output()
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
+            )
+            return outputs
+
+        if webp_supported:
+            try:
+                return _run(include_webp=True)
+            except ffmpeg.Error as e:
+                error_message = e.stderr.decode() if e.stderr else str(e)
+                if not (settings.thumbnail_webp_enabled or settings.thumbnail_preview_enabled):
+                    raise Exception(f"生成缩略图失败: {error_message}")
+                print(f"Warning: WebP 缩略图生成失败，只生成 JPEG: {error_message[-200:]}")
+
+        try:
+            return _run(include_webp=False)
+        except ffmpeg.Error as e:
+            error_message = e.stderr.decode() if e.stderr else str(e)
+            raise Exception(f"生成缩略图失败: {error_message}")
+
+    @staticmethod
+    def get_motion_scores(file_path: str) -> List[Tuple[float, float]]:
+        """
+        计算逐帧运动强度
+
+        使用低分辨率解码 + scdet 滤镜，读取每帧与上一帧的平均绝对差（mafd）
+
+        Args:
+            file_path: 视频文件路径
+
+        Returns:
+            [(时间点秒, 运动强度), ...]，按时间排序
+        """
+        try:
+            FFmpegHelper._check_ffmpeg_installed()
+
+            out, _ = (
+                FFmpegHelper._motion_scores_stream(file_path)
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
+            )
+
+        except ffmpeg.Error as e:
+            error_message = e.stderr.decode() if e.stderr else str(e)
+            raise Exception(f"计算运动强度失败: {error_message}")
+
+        return FFmpegHelper.parse_motion_scores(out)
+
+    @staticmethod
+    def _motion_scores_stream(source: str):
+        """运动强度计算的 ffmpeg 命令（结果输出到 stdout），source 为文件路径或 pipe:0"""
+        return (
+            ffmpeg
+            .input(source)
+            .filter('scale', 160, -2)
+            .filter('scdet')
+            .filter('metadata', mode='print', file='-')
+            .output('-', format='null')
+        )
+
+    @staticmethod
+    def parse_motion_scores(out: bytes) -> List[Tuple[float, float]]:
+        """解析 metadata 滤镜输出的逐帧运动强度，返回 [(时间点秒, 运动强度), ...]"""
+        scores = []
+        current_time = None
+        for line in out.decode(errors='ignore').splitlines():
+            line = line.strip()
+            if line.startswith('frame:'):
+                match = re.search(r'pts_time:(\S+)', line)
+                current_time = float(match.group(1)) if match else None
+            elif line.startswith('lavfi.scd.mafd=') and current_time is not None:
+                scores.append((current_time, float(line.split('=', 1)[1])))
+
+        return scores
+
+    @staticmethod
+    def detect_motion_segment(
+        file_path: str,
+        window_seconds: Optional[float] = None,
+        duration: Optional[float] = None,
+        scores: Optional[List[Tuple[float, float]]] = None
+    ) -> Optional[dict]:
+        """
+        检测运动最剧烈的时间窗口（即杀球片段）
+
+        Args:
+            file_path: 视频文件路径
+            window_seconds: 窗口长度（秒），默认取配置 auto_trim_window_seconds
+            duration: 视频总时长，未指定时自动获取
+            scores: 已计算的逐帧运动强度（如下载时边下载边计算的结果），未指定时计算
+
+        Returns:
+            {'start': 起始秒, 'end': 结束秒, 'peak': 运动峰值时间点}，
+            视频本身不长于窗口或无法检测时返回 None
+        """
+        window_seconds = window_seconds or settings.auto_trim_window_seconds
+        if duration is None:
+            duration = FFmpegHelper.get_video_info(file_path)['duration']
+
+        if duration <= window_seconds:
+            return None
+
+        if scores is None:
+            scores = FFmpegHelper.get_motion_scores(file_path)
+        if not scores:
+            return None
+
+        # 滑动窗口求运动强度之和最大的区间
+        best_sum = -1.0
+        best_start = 0.0
+        window_sum = 0.0
+        left = 0
+        for time_point, score in scores:
+            window_sum += score
+            while time_point - scores[left][0] > window_seconds:
+                window_sum -= scores[left][1]
+                left += 1
+            if window_sum > best_sum:
+                best_sum = window_sum
+                best_start = scores[left][0]
+
+        if best_sum <= 0:
+            return None
+
+        # 以窗口内运动强度的加权中心为中点重新定位，避免片段偏向一侧
+        in_window = [
+            item for item in scores
+            if best_start <= item[0] <= best_start + window_seconds
+        ]
+        centroid = sum(t * s for t, s in in_window) / sum(s for _, s in in_window)
+        peak = max(in_window, key=lambda item: item[1])[0]
+
+        start = round(max(0.0, min(centroid - window_seconds / 2, duration - window_seconds)), 3)
+        end = min(round(start + window_seconds, 3), duration)
+
+        return {
+            'start': start,
+            'end': end,
+            'peak': round(peak, 3)
+        }
+
+    @staticmethod
+    def get_analysis_rendition_path(video_path: str) -> str:
+        """获取视频对应的分析版本文件路径"""
+        return os.path.splitext(video_path)[0] + "_analysis.mp4"
+
+    @staticmethod
+    def _scaled_size(width: int, height: int, max_resolution: int) -> Tuple[int, int]:
+        """按短边不超过 max_resolution 等比缩放，宽高取偶数"""
+        short_side = min(width, height)
+        if short_side <= max_resolution:
+            scale = 1.0
+        else:
+            scale = max_resolution / short_side
+        return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2
+
+    @staticmethod
+    def create_analysis_rendition(
+        input_path: str,
+        output_path: str,
+        max_resolution: Optional[int] = None,
+        fps: Optional[int] = None,
+        crf: Optional[int] = None
+    ) -> str:
+        """
+        生成供 AI 分析使用的轻量视频（降分辨率、统一帧率、去除音轨）
+
+        Args:
+            input_path: 输入视频路径
+            output_path: 输出视频路径
+            max_resolution: 短边最大像素，默认取配置 analysis_max_resolution
+            fps: 目标帧率，默认取配置 analysis_fps
+            crf: 质量参数，默认取配置 analysis_crf
+
+        Returns:
+            输出视频路径
+        """
+        max_resolution = max_resolution or settings.analysis_max_resolution
+        fps = fps or settings.analysis_fps
+        crf = crf or settings.analysis_crf
+
+        try:
+            info = FFmpegHelper.get_video_info(input_path)
+            width, height = FFmpegHelper._scaled_size(info['width'], info['height'], max_resolution)
+
+            (
+                ffmpeg
+                .input(input_path)
+                .filter('fps', fps=fps)
+                .filter('scale', width, height)
+                .output(
+                    output_path,
+                    **FFmpegHelper._h264_options(crf, 'veryfast'),
+                    pix_fmt='yuv420p',
+                    movflags='+faststart',
+                    an=None  # 分析不需要音轨
+                )
+                .overwrite_output()
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
+            )
+
+            return output_path
+
+        except ffmpeg.Error as e:
+            error_message = e.stderr.decode() if e.stderr else str(e)
+            raise Exception(f"生成分析视频失败: {error_message}")
+
+    @staticmethod
+    def detect_impact_time(file_path: str, smooth_frames: int = 5) -> Optional[float]:
+        """
+        检测击球时刻（平滑后运动强度最大的时间点）
+
+        Args:
+            file_path: 视频文件路径
+            smooth_frames: 滑动平均的帧数，用于过滤单帧抖动
+
+        Returns:
+            击球时刻（秒），无法检测时返回 None
+        """
+        scores = FFmpegHelper.get_motion_scores(file_path)
+        if not scores:
+            return None
+
+        half = smooth_frames // 2
+        best_time = None
+        best_value = -1.0
+        for i, (time_point, _) in enumerate(scores):
+            neighbors = scores[max(0, i - half):i + half + 1]
+            value = sum(score for _, score in neighbors) / len(neighbors)
+            if value > best_value:
+                best_value = value
+                best_time = time_point
+
+        return best_time
+
+    @staticmethod
+    def extract_keyframes(
+        video_path: str,
+        output_dir: str,
+        count: Optional[int] = None,
+        span_seconds: Optional[float] = None,
+        center: Optional[float] = None,
+        max_resolution: Optional[int] = None
+    ) -> List[Tuple[float, str]]:
+        """
+        在击球时刻前后均匀抽取关键帧（一次 ffmpeg 调用输出全部 JPEG）
+
+        Args:
+            video_path: 视频文件路径
+            output_dir: 关键帧输出目录
+            count: 抽取帧数，默认取配置 analysis_keyframe_count
+            span_seconds: 抽帧时间跨度（秒），默认取配置 analysis_keyframe_span_seconds
+            center: 抽帧中心时间点，未指定时自动检测击球时刻
+            max_resolution: 短边最大像素，默认取配置 analysis_max_resolution
+
+        Returns:
+            [(时间点秒, 图片路径), ...]，按时间排序
+        """
+        count = count or settings.analysis_keyframe_count
+        span_seconds = span_seconds or settings.analysis_keyframe_span_seconds
+        max_resolution = max_resolution or settings.analysis_max_resolution
+
+        try:
+            info = FFmpegHelper.get_video_info(video_path)
+            duration = info['duration']
+
+            if center is None:
+                center = FFmpegHelper.detect_impact_time(video_path)
+            if center is None:
+                center = duration / 2
+
+            span_seconds = min(span_seconds, duration)
+            start = max(0.0, min(center - span_seconds / 2, duration - span_seconds))
+            interval = span_seconds / count
+            width, height = FFmpegHelper._scaled_size(info['width'], info['height'], max_resolution)
+
+            os.makedirs(output_dir, exist_ok=True)
+            (
+                ffmpeg
+                .input(video_path, ss=start, t=span_seconds)
+                .filter('fps', fps=1 / interval)
+                .filter('scale', width, height)
+                .output(
+                    os.path.join(output_dir, 'frame_%02d.jpg'),
+                    vframes=count,
+                    **{'q:v': 3}
+                )
+                .overwrite_output()
+                .run(cmd=FFmpegHelper._ffmpeg_cmd(), capture_stdout=True, capture_stderr=True, quiet=True)
+            )
+
+        except ffmpeg.Error as e:
+            error_message = e.stderr.decode() if e.stderr else str(e)
+            raise Exception(f"抽取关键帧失败: {error_message}")
+
+        frames = []
+        for i in range(count):
+            frame_path = os.path.join(output_dir, f'frame_{i + 1:02d}.jpg')
+            if os.path.exists(frame_path):
+                frames.append((round(start + i * interval, 3), frame_path))
+
+        if not frames:
+            raise Exception("抽取关键帧失败: 未生成任何图片")
+
+        return frames
+
+    @staticmethod
+    def is_streamable(head: bytes) -> bool:
+        """
+        根据文件开头判断视频能否从管道（stdin）顺序读取
+
+        MP4/MOV 的 moov（索引）在 mdat（数据）之前时才能顺序读取；手机录制的视频通常把 moov
+        写在文件末尾，只能下载完成后再处理。MKV/WebM 可以顺序读取
+
+        Args:
+            head: 文件开头的字节（64KB 足够）
+        """
+        if head[:4] == b'\x1a\x45\xdf\xa3':
+            return True
+
+        offset = 0
+        while offset + 8 <= len(head):
+            size = int.from_bytes(head[offset:offset + 4], 'big')
+            box_type = head[offset + 4:offset + 8]
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat' or (offset == 0 and box_type != b'ftyp'):
+                return False
+            if size == 1 and offset + 16 <= len(head):
+                size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+            if size < 8:
+                return False
+            offset += size
+        return False
+
+    @staticmethod
+    def streaming_transcode_args(
+        output_path: str,
+        trim_start: Optional[float] = None,
+        trim_end: Optional[float] = None,
+        crf: int = 28
+    ) -> List[str]:
+        """
+        从 stdin 读取视频并裁剪 + 压缩的 ffmpeg 命令（编码参数与 process_video 相同）
+
+        Returns:
+            命令行参数列表
+        """
+        input_options = {}
+        if trim_start is not None:
+            input_options['ss'] = trim_start
+        if trim_end is not None:
+            input_options['t'] = trim_end - (trim_start or 0.0)
+
+        return (
+            ffmpeg
+            .input('pipe:0', **input_options)
+            .output(
+                output_path,
+                **FFmpegHelper._h264_options(crf, 'medium'),
+                acodec='aac',
+                audio_bitrate='128k'
+            )
+            .overwrite_output()
+            .compile(cmd=FFmpegHelper._ffmpeg_cmd())
+        )
+
+    @staticmethod
+    def streaming_motion_scores_args() -> List[str]:
+        """从 stdin 读取视频并计算逐帧运动强度的 ffmpeg 命令（输出用 parse_motion_scores 解析）"""
+        return FFmpegHelper._motion_scores_stream('pipe:0').compile(cmd=FFmpegHelper._ffmpeg_cmd())
+
     @staticmethod
     def process_video(
         input_path: str,
@@ -0,0 +1,83 @@
+"""
+以 stdin 为输入的 ffmpeg 进程
+下载视频时把收到的数据同时写入 ffmpeg，处理与下载并行，最后一个字节到达后很快就能完成
+"""
+import asyncio
+from typing import List, Optional
+
+
+class FFmpegPipe:
+    """
+    异步 ffmpeg 子进程：feed 写入数据（按管道背压等待），finish 关闭 stdin 并等待结果
+
+    stdout 和 stderr 在后台持续读取，避免输出填满管道后 ffmpeg 阻塞、不再读取 stdin
+    """
+
+    def __init__(self, args: List[str]):
+        self.args = args
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.failed = False
+        self._stdout_task: Optional[asyncio.Task] = None
+        self._stderr_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(
+            *self.args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self._stdout_task = asyncio.ensure_future(self.process.stdout.read())
+        self._stderr_task = asyncio.ensure_future(self.process.stderr.read())
+
+    async def feed(self, chunk: bytes) -> bool:
+        """
+        写入一块数据
+
+        Returns:
+            是否写入成功；ffmpeg 已退出（如无法识别输入格式）时返回 False，之后的数据不再写入
+        """
+        if self.failed:
+            return False
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+            return False
+
+    async def finish(self) -> bytes:
+        """
+        关闭 stdin，等待 ffmpeg 处理完剩余数据
+
+        Returns:
+            ffmpeg 的 stdout 输出
+
+        Raises:
+            Exception: ffmpeg 以非 0 状态退出
+        """
+        try:
+            self.process.stdin.close()
+            await self.process.stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        out = await self._stdout_task
+        err = await self._stderr_task
+        returncode = await self.process.wait()
+        if returncode != 0:
+            self.failed = True
+            raise Exception(err.decode(errors='ignore')[-500:] or f"ffmpeg 退出码 {returncode}")
+        return out
+
+    async def abort(self) -> None:
+        """终止进程（下载失败时调用）"""
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.failed = True
+        self.process.kill()
+        await self.process.wait()
+        for task in (self._stdout_task, self._stderr_task):
+            if task is not None and not task.done():
+                task.cancel()
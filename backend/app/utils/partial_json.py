@@ -0,0 +1,108 @@
+"""
+增量 JSON 解析工具
+流式生成时逐段输入模型返回的文本，顶层字段一旦完整就立即回调，不必等待整个 JSON 生成完毕
+"""
+import json
+from typing import Any, Callable, Iterable, Optional
+
+
+class IncrementalJsonParser:
+    """
+    顶层 JSON 对象的增量解析器
+
+    - 顶层字段的值完整后调用 on_field(key, value)
+    - stream_arrays 中的数组字段，每个对象元素完整后调用 on_item(key, index, item)，
+      不再对整个数组调用 on_field
+    """
+
+    def __init__(
+        self,
+        on_field: Callable[[str, Any], None],
+        on_item: Optional[Callable[[str, int, Any], None]] = None,
+        stream_arrays: Iterable[str] = ()
+    ):
+        self.on_field = on_field
+        self.on_item = on_item
+        self.stream_arrays = set(stream_arrays)
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._key: Optional[str] = None
+        self._expecting_value = False
+        self._value_start: Optional[int] = None
+        self._item_start: Optional[int] = None
+        self._item_index = 0
+        self.fields = {}
+
+    def feed(self, text: str) -> None:
+        """输入一段新生成的文本"""
+        self._buf += text
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            c = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and not self._expecting_value:
+                        self._key = json.loads(buf[self._string_start:i + 1])
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                self._start_value(i)
+            elif c in "{[":
+                if self._depth == 1:
+                    self._start_value(i)
+                elif self._depth == 2 and c == "{" and self._key in self.stream_arrays:
+                    self._item_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 2 and self._item_start is not None:
+                    self._emit_item(json.loads(buf[self._item_start:i + 1]))
+                    self._item_start = None
+                elif self._depth == 1 and self._value_start is not None:
+                    self._emit_field(buf[self._value_start:i + 1])
+                elif self._depth == 0 and self._value_start is not None:
+                    # 最后一个字段是标量，遇到顶层 } 时结束
+                    self._emit_field(buf[self._value_start:i])
+            elif self._depth == 1:
+                if c == ":":
+                    self._expecting_value = True
+                    self._value_start = None
+                elif c == ",":
+                    if self._value_start is not None:
+                        self._emit_field(buf[self._value_start:i])
+                elif not c.isspace():
+                    self._start_value(i)
+            i += 1
+        self._pos = i
+
+    def _start_value(self, i: int) -> None:
+        if self._depth == 1 and self._expecting_value and self._value_start is None:
+            self._value_start = i
+
+    def _emit_field(self, raw: str) -> None:
+        key = self._key
+        self._expecting_value = False
+        self._value_start = None
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return
+        self.fields[key] = value
+        if key not in self.stream_arrays:
+            self.on_field(key, value)
+        self._item_index = 0
+
+    def _emit_item(self, item: Any) -> None:
+        if self.on_item is not None:
+            self.on_item(self._key, self._item_index, item)
+        self._item_index += 1
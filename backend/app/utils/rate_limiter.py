@@ -0,0 +1,210 @@
+"""
+客户端限流工具
+基于令牌桶的请求数（RPM）和 Token 数（TPM）配额调度器，超出配额的请求按优先级排队
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Optional
+
+
+# 优先级（数值越小越优先）
+PRIORITY_PREMIUM = 0
+PRIORITY_NORMAL = 10
+
+
+class QuotaExceededError(Exception):
+    """排队已满或等待超时"""
+
+    def __init__(self, message: str, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class TokenBucket:
+    """令牌桶：以固定速率补充令牌，容量为一分钟的配额"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """获取 amount 个令牌需要等待的秒数，0 表示可立即获取"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """扣除令牌（允许为负，表示透支，后续请求需等待补足）"""
+        self._refill()
+        self.tokens -= amount
+
+
+class QuotaScheduler:
+    """
+    进程内配额调度器
+
+    同时满足 RPM 和 TPM 两个令牌桶才放行；否则进入优先级队列等待，
+    队列已满或等待超过 max_wait_seconds 时抛出 QuotaExceededError
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rpm: int,
+        tpm: int,
+        max_queue_size: int,
+        max_wait_seconds: float
+    ):
+        self.name = name
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.max_queue_size = max_queue_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = []  # (priority, seq, tokens, future)
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.total_admitted = 0
+        self.total_queued = 0
+        self.total_rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.request_bucket is not None or self.token_bucket is not None
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens))
+        return wait
+
+    def _consume(self, tokens: int) -> None:
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens)
+        self.total_admitted += 1
+
+    def is_saturated(self) -> bool:
+        """队列是否已满（用于在耗时操作前提前拒绝）"""
+        return len(self._queue) >= self.max_queue_size
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        申请一次调用配额
+
+        Args:
+            tokens: 预估消耗的 Token 数
+            priority: 优先级，数值越小越先放行
+        """
+        if not self.enabled:
+            return
+
+        if not self._queue and self._wait_time(tokens) == 0:
+            self._consume(tokens)
+            return
+
+        if self.is_saturated():
+            self.total_rejected += 1
+            raise QuotaExceededError(
+                f"{self.name} 请求排队已满，请稍后重试",
+                retry_after=self._wait_time(tokens)
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._counter), tokens, future]
+        heapq.heappush(self._queue, entry)
+        self.total_queued += 1
+        self._ensure_dispatcher()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait_seconds)
+        except asyncio.CancelledError:
+            future.cancel()
+            self._remove(entry)
+            raise
+        except asyncio.TimeoutError:
+            if future.done():
+                return
+            future.cancel()
+            self._remove(entry)
+            self.total_rejected += 1
+            raise QuotaExceededError(
+                f"{self.name} 请求排队超时（{self.max_wait_seconds:.0f} 秒），请稍后重试",
+                retry_after=self._wait_time(tokens)
+            )
+
+    def _remove(self, entry: list) -> None:
+        """移除放弃等待的请求，使其不再占用队列名额（is_saturated）"""
+        for index, queued in enumerate(self._queue):
+            if queued is entry:
+                last = self._queue.pop()
+                if index < len(self._queue):
+                    self._queue[index] = last
+                    heapq.heapify(self._queue)
+                break
+        if self._wakeup is not None:
+            # 队首可能变化，唤醒调度器重新计算等待时间
+            self._wakeup.set()
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """根据实际消耗修正 TPM 令牌桶"""
+        if self.token_bucket is None or not actual_tokens:
+            return
+        self.token_bucket.consume(actual_tokens - estimated_tokens)
+
+    def _ensure_dispatcher(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        """按优先级依次放行排队中的请求"""
+        while self._queue:
+            _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            wait = self._wait_time(tokens)
+            if wait == 0:
+                heapq.heappop(self._queue)
+                self._consume(tokens)
+                future.set_result(None)
+                continue
+
+            # 等待令牌补充，或有更高优先级的请求入队
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot(self) -> dict:
+        """调度器当前状态（用于健康检查）"""
+        return {
+            "name": self.name,
+            "enabled": self.enabled,
+            "queue_size": len(self._queue),
+            "max_queue_size": self.max_queue_size,
+            "available_requests": round(self.request_bucket.tokens, 1) if self.request_bucket else None,
+            "available_tokens": int(self.token_bucket.tokens) if self.token_bucket else None,
+            "total_admitted": self.total_admitted,
+            "total_queued": self.total_queued,
+            "total_rejected": self.total_rejected
+        }
@@ -0,0 +1,209 @@
+"""
+外部服务调用的容错工具
+包含超时控制、带抖动的重试和熔断器
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+from google.api_core import exceptions as google_exceptions
+
+
+# 可重试的错误类型（临时性故障、限流、超时）
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.Aborted,
+    google_exceptions.Unknown,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，拒绝调用"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name} 服务暂时不可用，请 {int(retry_after) + 1} 秒后重试")
+
+
+class StageTimeoutError(asyncio.TimeoutError):
+    """某个调用阶段超时"""
+
+    def __init__(self, stage: str, timeout: float):
+        self.stage = stage
+        self.timeout = timeout
+        super().__init__(f"{stage} 阶段超时（{timeout:.0f} 秒）")
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """判断错误是否为可重试的临时性故障"""
+    return isinstance(exc, RETRYABLE_EXCEPTIONS)
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    - closed: 正常放行，连续失败达到阈值后打开
+    - open: 直接拒绝，等待 recovery_seconds 后进入 half_open
+    - half_open: 只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = False
+        self._lock = threading.Lock()
+        self.total_rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == "open" and time.time() - self._opened_at >= self.recovery_seconds:
+            self._state = "half_open"
+            self._half_open_in_flight = False
+        return self._state
+
+    def before_call(self) -> None:
+        """调用前检查，熔断打开时抛出 CircuitOpenError"""
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._half_open_in_flight:
+                self._half_open_in_flight = True
+                return
+
+            self.total_rejected += 1
+            retry_after = max(0.0, self.recovery_seconds - (time.time() - self._opened_at))
+            raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._half_open_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._state = "open"
+                self._opened_at = time.time()
+                self._half_open_in_flight = False
+
+    def release(self) -> None:
+        """调用未得出结果（如被取消）时释放 half_open 的试探名额，不改变熔断状态"""
+        with self._lock:
+            self._half_open_in_flight = False
+
+    def snapshot(self) -> dict:
+        """熔断器当前状态（用于健康检查）"""
+        with self._lock:
+            state = self._current_state()
+            retry_after = 0.0
+            if state == "open":
+                retry_after = max(0.0, self.recovery_seconds - (time.time() - self._opened_at))
+            return {
+                "name": self.name,
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_after_seconds": round(retry_after, 1),
+                "total_rejected": self.total_rejected
+            }
+
+
+async def call_with_retry(
+    func: Callable[..., Any],
+    *args,
+    stage: str,
+    timeout: float,
+    max_retries: int = 0,
+    base_delay: float = 1.0,
+    max_delay: float = 8.0,
+    breaker: Optional[CircuitBreaker] = None,
+    retry_on_timeout: bool = True,
+    before_retry: Optional[Callable[[], Awaitable[None]]] = None,
+    **kwargs
+) -> Any:
+    """
+    在线程池中执行同步调用，带超时、抖动重试和熔断
+
+    只有可重试的错误会重试，重试耗尽后计入一次熔断失败；参数错误、鉴权失败等直接抛出。
+    超时后线程中的调用不会停止，不能安全重复执行的调用（如上传文件）应设置 retry_on_timeout=False
+
+    Args:
+        func: 同步函数
+        stage: 阶段名称（用于日志和超时错误信息）
+        timeout: 单次调用超时（秒）
+        max_retries: 最大重试次数
+        base_delay: 首次重试等待时间（秒）
+        max_delay: 单次重试最长等待时间（秒）
+        breaker: 熔断器
+        retry_on_timeout: 超时后是否重试
+        before_retry: 每次重试前调用（如重新申请配额），抛出异常时不再重试
+
+    Returns:
+        func 的返回值
+    """
+    if breaker is not None:
+        breaker.before_call()
+
+    # 调用被取消等未得出结果时，finally 中释放熔断器的试探名额，避免熔断器一直停在 half_open
+    settled = False
+    attempt = 0
+    try:
+        while True:
+            try:
+                result = await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), timeout=timeout)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and not isinstance(e, StageTimeoutError):
+                    e = StageTimeoutError(stage, timeout)
+
+                if not is_retryable_error(e):
+                    # 非临时性故障说明服务本身可用
+                    if breaker is not None:
+                        breaker.record_success()
+                        settled = True
+                    raise e
+
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                if attempt >= max_retries or (timed_out and not retry_on_timeout):
+                    # 重试耗尽才计为一次失败调用
+                    if breaker is not None:
+                        breaker.record_failure()
+                        settled = True
+                    raise e
+
+                # 指数退避 + 全抖动
+                delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+                attempt += 1
+                print(f"{stage} 调用失败（{type(e).__name__}: {str(e)[:200]}），{delay:.1f} 秒后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+                if before_retry is not None:
+                    await before_retry()
+                continue
+
+            if breaker is not None:
+                breaker.record_success()
+                settled = True
+            return result
+    finally:
+        if breaker is not None and not settled:
+            breaker.release()
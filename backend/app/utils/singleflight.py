@@ -0,0 +1,65 @@
+"""
+并发请求合并（single-flight）
+同一个 Key 同时只执行一次，其余并发调用等待并共享第一次调用的结果
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    """进程内 single-flight 合并器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, Tuple["asyncio.Future", Any]] = {}
+        self.total_calls = 0
+        self.total_coalesced = 0
+
+    async def do(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        share: Any = None,
+        on_join: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """
+        执行 func；相同 key 的调用进行中时，直接等待其结果
+
+        执行放在独立任务中，发起调用的请求被取消时不影响其他等待者
+
+        Args:
+            share: 执行方保存的共享数据（如进度任务列表）
+            on_join: 合并到进行中的调用时，以执行方的 share 调用
+        """
+        self.total_calls += 1
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            task, shared = in_flight
+            self.total_coalesced += 1
+            print(f"{self.name} 合并重复请求: {key}")
+            if on_join is not None:
+                on_join(shared)
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(func())
+        self._in_flight[key] = (task, share)
+
+        def _on_done(t: "asyncio.Future") -> None:
+            if self._in_flight.get(key, (None,))[0] is t:
+                del self._in_flight[key]
+            # 取出异常，避免所有等待者都已取消时出现 "exception was never retrieved"
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_on_done)
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> dict:
+        """合并器当前状态（用于健康检查）"""
+        return {
+            "name": self.name,
+            "in_flight": len(self._in_flight),
+            "total_calls": self.total_calls,
+            "total_coalesced": self.total_coalesced,
+            "coalesced_ratio": round(self.total_coalesced / self.total_calls, 3) if self.total_calls else 0.0
+        }
@@ -0,0 +1,107 @@
+"""
+上传文件的静态服务
+文件名以 UUID 开头的文件写入后不会再改变，按内容寻址处理：强 ETag + 长期不可变缓存，
+小程序历史页重复查看时直接使用本地缓存，不再重新下载缩略图和视频
+"""
+import hashlib
+import os
+import re
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Receive, Scope, Send
+from app.config import settings
+
+
+# 上传、处理后的视频和缩略图都以 uuid4 命名（如 <uuid>_processed.mp4、<uuid>_thumb.jpg）
+CONTENT_ADDRESSED_NAME = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}([_.].*)?$"
+)
+
+# 不对外提供的子目录（旧版本把断点续传的未完成上传保存在 uploads/chunks 下）
+PRIVATE_DIRS = {"chunks"}
+
+
+class UploadFileResponse(FileResponse):
+    """
+    上传文件响应
+
+    - 完整响应在服务器支持 http.response.pathsend 扩展时交给服务器零拷贝发送（sendfile）
+    - 否则按较大的块读取，减少线程切换次数；Range 请求（视频拖动进度条）沿用 Starlette 的实现
+    """
+
+    chunk_size = settings.static_chunk_size_kb * 1024
+
+    def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+        # If-Range 与自定义的 ETag 比较（父类只认按修改时间计算的 ETag）
+        if http_if_range == self.headers.get("etag"):
+            return True
+        return super()._should_use_range(http_if_range, stat_result)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers = Headers(scope=scope)
+        if (
+            "http.response.pathsend" in scope.get("extensions", {})
+            and scope["method"].upper() != "HEAD"
+            and "range" not in headers
+        ):
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            if self.background is not None:
+                await self.background()
+            return
+
+        await super().__call__(scope, receive, send)
+
+
+class UploadStaticFiles(StaticFiles):
+    """/uploads 静态文件服务：强 ETag、不可变缓存策略、Range 和零拷贝发送"""
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if path.replace("\\", "/").split("/", 1)[0] in PRIVATE_DIRS:
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    @staticmethod
+    def is_content_addressed(full_path: str) -> bool:
+        """文件名以 UUID 开头的文件写入后不再修改"""
+        return CONTENT_ADDRESSED_NAME.match(os.path.basename(full_path)) is not None
+
+    @staticmethod
+    def strong_etag(full_path: str, stat_result: os.stat_result) -> str:
+        """
+        按文件名和大小计算 ETag
+
+        内容寻址的文件不依赖修改时间，多实例部署或迁移目录后 ETag 保持不变
+        """
+        base = f"{os.path.basename(full_path)}-{stat_result.st_size}"
+        return f'"{hashlib.md5(base.encode()).hexdigest()}"'
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200
+    ) -> Response:
+        headers = {}
+        if self.is_content_addressed(str(full_path)):
+            headers["etag"] = self.strong_etag(str(full_path), stat_result)
+            headers["cache-control"] = (
+                f"public, max-age={settings.static_cache_max_age_seconds}, immutable"
+            )
+        else:
+            # 其他文件每次使用前用 ETag 重新验证（304 不传输内容）
+            headers["cache-control"] = "no-cache"
+
+        response = UploadFileResponse(
+            full_path,
+            status_code=status_code,
+            headers=headers,
+            stat_result=stat_result
+        )
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
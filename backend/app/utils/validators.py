@@ -18,24 +18,37 @@ def validate_video_file(file: UploadFile) -> None:
         HTTPException: 如果文件不符合要求
     """
     # 检查文件扩展名
-    if not file.filename:
+    validate_video_filename(file.filename)
+    
+    # 检查 Content-Type
+    if file.content_type and not file.content_type.startswith('video/'):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="文件名不能为空"
+            detail="文件必须是视频格式"
         )
+
+
+def validate_video_filename(filename: Optional[str]) -> None:
+    """
+    验证视频文件名（扩展名）
     
-    file_ext = file.filename.rsplit('.', 1)[-1].lower()
-    if file_ext not in settings.allowed_extensions_list:
+    Args:
+        filename: 文件名
+    
+    Raises:
+        HTTPException: 如果文件名为空或格式不支持
+    """
+    if not filename:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"不支持的文件格式。允许的格式: {', '.join(settings.allowed_extensions_list)}"
+            detail="文件名不能为空"
         )
     
-    # 检查 Content-Type
-    if file.content_type and not file.content_type.startswith('video/'):
+    file_ext = filename.rsplit('.', 1)[-1].lower()
+    if file_ext not in settings.allowed_extensions_list:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="文件必须是视频格式"
+            detail=f"不支持的文件格式。允许的格式: {', '.join(settings.allowed_extensions_list)}"
         )
 
 
@@ -56,6 +69,37 @@ def validate_video_size(file_size: int) -> None:
         )
 
 
+def validate_trim_bounds(trim_start: Optional[float], trim_end: Optional[float]) -> None:
+    """
+    不依赖视频时长的裁剪范围检查（下载或处理视频之前执行）
+    
+    Args:
+        trim_start: 裁剪起始时间（秒）
+        trim_end: 裁剪结束时间（秒）
+    
+    Raises:
+        HTTPException: 如果裁剪范围无效
+    """
+    start = trim_start if trim_start is not None else 0.0
+    if start < 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="裁剪起始时间不能小于 0"
+        )
+    
+    if trim_end is not None:
+        if trim_end <= start:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="裁剪结束时间必须大于起始时间"
+            )
+        if trim_end - start > settings.max_video_duration_seconds:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"裁剪后的视频时长不能超过 {settings.max_video_duration_seconds} 秒"
+            )
+
+
 def validate_trim_range(trim_start: Optional[float], trim_end: Optional[float], duration: float) -> tuple:
     """
     验证视频裁剪范围
@@ -1,5 +1,4 @@
 import os
-import httpx
 from fastapi import HTTPException, status
 
 async def get_wechat_openid(code: str) -> str:
@@ -19,6 +18,8 @@ async def get_wechat_openid(code: str) -> str:
             detail="微信小程序配置缺失 (WECHAT_APP_ID, WECHAT_APP_SECRET)，请在 backend/.env 文件中配置"
         )
         
+    import httpx
+
     url = f"https://api.weixin.qq.com/sns/jscode2session?appid={app_id}&secret={secret}&js_code={code}&grant_type=authorization_code"
     
     async with httpx.AsyncClient() as client:
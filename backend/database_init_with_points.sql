@@ -56,7 +56,8 @@ CREATE TABLE IF NOT EXISTS analyses (
     suggestions JSONB,
     points_cost INTEGER DEFAULT 10 NOT NULL,  -- 本次分析消耗的积分
     analyzed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    analysis_duration FLOAT
+    analysis_duration FLOAT,
+    prompt_version VARCHAR(20)  -- 生成结果使用的 Prompt/Schema 版本
 );
 
 CREATE INDEX IF NOT EXISTS idx_analyses_user_id ON analyses(user_id);
@@ -64,11 +65,14 @@ CREATE INDEX IF NOT EXISTS idx_analyses_video_id ON analyses(video_id);
 CREATE INDEX IF NOT EXISTS idx_analyses_analyzed_at ON analyses(analyzed_at DESC);
 CREATE INDEX IF NOT EXISTS idx_analyses_speed ON analyses(speed DESC);
 
+-- 已有数据库升级：记录 Prompt 版本
+ALTER TABLE analyses ADD COLUMN IF NOT EXISTS prompt_version VARCHAR(20);
+
 -- 4. 创建 points_transactions 表 (积分交易记录表)
 CREATE TABLE IF NOT EXISTS points_transactions (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-    transaction_type VARCHAR(20) NOT NULL,  -- 'earn' 获得, 'spend' 消费, 'gift' 赠送, 'purchase' 购买
+    transaction_type VARCHAR(20) NOT NULL,  -- 'earn' 获得, 'spend' 消费, 'gift' 赠送, 'purchase' 购买, 'refund' 退回
     points INTEGER NOT NULL,  -- 积分数量（正数表示获得，负数表示消费）
     balance_before INTEGER NOT NULL,  -- 交易前余额
     balance_after INTEGER NOT NULL,  -- 交易后余额
@@ -161,4 +165,26 @@ CREATE TRIGGER trigger_give_welcome_points
     FOR EACH ROW
     EXECUTE FUNCTION give_welcome_points();
 
+-- 8. 原子调整积分：余额检查和更新在同一条语句中完成，并发扣除不会丢失更新
+-- 余额不足或用户不存在时不更新，返回空结果；退回（refund）冲减累计消费，不计入累计获得
+CREATE OR REPLACE FUNCTION adjust_user_points(
+    p_user_id UUID,
+    p_points INTEGER,
+    p_transaction_type VARCHAR
+)
+RETURNS TABLE (balance_before INTEGER, balance_after INTEGER) AS $$
+    UPDATE users
+    SET points = points + p_points,
+        total_points_earned = total_points_earned
+            + CASE WHEN p_transaction_type <> 'refund' AND p_points > 0 THEN p_points ELSE 0 END,
+        total_points_spent = CASE
+            WHEN p_transaction_type = 'refund' THEN GREATEST(0, total_points_spent - p_points)
+            WHEN p_points < 0 THEN total_points_spent - p_points
+            ELSE total_points_spent
+        END,
+        updated_at = NOW()
+    WHERE id = p_user_id AND points + p_points >= 0
+    RETURNING points - p_points, points;
+$$ LANGUAGE sql;
+
 -- 完成！现在可以启动后端服务了
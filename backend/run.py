@@ -2,27 +2,100 @@
 """
 启动脚本
 运行 FastAPI 应用
+
+- DEBUG=true：单进程 + 热重载（开发环境）
+- 默认（生产环境）：SERVER_WORKERS 个 worker 进程（默认 1，0 表示按容器可用 CPU 核数自动设置），
+  使用 uvloop + httptools；多 worker 时 worker 处理 SERVER_MAX_REQUESTS 个请求后自动重启，
+  向主进程发送 SIGHUP 可逐个平滑重启全部 worker
 """
+import asyncio
+import importlib.util
+import json
+import os
 import uvicorn
 from app.config import settings
 
 
-import os
+def available_cpus() -> int:
+    """容器可用的 CPU 核数（考虑 cgroup CPU 配额和 CPU 亲和性）"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2: "<quota> <period>" 或 "max <period>"
+    quota_files = [("/sys/fs/cgroup/cpu.max", None)]
+    # cgroup v1
+    quota_files.append(("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"))
+    for quota_path, period_path in quota_files:
+        try:
+            with open(quota_path) as f:
+                values = f.read().split()
+            if period_path:
+                with open(period_path) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], values[1]
+            if quota not in ("max", "-1"):
+                cpus = min(cpus, max(1, int(int(quota) / int(period))))
+            break
+        except (OSError, ValueError, IndexError):
+            continue
+
+    return max(1, cpus)
+
+
+def check_gemini_once() -> None:
+    """
+    在主进程中执行一次 Gemini 就绪检查，结果通过环境变量传给各个 worker，
+    避免每个 worker 启动时都访问 Gemini API
+    """
+    if not settings.gemini_warmup_enabled:
+        return
+
+    from app.services.gemini_router import READY_STATE_ENV, gemini_router
+    ready = asyncio.run(gemini_router.warm_up(timeout=settings.gemini_warmup_timeout_seconds))
+    if not ready and settings.gemini_warmup_strict:
+        raise SystemExit("没有可用的 Gemini 路线，请检查 GEMINI_API_KEY / GEMINI_ROUTES 配置")
+    os.environ[READY_STATE_ENV] = json.dumps(gemini_router.export_ready_state())
+
 
 if __name__ == "__main__":
     # 微信云托管环境会自动注入 PORT 环境变量，默认为 80
     # 我们优先使用环境变量，如果没有则使用 settings 里的默认值 (现在已改为 80)
     port = int(os.environ.get("PORT", settings.port))
-    
+
     # 在生产环境下关闭 reload，除非明确指定 DEBUG=true
     is_debug = os.environ.get("DEBUG", "false").lower() == "true"
-    
-    print(f"Starting server on {settings.host}:{port} (debug: {is_debug})")
-    
-    uvicorn.run(
-        "app.main:app",
-        host=settings.host,
-        port=port,
-        reload=is_debug,
-        log_level="info"
-    )
+
+    if is_debug:
+        print(f"Starting server on {settings.host}:{port} (debug: {is_debug})")
+        uvicorn.run(
+            "app.main:app",
+            host=settings.host,
+            port=port,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        workers = settings.server_workers or available_cpus()
+        if workers > 1:
+            check_gemini_once()
+            # 配额调度在各个 worker 内独立进行，按 worker 数平分配额，总请求速率不超过配置值
+            os.environ["GEMINI_QUOTA_WORKERS"] = str(workers)
+
+        print(f"Starting server on {settings.host}:{port} (workers: {workers})")
+
+        uvicorn.run(
+            "app.main:app",
+            host=settings.host,
+            port=port,
+            workers=workers,
+            loop="uvloop" if importlib.util.find_spec("uvloop") else "auto",
+            http="httptools" if importlib.util.find_spec("httptools") else "auto",
+            # 单 worker 时 uvicorn 没有主进程重启 worker，达到请求上限后服务会直接退出
+            limit_max_requests=(settings.server_max_requests or None) if workers > 1 else None,
+            timeout_graceful_shutdown=settings.server_graceful_timeout_seconds,
+            timeout_keep_alive=settings.server_keepalive_seconds,
+            backlog=settings.server_backlog,
+            log_level="info"
+        )
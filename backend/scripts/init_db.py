@@ -62,13 +62,17 @@ CREATE TABLE IF NOT EXISTS analyses (
     rank_position INTEGER,
     suggestions JSONB,
     analyzed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    analysis_duration FLOAT
+    analysis_duration FLOAT,
+    prompt_version VARCHAR(20)  -- 生成结果使用的 Prompt/Schema 版本
 );
 
 CREATE INDEX IF NOT EXISTS idx_analyses_user_id ON analyses(user_id);
 CREATE INDEX IF NOT EXISTS idx_analyses_video_id ON analyses(video_id);
 CREATE INDEX IF NOT EXISTS idx_analyses_analyzed_at ON analyses(analyzed_at DESC);
 CREATE INDEX IF NOT EXISTS idx_analyses_speed ON analyses(speed DESC);
+
+-- 已有数据库升级：记录 Prompt 版本
+ALTER TABLE analyses ADD COLUMN IF NOT EXISTS prompt_version VARCHAR(20);
 """
 
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+冷启动耗时测量脚本
+统计导入 app.main 的耗时（按顶层包汇总），可选测量从启动进程到 /health 返回的时间
+
+用法（在 backend 目录下执行）:
+    python scripts/measure_startup.py            # 导入耗时分析
+    python scripts/measure_startup.py --top 30   # 显示更多包
+    python scripts/measure_startup.py --serve    # 同时测量 /health 就绪时间
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 应该延迟到第一次使用时才导入的 SDK
+DEFERRED_PACKAGES = ["google.generativeai", "supabase", "gotrue", "postgrest", "httpx"]
+
+
+def measure_imports() -> list:
+    """在新进程中以 -X importtime 导入 app.main，返回 [(包名, 自身耗时us, 累计耗时us, 层级)]"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        raise SystemExit("导入 app.main 失败")
+
+    records = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        records.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return records
+
+
+def measure_health(port: int, timeout: float) -> float:
+    """启动 uvicorn 进程，返回 /health 首次返回 200 所需的秒数"""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.02)
+        raise SystemExit(f"/health 在 {timeout:.0f} 秒内未就绪")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量后端冷启动耗时")
+    parser.add_argument("--top", type=int, default=15, help="显示耗时最多的前 N 个包")
+    parser.add_argument("--serve", action="store_true", help="同时测量 /health 就绪时间")
+    parser.add_argument("--timeout", type=float, default=30, help="/health 就绪等待时间（秒）")
+    args = parser.parse_args()
+
+    records = measure_imports()
+    total_us = next(cumulative for name, _, cumulative, _ in records if name == "app.main")
+
+    # 按顶层包汇总自身耗时（包含其全部子模块）
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in records:
+        by_package[name.split(".")[0]] += self_us
+
+    print("=" * 60)
+    print(f"导入 app.main 总耗时: {total_us / 1000:.0f} ms")
+    print("=" * 60)
+    print(f"{'包':<32}{'耗时 (ms)':>12}{'占比':>10}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<32}{self_us / 1000:>12.1f}{self_us / total_us:>10.1%}")
+
+    imported = {name for name, _, _, _ in records}
+    print("\n延迟导入检查:")
+    for package in DEFERRED_PACKAGES:
+        status = "❌ 启动时已导入" if package in imported else "✅ 未在启动时导入"
+        print(f"  {package:<28}{status}")
+
+    if args.serve:
+        seconds = measure_health(_free_port(), args.timeout)
+        print(f"\n从启动进程到 /health 就绪: {seconds * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+"""
+测试公共配置
+应用配置在导入时读取环境变量，这里提供占位值；测试不连接 Supabase、Gemini 等外部服务
+"""
+import os
+
+for _name, _value in {
+    "SUPABASE_URL": "https://test.supabase.co",
+    "SUPABASE_KEY": "test-key",
+    "SECRET_KEY": "test-secret",
+    "GEMINI_API_KEY": "test-gemini-key",
+    "WECHAT_APP_ID": "test-app-id",
+    "WECHAT_APP_SECRET": "test-app-secret",
+}.items():
+    os.environ.setdefault(_name, _value)
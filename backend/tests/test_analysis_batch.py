@@ -0,0 +1,66 @@
+"""
+批量分析的积分结算：客户端断开后，已开始的分析仍会完成并保存，按实际结果计费
+"""
+import asyncio
+
+from app.services import analysis_service as analysis_module
+from app.services.analysis_service import ANALYSIS_POINTS_COST, AnalysisService
+from app.utils.singleflight import SingleFlight
+
+USER_ID = "user-1"
+
+
+def _service(monkeypatch, delays, refunds, saved):
+    service = AnalysisService(db=None)
+    flight = SingleFlight("test-analysis")
+
+    async def _run(video_id):
+        await asyncio.sleep(delays[video_id])
+        saved.append(video_id)
+        return {"id": f"analysis-{video_id}", "video_id": video_id}
+
+    async def analyze_video(video_id, user_id, mode=None, priority=None, charge_points=True):
+        # 与真实实现一样在 single-flight 的独立任务中执行，调用方被取消后分析继续
+        return await flight.do((user_id, video_id), lambda: _run(video_id))
+
+    async def refund_points(user_id, points, description):
+        refunds.append(points)
+
+    monkeypatch.setattr(service, "analyze_video", analyze_video)
+    monkeypatch.setattr(service, "_refund_points", refund_points)
+    monkeypatch.setattr(analysis_module.settings, "analysis_batch_concurrency", 2)
+    return service
+
+
+def test_completed_batch_refunds_failed_items(monkeypatch):
+    refunds, saved = [], []
+    service = _service(monkeypatch, {"a": 0, "b": 0}, refunds, saved)
+
+    async def scenario():
+        items = [item async for item in service.analyze_batch(
+            ["a", "b"], USER_ID, reserved_points=3 * ANALYSIS_POINTS_COST
+        )]
+        return items[-1]
+
+    summary = asyncio.run(scenario())
+    assert summary["succeeded"] == 2
+    assert summary["points_cost"] == 2 * ANALYSIS_POINTS_COST
+    assert refunds == [ANALYSIS_POINTS_COST]
+
+
+def test_disconnect_charges_analyses_that_still_complete(monkeypatch):
+    refunds, saved = [], []
+    service = _service(monkeypatch, {"a": 0, "b": 0.05, "c": 0.05, "d": 0}, refunds, saved)
+
+    async def scenario():
+        stream = service.analyze_batch(["a", "b", "c", "d"], USER_ID, reserved_points=4 * ANALYSIS_POINTS_COST)
+        first = await stream.__anext__()
+        assert first["video_id"] == "a"
+        # 客户端断开：b、c 已经在分析，d 还在排队
+        await stream.aclose()
+        while analysis_module._pending_refunds:
+            await asyncio.gather(*list(analysis_module._pending_refunds))
+
+    asyncio.run(scenario())
+    assert sorted(saved) == ["a", "b", "c"]
+    assert refunds == [ANALYSIS_POINTS_COST]
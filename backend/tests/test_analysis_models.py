@@ -0,0 +1,48 @@
+"""
+模型输出校验：超出范围的数值收敛到取值范围内
+"""
+import json
+
+import pytest
+from pydantic import ValidationError
+
+from app.models.analysis import AnalysisModelOutput
+
+
+def _output(**overrides):
+    data = {
+        "speed": 320,
+        "rank": 80,
+        "rank_position": 20,
+        "level": "业余中级",
+        "technique": {"power": 85, "angle": 78, "coordination": 82},
+        "score": 8.2,
+        "suggestions": []
+    }
+    data.update(overrides)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def test_out_of_range_values_clamped():
+    result = AnalysisModelOutput.model_validate_json(_output(
+        speed=0,
+        rank=120,
+        rank_position="前25%",
+        technique={"power": 105, "angle": 88.6, "coordination": -3},
+        score=11.5
+    ))
+    assert result.speed == 1
+    assert result.rank == 100
+    assert result.rank_position == 25
+    assert (result.technique.power, result.technique.angle, result.technique.coordination) == (100, 89, 0)
+    assert result.score == 10
+
+
+def test_valid_values_unchanged():
+    result = AnalysisModelOutput.model_validate_json(_output())
+    assert result.speed == 320 and result.rank == 80 and result.score == pytest.approx(8.2)
+
+
+def test_non_numeric_value_rejected():
+    with pytest.raises(ValidationError):
+        AnalysisModelOutput.model_validate_json(_output(speed="fast"))
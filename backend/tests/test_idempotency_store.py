@@ -0,0 +1,96 @@
+"""
+幂等存储：同一 worker 内的重放，以及通过共享后端在 worker 之间认领 Key 和共享结果
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.services.cache import MemoryCacheBackend
+from app.services.idempotency_store import IdempotencyStore
+
+USER_ID = "user-1"
+
+
+def _store(backend=None):
+    return IdempotencyStore(
+        ttl_seconds=60, max_entries=100, backend=backend,
+        in_flight_ttl_seconds=5, poll_interval_seconds=0.01
+    )
+
+
+def test_retry_in_same_worker_reuses_result():
+    store = _store()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        return {"id": "a1"}
+
+    async def scenario():
+        first = await store.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, func)
+        second = await store.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, func)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == ({"id": "a1"}, False)
+    assert second == ({"id": "a1"}, True)
+    assert len(calls) == 1
+
+
+def test_shared_backend_replays_across_workers():
+    # 两个存储共用一个后端，模拟两个 worker
+    backend = MemoryCacheBackend(max_entries=100)
+    worker_a, worker_b = _store(backend), _store(backend)
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"id": "a1"}
+
+    async def scenario():
+        # 重试在第一个请求执行期间落到另一个 worker：等待其完成并返回同一结果
+        return await asyncio.gather(
+            worker_a.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, func),
+            worker_b.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, func)
+        )
+
+    first, second = asyncio.run(scenario())
+    assert first == ({"id": "a1"}, False)
+    assert second == ({"id": "a1"}, True)
+    assert len(calls) == 1
+
+
+def test_shared_failure_lets_other_worker_retry():
+    backend = MemoryCacheBackend(max_entries=100)
+    worker_a, worker_b = _store(backend), _store(backend)
+
+    async def failing():
+        raise HTTPException(status_code=500, detail="分析失败")
+
+    async def succeeding():
+        return {"id": "a1"}
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await worker_a.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, failing)
+        return await worker_b.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, succeeding)
+
+    assert asyncio.run(scenario()) == ({"id": "a1"}, False)
+
+
+def test_shared_key_with_different_payload_is_rejected():
+    backend = MemoryCacheBackend(max_entries=100)
+    worker_a, worker_b = _store(backend), _store(backend)
+
+    async def func():
+        return {"id": "a1"}
+
+    async def scenario():
+        await worker_a.run("analysis.start", USER_ID, "k1", {"video_id": "v1"}, func)
+        with pytest.raises(HTTPException) as exc_info:
+            await worker_b.run("analysis.start", USER_ID, "k1", {"video_id": "v2"}, func)
+        return exc_info.value.status_code
+
+    assert asyncio.run(scenario()) == 422
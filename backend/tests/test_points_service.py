@@ -0,0 +1,124 @@
+"""
+积分余额的原子更新：数据库函数一次完成检查和更新；没有该函数时按余额做条件更新，并发修改后重试
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+
+from app.services import points_service as points_module
+from app.services.points_service import PointsService
+
+USER_ID = "user-1"
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.filters = {}
+        self.update_data = None
+        self.insert_data = None
+
+    def select(self, columns):
+        return self
+
+    def update(self, data):
+        self.update_data = data
+        return self
+
+    def insert(self, data):
+        self.insert_data = data
+        return self
+
+    def eq(self, column, value):
+        self.filters[column] = value
+        return self
+
+    def execute(self):
+        if self.insert_data is not None:
+            return SimpleNamespace(data=[{"id": "t1", **self.insert_data}])
+        user = self.db.users.get(self.filters.get("id"))
+        if user is None or any(user.get(k, v) != v for k, v in self.filters.items() if k != "id"):
+            return SimpleNamespace(data=[])
+        if self.update_data is None:
+            return SimpleNamespace(data=[dict(user)])
+        self.db.before_update()
+        if user["points"] != self.filters.get("points", user["points"]):
+            return SimpleNamespace(data=[])
+        user.update({k: v for k, v in self.update_data.items() if k != "updated_at"})
+        return SimpleNamespace(data=[dict(user)])
+
+
+class FakeDb:
+    """模拟 Supabase：has_rpc 为 False 时模拟尚未创建 adjust_user_points 函数"""
+
+    def __init__(self, has_rpc):
+        self.has_rpc = has_rpc
+        self.users = {USER_ID: {"points": 30, "total_points_earned": 50, "total_points_spent": 20}}
+        self.concurrent_spends = []
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def before_update(self):
+        # 模拟读取余额之后、更新之前的并发扣除
+        if self.concurrent_spends:
+            self.users[USER_ID]["points"] -= self.concurrent_spends.pop()
+
+    def rpc(self, name, params):
+        if not self.has_rpc:
+            raise APIError({"code": "PGRST202", "message": f"Could not find the function public.{name}"})
+        user = self.users.get(params["p_user_id"])
+        data = []
+        if user is not None and user["points"] + params["p_points"] >= 0:
+            before = user["points"]
+            user["points"] += params["p_points"]
+            data = [{"balance_before": before, "balance_after": user["points"]}]
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=data))
+
+
+@pytest.fixture(autouse=True)
+def reset_rpc_flag(monkeypatch):
+    monkeypatch.setattr(points_module, "_adjust_rpc_available", None)
+
+
+def _spend(db, points):
+    return asyncio.run(PointsService(db).adjust_points(USER_ID, -points, "spend", "视频分析消耗"))
+
+
+def test_rpc_updates_balance_in_one_call():
+    db = FakeDb(has_rpc=True)
+    transaction = _spend(db, 10)
+    assert (transaction["balance_before"], transaction["balance_after"]) == (30, 20)
+    assert db.users[USER_ID]["points"] == 20
+
+
+def test_rpc_reports_insufficient_points():
+    db = FakeDb(has_rpc=True)
+    with pytest.raises(HTTPException) as exc_info:
+        _spend(db, 40)
+    assert exc_info.value.status_code == 400
+    assert db.users[USER_ID]["points"] == 30
+
+
+def test_fallback_retries_after_concurrent_update():
+    db = FakeDb(has_rpc=False)
+    db.concurrent_spends = [10]
+    transaction = _spend(db, 10)
+    # 第一次条件更新因并发扣除失败，重新读取后按新余额扣除，不丢失并发的修改
+    assert (transaction["balance_before"], transaction["balance_after"]) == (20, 10)
+    assert db.users[USER_ID]["points"] == 10
+    assert db.users[USER_ID]["total_points_spent"] == 30
+    assert points_module._adjust_rpc_available is False
+
+
+def test_fallback_rejects_overdraft_after_concurrent_update():
+    db = FakeDb(has_rpc=False)
+    db.concurrent_spends = [25]
+    with pytest.raises(HTTPException) as exc_info:
+        _spend(db, 10)
+    assert exc_info.value.status_code == 400
+    assert db.users[USER_ID]["points"] == 5
@@ -0,0 +1,132 @@
+"""
+任务进度：合并执行（single-flight、幂等重放）的请求都能收到进度
+"""
+import asyncio
+
+from app.services.idempotency_store import IdempotencyStore
+from app.services.progress_broker import (
+    STAGE_GENERATING,
+    STAGE_RECEIVED,
+    STAGE_SAVED,
+    join_progress,
+    progress_broker,
+    progress_jobs,
+    report_progress
+)
+from app.utils.singleflight import SingleFlight
+
+
+def _stages(user_id, job_id):
+    return [event["stage"] for event in progress_broker.history(progress_broker.job_key(user_id, job_id))]
+
+
+def test_singleflight_joiners_receive_progress():
+    flight = SingleFlight("test")
+    release = asyncio.Event()
+
+    async def work():
+        report_progress(STAGE_GENERATING)
+        await release.wait()
+        report_progress(STAGE_SAVED, analysis_id="a1")
+        return "done"
+
+    async def call(job_id):
+        with progress_broker.track("sf-user", job_id):
+            return await flight.do("video-1", work, share=progress_jobs(), on_join=join_progress)
+
+    async def run():
+        first = asyncio.ensure_future(call("job-a"))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(call("job-b"))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(first, second)
+
+    assert asyncio.run(run()) == ["done", "done"]
+    assert _stages("sf-user", "job-a") == [STAGE_RECEIVED, STAGE_GENERATING, STAGE_SAVED]
+    # 加入方先回放已发生的 generating，再收到之后的 saved
+    assert _stages("sf-user", "job-b") == [STAGE_RECEIVED, STAGE_GENERATING, STAGE_SAVED]
+
+
+def test_untracked_executor_still_publishes_to_joiners():
+    flight = SingleFlight("test")
+    release = asyncio.Event()
+
+    async def work():
+        await release.wait()
+        report_progress(STAGE_SAVED)
+
+    async def untracked():
+        await flight.do("video-2", work, share=progress_jobs(), on_join=join_progress)
+
+    async def tracked():
+        with progress_broker.track("sf-user", "job-c"):
+            await flight.do("video-2", work, share=progress_jobs(), on_join=join_progress)
+
+    async def run():
+        first = asyncio.ensure_future(untracked())
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(tracked())
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+    assert _stages("sf-user", "job-c") == [STAGE_RECEIVED, STAGE_SAVED]
+
+
+def test_idempotent_replay_replays_finished_progress():
+    store = IdempotencyStore(ttl_seconds=60, max_entries=10)
+
+    async def work():
+        report_progress(STAGE_SAVED, video_id="v1")
+        return {"id": "v1"}
+
+    async def call(job_id):
+        with progress_broker.track("idem-user", job_id):
+            return await store.run("video.upload", "idem-user", "key-1", {"file": "a.mp4"}, work)
+
+    async def run():
+        return await call("job-1"), await call("job-2")
+
+    (first, replayed_first), (second, replayed_second) = asyncio.run(run())
+    assert first == second == {"id": "v1"}
+    assert (replayed_first, replayed_second) == (False, True)
+    assert _stages("idem-user", "job-2") == [STAGE_RECEIVED, STAGE_SAVED]
+
+
+def test_subscribe_requires_existing_job():
+    async def run():
+        key = progress_broker.job_key("sub-user", "missing")
+        assert not await progress_broker.wait_for_job(key, timeout=0.01)
+        events = [event async for event in progress_broker.subscribe(key, heartbeat_seconds=1)]
+        assert events == []
+        # 订阅不创建任务
+        assert progress_broker.history(key) == []
+        assert key not in progress_broker._waiters
+
+    asyncio.run(run())
+
+
+def test_subscribe_before_job_starts():
+    async def run():
+        key = progress_broker.job_key("sub-user", "job-later")
+        waiting = asyncio.ensure_future(progress_broker.wait_for_job(key, timeout=5))
+        await asyncio.sleep(0.01)
+        with progress_broker.track("sub-user", "job-later"):
+            report_progress(STAGE_SAVED)
+        assert await waiting
+        events = [event["stage"] async for event in progress_broker.subscribe(key, heartbeat_seconds=1)]
+        assert events == [STAGE_RECEIVED, STAGE_SAVED]
+
+    asyncio.run(run())
+
+
+def test_other_users_job_not_visible():
+    async def run():
+        with progress_broker.track("owner", "job-x"):
+            report_progress(STAGE_SAVED)
+        other_key = progress_broker.job_key("intruder", "job-x")
+        assert not await progress_broker.wait_for_job(other_key, timeout=0.01)
+
+    asyncio.run(run())
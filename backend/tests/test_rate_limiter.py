@@ -0,0 +1,67 @@
+"""
+配额调度器：排队超时或取消的请求移出队列
+"""
+import asyncio
+
+import pytest
+
+from app.utils.rate_limiter import PRIORITY_NORMAL, PRIORITY_PREMIUM, QuotaExceededError, QuotaScheduler
+
+
+def _scheduler(**overrides):
+    options = {"name": "test", "rpm": 1, "tpm": 0, "max_queue_size": 2, "max_wait_seconds": 0.05}
+    options.update(overrides)
+    return QuotaScheduler(**options)
+
+
+def test_timed_out_waiters_leave_queue():
+    scheduler = _scheduler()
+
+    async def run():
+        await scheduler.acquire(100)
+        for _ in range(2):
+            with pytest.raises(QuotaExceededError):
+                await scheduler.acquire(100)
+        assert scheduler.snapshot()["queue_size"] == 0
+        assert not scheduler.is_saturated()
+
+    asyncio.run(run())
+    assert scheduler.total_rejected == 2
+
+
+def test_cancelled_waiter_leaves_queue():
+    scheduler = _scheduler(max_wait_seconds=10)
+
+    async def run():
+        await scheduler.acquire(100)
+        waiters = [asyncio.ensure_future(scheduler.acquire(100)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert scheduler.is_saturated()
+
+        waiters[0].cancel()
+        await asyncio.gather(waiters[0], return_exceptions=True)
+        assert scheduler.snapshot()["queue_size"] == 1
+        waiters[1].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert scheduler.snapshot()["queue_size"] == 0
+
+    asyncio.run(run())
+
+
+def test_queued_requests_admitted_by_priority():
+    scheduler = _scheduler(rpm=600, max_wait_seconds=5)
+    admitted = []
+
+    async def acquire(name, priority):
+        await scheduler.acquire(100, priority=priority)
+        admitted.append(name)
+
+    async def run():
+        scheduler.request_bucket.tokens = 0
+        await asyncio.gather(
+            acquire("normal", PRIORITY_NORMAL),
+            acquire("premium", PRIORITY_PREMIUM)
+        )
+
+    asyncio.run(run())
+    assert admitted == ["premium", "normal"]
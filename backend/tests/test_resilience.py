@@ -0,0 +1,180 @@
+"""
+熔断器状态机与 call_with_retry 的重试、超时和取消处理
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from app.utils import resilience
+from app.utils.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    StageTimeoutError,
+    call_with_retry
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的时钟"""
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "time", lambda: now[0])
+    return now
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_threshold(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, recovery_seconds=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.before_call()
+    assert exc_info.value.retry_after == pytest.approx(30)
+    assert breaker.snapshot()["total_rejected"] == 1
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, recovery_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_single_probe(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_seconds=30)
+    _open(breaker)
+
+    clock[0] += 30
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_half_open_failure_reopens(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, recovery_seconds=30)
+    _open(breaker)
+
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_cancelled_probe_releases_half_open_slot(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_seconds=30)
+    _open(breaker)
+    clock[0] += 30
+
+    started = threading.Event()
+    stop = threading.Event()
+
+    def slow():
+        started.set()
+        stop.wait(5)
+
+    async def run():
+        task = asyncio.ensure_future(call_with_retry(slow, stage="test", timeout=10, breaker=breaker))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        stop.set()
+
+    asyncio.run(run())
+    assert breaker.state == "half_open"
+    # 试探名额已释放，下一个请求可以继续试探
+    breaker.before_call()
+
+
+def test_retries_then_records_single_failure():
+    breaker = CircuitBreaker("test", failure_threshold=2, recovery_seconds=30)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        raise google_exceptions.ServiceUnavailable("unavailable")
+
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(call_with_retry(
+            flaky, stage="test", timeout=1, max_retries=2, base_delay=0, breaker=breaker
+        ))
+    assert len(calls) == 3
+    assert breaker.snapshot()["consecutive_failures"] == 1
+
+
+def test_each_retry_reacquires_quota():
+    acquired = []
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise google_exceptions.ServiceUnavailable("unavailable")
+        return "ok"
+
+    async def before_retry():
+        acquired.append(len(calls))
+
+    result = asyncio.run(call_with_retry(
+        flaky, stage="test", timeout=1, max_retries=2, base_delay=0, before_retry=before_retry
+    ))
+    assert result == "ok"
+    # 首次调用由调用方申请配额，之后每次重试前各申请一次
+    assert acquired == [1, 2]
+
+
+def test_non_retryable_error_not_counted():
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_seconds=30)
+    calls = []
+
+    def invalid():
+        calls.append(1)
+        raise google_exceptions.InvalidArgument("bad request")
+
+    with pytest.raises(google_exceptions.InvalidArgument):
+        asyncio.run(call_with_retry(
+            invalid, stage="test", timeout=1, max_retries=2, base_delay=0, breaker=breaker
+        ))
+    assert len(calls) == 1
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("retry_on_timeout, expected_calls", [(True, 2), (False, 1)])
+def test_timeout_retry(retry_on_timeout, expected_calls):
+    breaker = CircuitBreaker("test", failure_threshold=5, recovery_seconds=30)
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+
+    with pytest.raises(StageTimeoutError):
+        asyncio.run(call_with_retry(
+            slow, stage="test", timeout=0.05, max_retries=1, base_delay=0,
+            breaker=breaker, retry_on_timeout=retry_on_timeout
+        ))
+    assert len(calls) == expected_calls
+    assert breaker.snapshot()["consecutive_failures"] == 1
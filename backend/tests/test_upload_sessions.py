@@ -0,0 +1,205 @@
+"""
+断点续传：分片位置校验、最后一个分片的认领、处理被取消后恢复会话，以及未完成的上传不对外提供
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app.services import video_service as video_service_module
+from app.services.upload_sessions import (
+    STATE_COMPLETED,
+    STATE_PROCESSING,
+    STATE_UPLOADING,
+    UploadSessionStore
+)
+from app.utils.static_files import UploadStaticFiles
+
+USER_ID = "user-1"
+CONTENT = b"0123456789" * 3
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadSessionStore(root_dir=str(tmp_path / "chunks"), chunk_size=10, ttl_seconds=3600)
+
+
+def _create(store, sha256=None):
+    os.makedirs(store.root_dir, exist_ok=True)
+    session = store.create(USER_ID, "swing.mp4", len(CONTENT), sha256, {"job_id": "job-1"})
+    return session["upload_id"]
+
+
+def _upload_all(store, upload_id):
+    finished = False
+    for offset in range(0, len(CONTENT), 10):
+        status, finished = store.write_chunk(upload_id, USER_ID, offset, CONTENT[offset:offset + 10])
+    return status, finished
+
+
+def test_chunks_must_arrive_in_order(store):
+    upload_id = _create(store)
+    status, finished = store.write_chunk(upload_id, USER_ID, 0, CONTENT[:10])
+    assert (status["offset"], finished) == (10, False)
+
+    with pytest.raises(HTTPException) as exc_info:
+        store.write_chunk(upload_id, USER_ID, 20, CONTENT[20:])
+    assert exc_info.value.status_code == 409
+    assert exc_info.value.headers["Upload-Offset"] == "10"
+
+    # 重复发送已接收的分片同样返回当前位置
+    with pytest.raises(HTTPException) as exc_info:
+        store.write_chunk(upload_id, USER_ID, 0, CONTENT[:10])
+    assert exc_info.value.headers["Upload-Offset"] == "10"
+    assert store.get_status(upload_id, USER_ID)["offset"] == 10
+
+
+def test_other_user_cannot_access_session(store):
+    upload_id = _create(store)
+    with pytest.raises(HTTPException) as exc_info:
+        store.get_status(upload_id, "user-2")
+    assert exc_info.value.status_code == 404
+
+
+def test_last_chunk_finishes_once(store):
+    upload_id = _create(store)
+    status, finished = _upload_all(store, upload_id)
+    assert finished and status["state"] == STATE_PROCESSING
+    assert status["offset"] == len(CONTENT)
+
+    # 处理期间重试最后一个分片不会再次触发处理
+    status, finished = store.write_chunk(upload_id, USER_ID, 20, CONTENT[20:])
+    assert not finished and status["state"] == STATE_PROCESSING
+
+
+def test_claim_verifies_checksum(store, tmp_path):
+    upload_id = _create(store, sha256=hashlib.sha256(b"other").hexdigest())
+    _upload_all(store, upload_id)
+    with pytest.raises(HTTPException) as exc_info:
+        store.claim_file(upload_id, USER_ID, str(tmp_path), "video-1")
+    assert exc_info.value.status_code == 400
+    # 校验失败的会话被删除，客户端需重新上传
+    with pytest.raises(HTTPException):
+        store.get_status(upload_id, USER_ID)
+
+
+def test_claim_and_complete(store, tmp_path):
+    upload_id = _create(store, sha256=hashlib.sha256(CONTENT).hexdigest())
+    _upload_all(store, upload_id)
+    path, meta = store.claim_file(upload_id, USER_ID, str(tmp_path), "video-1")
+    assert path == str(tmp_path / "video-1.mp4")
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+
+    status = store.complete(upload_id, USER_ID, {"id": "v1"})
+    assert status["state"] == STATE_COMPLETED and status["video"] == {"id": "v1"}
+    status, finished = store.write_chunk(upload_id, USER_ID, 20, CONTENT[20:])
+    assert not finished and status["video"] == {"id": "v1"}
+
+
+def test_released_session_can_be_reclaimed(store, tmp_path):
+    upload_id = _create(store)
+    _upload_all(store, upload_id)
+    store.claim_file(upload_id, USER_ID, str(tmp_path), "video-1")
+
+    store.release(upload_id, USER_ID, str(tmp_path), "video-1")
+    status = store.get_status(upload_id, USER_ID)
+    assert status["state"] == STATE_UPLOADING and status["offset"] == len(CONTENT)
+    assert not os.path.exists(tmp_path / "video-1.mp4")
+
+    # 重试最后一个分片：不重复写入，重新触发处理
+    status, finished = store.write_chunk(upload_id, USER_ID, 20, CONTENT[20:])
+    assert finished and status["offset"] == len(CONTENT)
+    path, _ = store.claim_file(upload_id, USER_ID, str(tmp_path), "video-2")
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+
+
+def test_cancelled_processing_restores_session(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(video_service_module, "upload_sessions", store)
+    monkeypatch.setattr(video_service_module.settings, "upload_dir", str(tmp_path / "uploads"))
+    service = video_service_module.VideoService(db=None)
+
+    started = asyncio.Event()
+
+    async def slow_process(**kwargs):
+        started.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(service, "process_stored_video", slow_process)
+
+    upload_id = _create(store)
+    _upload_all(store, upload_id)
+
+    async def run():
+        task = asyncio.ensure_future(service.finish_chunked_upload(upload_id, USER_ID))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    status = store.get_status(upload_id, USER_ID)
+    assert status["state"] == STATE_UPLOADING and status["offset"] == len(CONTENT)
+    assert os.listdir(tmp_path / "uploads" / "original") == []
+
+
+def test_invalid_video_discards_session(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(video_service_module, "upload_sessions", store)
+    monkeypatch.setattr(video_service_module.settings, "upload_dir", str(tmp_path / "uploads"))
+    service = video_service_module.VideoService(db=None)
+
+    async def failing_process(**kwargs):
+        raise HTTPException(status_code=400, detail="无效的视频文件")
+
+    monkeypatch.setattr(service, "process_stored_video", failing_process)
+
+    upload_id = _create(store)
+    _upload_all(store, upload_id)
+    with pytest.raises(HTTPException):
+        asyncio.run(service.finish_chunked_upload(upload_id, USER_ID))
+    with pytest.raises(HTTPException) as exc_info:
+        store.get_status(upload_id, USER_ID)
+    assert exc_info.value.status_code == 404
+    assert os.listdir(tmp_path / "uploads" / "original") == []
+
+
+def test_transient_failure_keeps_session(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(video_service_module, "upload_sessions", store)
+    monkeypatch.setattr(video_service_module.settings, "upload_dir", str(tmp_path / "uploads"))
+    service = video_service_module.VideoService(db=None)
+
+    async def failing_process(**kwargs):
+        assert kwargs["keep_original_on_error"]
+        raise HTTPException(status_code=500, detail="保存视频信息失败: 连接超时")
+
+    monkeypatch.setattr(service, "process_stored_video", failing_process)
+
+    upload_id = _create(store)
+    _upload_all(store, upload_id)
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(service.finish_chunked_upload(upload_id, USER_ID))
+    assert exc_info.value.status_code == 500
+
+    # 文件移回会话，重试最后一个分片即可重新处理，不必重新上传
+    status = store.get_status(upload_id, USER_ID)
+    assert status["state"] == STATE_UPLOADING and status["offset"] == len(CONTENT)
+    assert os.listdir(tmp_path / "uploads" / "original") == []
+    status, finished = store.write_chunk(upload_id, USER_ID, 20, CONTENT[20:])
+    assert finished
+
+
+def test_static_files_do_not_serve_chunk_sessions(tmp_path):
+    (tmp_path / "chunks" / "abc").mkdir(parents=True)
+    (tmp_path / "chunks" / "abc" / "meta.json").write_text("{}")
+    (tmp_path / "thumbnails").mkdir()
+    (tmp_path / "thumbnails" / "thumb.jpg").write_bytes(b"jpg")
+    app = FastAPI()
+    app.mount("/uploads", UploadStaticFiles(directory=str(tmp_path)), name="uploads")
+    client = TestClient(app)
+
+    assert client.get("/uploads/chunks/abc/meta.json").status_code == 404
+    assert client.get("/uploads/thumbnails/thumb.jpg").status_code == 200
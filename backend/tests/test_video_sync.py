@@ -0,0 +1,59 @@
+"""
+云存储同步的裁剪范围校验：下载前拒绝明显无效的范围，下载后校验失败时清理文件并原样返回 400
+"""
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from app.services import video_service as video_service_module
+
+USER_ID = "user-1"
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    for name in ("original", "processed", "thumbnails"):
+        os.makedirs(tmp_path / name)
+    monkeypatch.setattr(video_service_module.settings, "upload_dir", str(tmp_path))
+    return video_service_module.VideoService(db=None)
+
+
+def _fake_download(service, monkeypatch, downloads):
+    async def download_file(client, url, original_path, streaming_args):
+        downloads.append(url)
+        with open(original_path, "wb") as f:
+            f.write(b"video")
+        # 模拟边下载边转码的输出
+        processed_path = original_path.replace(os.sep + "original" + os.sep, os.sep + "processed" + os.sep)
+        with open(processed_path.replace(".mp4", "_processed.mp4"), "wb") as f:
+            f.write(b"processed")
+        return b""
+
+    monkeypatch.setattr(service, "_download_file", download_file)
+
+
+def test_invalid_bounds_are_rejected_before_download(service, monkeypatch):
+    downloads = []
+    _fake_download(service, monkeypatch, downloads)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(service._sync_file(None, "https://example.com/v.mp4", USER_ID, trim_start=3, trim_end=2))
+    assert exc_info.value.status_code == 400
+    assert downloads == []
+
+
+def test_trim_past_end_cleans_up_streamed_output(service, tmp_path, monkeypatch):
+    downloads = []
+    _fake_download(service, monkeypatch, downloads)
+    monkeypatch.setattr(
+        video_service_module.FFmpegHelper, "get_video_info", staticmethod(lambda path: {"duration": 3.0})
+    )
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(service._sync_file(None, "https://example.com/v.mp4", USER_ID, trim_start=5, trim_end=8))
+    assert exc_info.value.status_code == 400
+    assert downloads
+    assert os.listdir(tmp_path / "original") == []
+    assert os.listdir(tmp_path / "processed") == []
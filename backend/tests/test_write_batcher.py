@@ -0,0 +1,124 @@
+"""
+批量写入：永久错误逐行拒绝、临时错误转存 spool 与重放
+"""
+import asyncio
+import json
+
+import httpx
+import pytest
+from postgrest.exceptions import APIError
+
+from app.services.write_batcher import WriteBatcher, is_transient_error
+
+
+class FakeTable:
+    """模拟数据库：bad 行触发唯一约束冲突，down 为 True 时连接失败"""
+
+    def __init__(self):
+        self.rows = {}
+        self.down = False
+        self.calls = []
+
+    def insert(self, table, rows, upsert=False):
+        self.calls.append((table, len(rows), upsert))
+        if self.down:
+            raise httpx.ConnectError("connection refused")
+        if any(row.get("bad") for row in rows):
+            raise APIError({"code": "23505", "message": "duplicate key value"})
+        for row in rows:
+            self.rows[row["id"]] = row
+
+
+@pytest.fixture
+def db():
+    return FakeTable()
+
+
+@pytest.fixture
+def batcher(tmp_path, db):
+    batcher = WriteBatcher(
+        interval_ms=1,
+        max_rows=100,
+        spool_path=str(tmp_path / "spool.jsonl"),
+        replay_interval_seconds=3600
+    )
+    batcher._insert = db.insert
+    return batcher
+
+
+def _submit_all(batcher, rows):
+    async def run():
+        return await asyncio.gather(
+            *(batcher.submit("analyses", row) for row in rows),
+            return_exceptions=True
+        )
+    return asyncio.run(run())
+
+
+def _spooled(batcher):
+    with open(batcher.spool_path, encoding="utf-8") as f:
+        return [json.loads(line)["row"] for line in f if line.strip()]
+
+
+def test_bad_row_rejected_others_written(batcher, db):
+    rows = [{"id": "a"}, {"id": "b", "bad": True}, {"id": "c"}]
+    results = _submit_all(batcher, rows)
+
+    assert results[0] == rows[0] and results[2] == rows[2]
+    assert isinstance(results[1], APIError)
+    assert set(db.rows) == {"a", "c"}
+    # 永久错误不转存 spool
+    assert batcher.stats()["total_spooled"] == 0
+    assert batcher.stats()["total_rejected"] == 1
+    assert batcher.stats()["total_rows"] == 2
+
+
+def test_transient_error_spooled_and_replayed(batcher, db):
+    db.down = True
+    rows = [{"id": "a"}, {"id": "b"}]
+    results = _submit_all(batcher, rows)
+
+    assert results == rows
+    assert [row["id"] for row in _spooled(batcher)] == ["a", "b"]
+    assert db.rows == {}
+
+    # 数据库仍不可用：写回 spool
+    assert batcher.replay_spool() == 0
+    assert len(_spooled(batcher)) == 2
+
+    db.down = False
+    assert batcher.replay_spool() == 2
+    assert set(db.rows) == {"a", "b"}
+    assert db.calls[-1] == ("analyses", 2, True)
+    assert batcher.replay_spool() == 0
+
+
+def test_bad_row_in_spool_moved_to_rejected(batcher, db):
+    batcher._spool("analyses", [{"id": "a"}, {"id": "b", "bad": True}])
+
+    assert batcher.replay_spool() == 1
+    assert set(db.rows) == {"a"}
+    with open(f"{batcher.spool_path}.rejected", encoding="utf-8") as f:
+        rejected = [json.loads(line) for line in f]
+    assert [item["row"]["id"] for item in rejected] == ["b"]
+    assert "duplicate" in rejected[0]["error"]
+    # 被拒绝的行不再重放
+    assert batcher.replay_spool() == 0
+
+
+@pytest.mark.parametrize("error, transient", [
+    (httpx.ConnectError("refused"), True),
+    (httpx.ReadTimeout("timeout"), True),
+    (APIError({"code": "08006", "message": "connection failure"}), True),
+    (APIError({"code": "40P01", "message": "deadlock"}), True),
+    (APIError({"code": "PGRST001", "message": "db unavailable"}), True),
+    (APIError({"code": "503", "message": "bad gateway"}), True),
+    (APIError({"code": "429", "message": "too many requests"}), True),
+    (APIError({"message": "no code"}), True),
+    (APIError({"code": "23505", "message": "duplicate"}), False),
+    (APIError({"code": "PGRST204", "message": "column not found"}), False),
+    (APIError({"code": "400", "message": "bad request"}), False),
+    (ValueError("bad value"), False),
+])
+def test_is_transient_error(error, transient):
+    assert is_transient_error(error) is transient